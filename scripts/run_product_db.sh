@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
 set -euo pipefail
-python -m src.product_db.server --config config/local.yaml
+python -m src.product_db.server --config config/local.yaml "$@"
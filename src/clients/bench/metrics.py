@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import csv
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from ...common.stats import Histogram
+from ...common.time_utils import now_s, perf_s
+
+
+class Recorder:
+    """
+    Latency per API, errors by code and completions per second of the calls made by one
+    simulated client (no locking: one recorder per thread). merge() adds recorders of
+    several clients, runs or processes together; to_dict/from_dict carry them across
+    processes.
+    """
+
+    def __init__(self, started: float = 0.0):
+        self.started = started  # wall clock start of the measured phase
+        self.latency: Dict[str, Histogram] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self.per_second: Dict[int, List[int]] = {}  # second since start -> [ops, errors]
+        self.send_lag = Histogram()  # open loop: how late calls went out after their intended time
+
+    def record(self, api: str, latency_s: float, error_code: Optional[str], done_at: Optional[float] = None) -> None:
+        h = self.latency.get(api)
+        if h is None:
+            h = self.latency[api] = Histogram()
+        h.record_s(latency_s)
+        sec = int((now_s() if done_at is None else done_at) - self.started)
+        bucket = self.per_second.get(sec)
+        if bucket is None:
+            bucket = self.per_second[sec] = [0, 0]
+        bucket[0] += 1
+        if error_code:
+            by_code = self.errors.setdefault(api, {})
+            by_code[error_code] = by_code.get(error_code, 0) + 1
+            bucket[1] += 1
+
+    def wrap(self, client: Any) -> "TimedClient":
+        return TimedClient(client, self)
+
+    def merge(self, other: "Recorder") -> None:
+        self.send_lag.merge(other.send_lag)
+        for api, h in other.latency.items():
+            self.latency.setdefault(api, Histogram()).merge(h)
+        for api, by_code in other.errors.items():
+            mine = self.errors.setdefault(api, {})
+            for code, n in by_code.items():
+                mine[code] = mine.get(code, 0) + n
+        if not self.started:
+            self.started = other.started
+        # other's seconds are relative to its own start
+        shift = int(round(other.started - self.started))
+        for sec, (ops, errs) in other.per_second.items():
+            bucket = self.per_second.setdefault(sec + shift, [0, 0])
+            bucket[0] += ops
+            bucket[1] += errs
+
+    @property
+    def total_ops(self) -> int:
+        return sum(h.n for h in self.latency.values())
+
+    def overall(self) -> Histogram:
+        h = Histogram()
+        for x in self.latency.values():
+            h.merge(x)
+        return h
+
+    def summary(self) -> Dict[str, Any]:
+        apis = {}
+        for api, h in sorted(self.latency.items()):
+            apis[api] = {"latency_ms": h.summary_ms(), "errors": dict(self.errors.get(api, {}))}
+        out = {
+            "ops": self.total_ops,
+            "errors": sum(sum(c.values()) for c in self.errors.values()),
+            "latency_ms": self.overall().summary_ms(),
+            "apis": apis,
+            "per_second": [{"second": s, "ops": v[0], "errors": v[1]} for s, v in sorted(self.per_second.items())],
+        }
+        if self.send_lag.n:
+            out["send_lag_ms"] = self.send_lag.summary_ms()
+        return out
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "latency": {api: h.to_dict() for api, h in self.latency.items()},
+            "errors": self.errors,
+            "per_second": {str(s): v for s, v in self.per_second.items()},
+            "send_lag": self.send_lag.to_dict(),
+        }
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Recorder":
+        r = cls(float(d["started"]))
+        r.latency = {api: Histogram.from_dict(h) for api, h in d["latency"].items()}
+        r.errors = {api: dict(c) for api, c in d["errors"].items()}
+        r.per_second = {int(s): list(v) for s, v in d["per_second"].items()}
+        if d.get("send_lag"):
+            r.send_lag = Histogram.from_dict(d["send_lag"])
+        return r
+
+
+class TimedClient:
+    """
+    Client wrapper that records every call (latency, error code) into a Recorder. Latency
+    runs from the call, or from `intended` (perf_s) when the open-loop generator set it for
+    the next call, so time spent waiting for a free connection counts too.
+    """
+
+    def __init__(self, client: Any, recorder: Recorder):
+        self.client = client
+        self.recorder = recorder
+        self.intended: Optional[float] = None
+
+    def call(self, api: str, payload: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        t0 = perf_s() if self.intended is None else self.intended
+        self.intended = None
+        try:
+            resp = self.client.call(api, payload, **kwargs)
+        except Exception as e:
+            self.recorder.record(api, perf_s() - t0, type(e).__name__)
+            raise
+        code = None if resp.get("ok") else str((resp.get("error") or {}).get("code", "UNKNOWN"))
+        self.recorder.record(api, perf_s() - t0, code)
+        return resp
+
+
+def write_reports(
+    reports_dir: str, name: str, meta: Dict[str, Any], runs: List[Dict[str, Any]], overall: Optional[Dict[str, Any]]
+) -> List[str]:
+    """
+    Writes <name>-<timestamp>.json (everything) plus .apis.csv (latency per run and API) and
+    .throughput.csv (ops per second per run) under reports_dir; returns the paths. overall
+    (all runs merged) is left out when the runs are not comparable, e.g. a rate sweep.
+    """
+    os.makedirs(reports_dir, exist_ok=True)
+    base = os.path.join(reports_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now_s()))}")
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "runs": runs, "overall": overall}, f, indent=2)
+
+    cols = ["count", "mean", "p50", "p90", "p99", "p999", "max"]
+    with open(base + ".apis.csv", "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["run", "api"] + [c if c == "count" else f"{c}_ms" for c in cols] + ["errors", "errors_by_code"])
+        labelled = [(str(i + 1), r) for i, r in enumerate(runs)] + ([("all", overall)] if overall is not None else [])
+        for label, summary in labelled:
+            rows = list(summary["apis"].items()) + [("*", {"latency_ms": summary["latency_ms"], "errors": {}})]
+            for api, st in rows:
+                lat = st["latency_ms"]
+                errs = st["errors"] if api != "*" else {}
+                n_err = sum(errs.values()) if api != "*" else summary["errors"]
+                w.writerow([label, api] + [lat[c] for c in cols] + [n_err, json.dumps(errs, sort_keys=True)])
+
+    with open(base + ".throughput.csv", "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["run", "second", "ops", "errors"])
+        for i, r in enumerate(runs):
+            for row in r["per_second"]:
+                w.writerow([i + 1, row["second"], row["ops"], row["errors"]])
+    return [base + ".json", base + ".apis.csv", base + ".throughput.csv"]
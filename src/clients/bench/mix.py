@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import bisect
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import yaml
+
+from ...common.protocol import RpcClient
+from ..cache import ConditionalCache
+
+SELLER_APIS = ("GetSellerRating", "DisplayItemsForSale", "ChangeItemPrice", "UpdateUnitsForSale", "RegisterItemForSale")
+BUYER_APIS = (
+    "SearchItemsForSale",
+    "GetItem",
+    "AddItemToCart",
+    "RemoveItemFromCart",
+    "DisplayCart",
+    "SaveCart",
+    "ClearCart",
+    "ProvideFeedback",
+    "GetSellerRating",
+    "GetBuyerPurchases",
+)
+
+
+class Zipf:
+    """Ranks 0..n-1 with P(rank k) proportional to 1/(k+1)^s; s=0 is uniform. sample() takes the caller's Random."""
+
+    def __init__(self, n: int, s: float):
+        if n < 1:
+            raise ValueError("Zipf needs at least one rank")
+        weights = [1.0 / (k + 1) ** s for k in range(n)]
+        total = sum(weights)
+        self._cdf = list(itertools.accumulate(w / total for w in weights))
+
+    def sample(self, rng: random.Random) -> int:
+        return min(bisect.bisect_left(self._cdf, rng.random()), len(self._cdf) - 1)
+
+
+@dataclass
+class RoleMix:
+    """What one kind of client does: API weights, mean think time between ops, session churn."""
+
+    weights: Dict[str, float]
+    think_ms: float = 0.0
+    session_churn: float = 0.0  # chance per op of logging out and back in
+    _apis: List[str] = field(default_factory=list, init=False, repr=False)
+    _cum: List[float] = field(default_factory=list, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._apis = [api for api, w in self.weights.items() if w > 0]
+        self._cum = list(itertools.accumulate(self.weights[api] for api in self._apis))
+
+    def pick(self, rng: random.Random) -> str:
+        return rng.choices(self._apis, cum_weights=self._cum)[0]
+
+
+@dataclass
+class WorkloadSpec:
+    """
+    Declarative benchmark workload (see config/workload.sample.yaml): catalog shape,
+    Zipfian item and keyword popularity, and a weighted API mix per role.
+    """
+
+    seller: RoleMix
+    buyer: RoleMix
+    ops_per_client: int = 1000
+    categories: int = 1
+    items_per_seller: int = 10
+    item_quantity: int = 100000
+    keywords: int = 50
+    keywords_per_item: int = 3
+    keywords_per_search: int = 1
+    item_zipf: float = 1.0
+    keyword_zipf: float = 1.0
+    seed: int = 1
+
+    @cached_property
+    def keyword_popularity(self) -> Zipf:
+        return Zipf(self.keywords, self.keyword_zipf)
+
+    def draw_keywords(self, rng: random.Random, n: int) -> List[str]:
+        """n distinct keywords, drawn by popularity."""
+        kws: List[str] = []
+        while len(kws) < min(n, self.keywords):
+            kw = _keyword(self.keyword_popularity.sample(rng))
+            if kw not in kws:
+                kws.append(kw)
+        return kws
+
+    def item_payload(self, rng: random.Random, name: str) -> Dict[str, Any]:
+        """RegisterItemForSale payload of a new item: random category, keywords drawn by popularity."""
+        return {
+            "item_name": name[:32],
+            "item_category": rng.randint(1, self.categories),
+            "condition": "New",
+            "sale_price": 10.0,
+            "quantity": self.item_quantity,
+            "keywords": self.draw_keywords(rng, self.keywords_per_item),
+        }
+
+
+def _keyword(rank: int) -> str:
+    return f"kw{rank}"  # at most 8 characters for up to a million keywords
+
+
+def _role(raw: Optional[Dict[str, Any]], apis: Tuple[str, ...], name: str) -> RoleMix:
+    raw = raw or {}
+    weights = {str(k): float(v) for k, v in (raw.get("ops") or {}).items()}
+    unknown = sorted(set(weights) - set(apis))
+    if unknown:
+        raise ValueError(f"workload {name}.ops: unknown APIs {unknown} (known: {', '.join(apis)})")
+    if any(w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+        raise ValueError(f"workload {name}.ops: weights must be >= 0 and not all 0")
+    churn = float(raw.get("session_churn", 0.0))
+    if not 0.0 <= churn <= 1.0:
+        raise ValueError(f"workload {name}.session_churn must be within [0, 1]")
+    return RoleMix(weights, think_ms=float(raw.get("think_ms", 0.0)), session_churn=churn)
+
+
+def load_workload(path: str) -> WorkloadSpec:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = yaml.safe_load(f) or {}
+    catalog = raw.get("catalog") or {}
+    popularity = raw.get("popularity") or {}
+    buyer = raw.get("buyer") or {}
+    spec = WorkloadSpec(
+        seller=_role(raw.get("seller"), SELLER_APIS, "seller"),
+        buyer=_role(buyer, BUYER_APIS, "buyer"),
+        ops_per_client=int(raw.get("ops_per_client", 1000)),
+        categories=int(catalog.get("categories", 1)),
+        items_per_seller=int(catalog.get("items_per_seller", 10)),
+        item_quantity=int(catalog.get("item_quantity", 100000)),
+        keywords=int(catalog.get("keywords", 50)),
+        keywords_per_item=int(catalog.get("keywords_per_item", 3)),
+        keywords_per_search=int(buyer.get("keywords_per_search", 1)),
+        item_zipf=float(popularity.get("items_zipf", 1.0)),
+        keyword_zipf=float(popularity.get("keywords_zipf", 1.0)),
+        seed=int(raw.get("seed", 1)),
+    )
+    if spec.categories < 1 or spec.keywords < 1 or spec.ops_per_client < 1:
+        raise ValueError("workload: categories, keywords and ops_per_client must be >= 1")
+    if not 1 <= spec.keywords_per_item <= 5 or not 1 <= spec.keywords_per_search <= 5:
+        raise ValueError("workload: keywords_per_item and keywords_per_search must be within [1, 5]")
+    return spec
+
+
+class Catalog:
+    """
+    Items registered during setup in popularity order (Zipf rank 0 is the hottest),
+    shuffled by the spec's seed so hot items are spread over sellers and categories.
+    Built the same way in every load generator process.
+    """
+
+    def __init__(self, sellers: List[Dict[str, Any]], spec: WorkloadSpec):
+        self.items = [it for s in sellers for it in s.get("items", [])]
+        random.Random(spec.seed).shuffle(self.items)
+        self._items = Zipf(len(self.items), spec.item_zipf) if self.items else None
+        self.spec = spec
+
+    def hot_item(self, rng: random.Random) -> Dict[str, Any]:
+        assert self._items is not None
+        return self.items[self._items.sample(rng)]
+
+    def search_keywords(self, rng: random.Random) -> List[str]:
+        return self.spec.draw_keywords(rng, self.spec.keywords_per_search)
+
+
+def client_rng(spec: WorkloadSpec, role: str, index: int) -> random.Random:
+    """Per-client random stream, so a run with the same spec and seed repeats its op sequence."""
+    return random.Random(f"{spec.seed}-{role}-{index}")
+
+
+def _relogin(client: RpcClient, account: Dict[str, Any], session_id: str, role: str) -> Iterator[Tuple[str, str]]:
+    client.call("Logout", {}, session_id=session_id, role=role)
+    yield "Logout", session_id
+    login = client.call("Login", {"username": account["username"], "password": account.get("password", "pw")}, role=role)
+    if login.get("ok"):
+        session_id = login["data"]["session_id"]
+    yield "Login", session_id
+
+
+def seller_mix_ops(
+    client: RpcClient, seller: Dict[str, Any], spec: WorkloadSpec, rng: random.Random, session_id: Optional[str] = None
+) -> Iterator[str]:
+    """
+    Endless seller ops drawn from spec.seller, one call per step (yields the API called).
+    Price and unit changes go to the seller's own items, uniformly; new items join them.
+    """
+    mix = spec.seller
+    session = session_id or seller["session_id"]
+    own: List[Dict[str, int]] = list(seller["item_ids"])  # {category, id}
+    registered = 0
+    while True:
+        if mix.session_churn and rng.random() < mix.session_churn:
+            for api, session in _relogin(client, seller, session, "seller"):
+                yield api
+            continue
+        api = mix.pick(rng)
+        if api in ("ChangeItemPrice", "UpdateUnitsForSale") and not own:
+            api = "DisplayItemsForSale"
+        if api in ("GetSellerRating", "DisplayItemsForSale"):
+            client.call(api, {}, session_id=session, role="seller")
+        elif api == "ChangeItemPrice":
+            price = round(rng.uniform(5.0, 15.0), 2)
+            client.call(api, {"item_id": rng.choice(own), "new_price": price}, session_id=session, role="seller")
+        elif api == "UpdateUnitsForSale":
+            client.call(api, {"item_id": rng.choice(own), "remove_quantity": 1}, session_id=session, role="seller")
+        else:
+            registered += 1
+            payload = spec.item_payload(rng, f"s{seller['seller_id']}new{registered}")
+            resp = client.call(api, payload, session_id=session, role="seller")
+            if resp.get("ok"):
+                own.append(resp["data"]["item_id"])
+        yield api
+
+
+def buyer_mix_ops(
+    client: RpcClient,
+    buyer: Dict[str, Any],
+    catalog: Catalog,
+    spec: WorkloadSpec,
+    rng: random.Random,
+    conditional: bool = True,
+    session_id: Optional[str] = None,
+) -> Iterator[str]:
+    """
+    Endless buyer ops drawn from spec.buyer, one call per step (yields the API called).
+    Items are picked by popularity (catalog.hot_item), searches by a hot item's category
+    and popular keywords. Removing from an empty cart adds instead.
+    conditional: revalidate searches, items and the cart by etag instead of re-fetching them.
+    """
+    mix = spec.buyer
+    session = session_id or buyer["session_id"]
+    cache = ConditionalCache() if conditional else None
+    cart: Dict[Tuple[int, int], List[Any]] = {}  # item key -> [item_id, quantity]
+
+    def read(api: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if cache is not None:
+            return cache.call(client, api, payload, session_id=session, role="buyer")
+        return client.call(api, payload, session_id=session, role="buyer")
+
+    while True:
+        if mix.session_churn and rng.random() < mix.session_churn:
+            for api, session in _relogin(client, buyer, session, "buyer"):
+                yield api
+            cart.clear()  # an unsaved cart ends with the session
+            continue
+        api = mix.pick(rng)
+        if api == "RemoveItemFromCart" and not cart:
+            api = "AddItemToCart"
+        if not catalog.items and api in ("SearchItemsForSale", "GetItem", "AddItemToCart", "ProvideFeedback", "GetSellerRating"):
+            api = "DisplayCart"
+        if api == "SearchItemsForSale":
+            read(api, {"item_category": catalog.hot_item(rng)["category"], "keywords": catalog.search_keywords(rng)})
+        elif api == "GetItem":
+            read(api, {"item_id": catalog.hot_item(rng)["item_id"]})
+        elif api == "DisplayCart":
+            read(api, {})
+        elif api == "AddItemToCart":
+            item_id = catalog.hot_item(rng)["item_id"]
+            resp = client.call(api, {"item_id": item_id, "quantity": 1}, session_id=session, role="buyer")
+            if resp.get("ok"):
+                cart.setdefault((item_id["category"], item_id["id"]), [item_id, 0])[1] += 1
+        elif api == "RemoveItemFromCart":
+            key = rng.choice(list(cart))
+            item_id, qty = cart[key]
+            client.call(api, {"item_id": item_id, "quantity": 1}, session_id=session, role="buyer")
+            if qty <= 1:
+                del cart[key]
+            else:
+                cart[key][1] = qty - 1
+        elif api == "ProvideFeedback":
+            vote = "up" if rng.random() < 0.5 else "down"
+            client.call(api, {"item_id": catalog.hot_item(rng)["item_id"], "vote": vote}, session_id=session, role="buyer")
+        elif api == "GetSellerRating":
+            client.call(api, {"seller_id": catalog.hot_item(rng)["seller_id"]}, session_id=session, role="buyer")
+        else:
+            client.call(api, {}, session_id=session, role="buyer")
+            if api == "ClearCart":
+                cart.clear()
+        yield api
+
+
+def run_closed(steps: Iterator[str], ops: int, think_ms: float, rng: random.Random) -> None:
+    """Closed loop over a mix: ops steps, each followed by an exponential think time of mean think_ms."""
+    think_s = think_ms / 1000.0
+    for _ in itertools.islice(steps, ops):
+        if think_s > 0:
+            time.sleep(rng.expovariate(1.0 / think_s))
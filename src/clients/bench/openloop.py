@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from ...common.time_utils import perf_s
+from .metrics import TimedClient
+
+
+@dataclass
+class OpenLoop:
+    """Open-loop run parameters (see runner.run_open)."""
+
+    rate: float
+    duration_s: float
+    poisson: bool = True
+    connections: int = 16
+    drain_s: float = 10.0
+    seed: Optional[int] = None
+
+
+class ArrivalSchedule:
+    """
+    Intended send times (perf_s) of an open-loop run: rate arrivals per second for
+    duration_s from start, evenly spaced or Poisson (exponential gaps). Shared by the
+    workers of one frontend; each arrival is taken by exactly one of them. Several
+    processes interleave their constant schedules with different offsets (first arrival
+    at start + offset).
+    """
+
+    def __init__(self, rate: float, duration_s: float, poisson: bool, start: float, seed: Optional[int] = None, offset: float = 0.0):
+        if rate <= 0:
+            raise ValueError("rate must be > 0")
+        self.rate = float(rate)
+        self.poisson = poisson
+        self.end = start + duration_s
+        self._next = start + offset
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.taken = 0
+        self.missed = 0  # arrivals never sent because the run's drain time ran out
+
+    def _advance(self) -> None:
+        self._next += self._rng.expovariate(self.rate) if self.poisson else 1.0 / self.rate
+
+    def take(self) -> Optional[float]:
+        """The next arrival's intended send time, or None when the schedule is used up."""
+        with self._lock:
+            if self._next >= self.end:
+                return None
+            slot = self._next
+            self._advance()
+            self.taken += 1
+            return slot
+
+    def give_up(self) -> None:
+        """Counts a taken arrival and every one not taken yet as missed."""
+        with self._lock:
+            self.taken -= 1
+            self.missed += 1
+            while self._next < self.end:
+                self._advance()
+                self.missed += 1
+
+
+def run_worker(schedule: ArrivalSchedule, client: TimedClient, make_steps: Callable[[], Iterator[str]], stop_at: float) -> None:
+    """
+    Sends one op (one step of make_steps()) per arrival taken from schedule, no earlier than
+    its intended time; latency is recorded from that time, so an arrival that waited for
+    this worker still counts the wait. Gives up on the rest of the schedule at stop_at.
+    """
+    steps = make_steps()
+    while True:
+        slot = schedule.take()
+        if slot is None:
+            return
+        now = perf_s()
+        if now >= stop_at:
+            schedule.give_up()
+            return
+        if slot > now:
+            time.sleep(slot - now)
+        client.recorder.send_lag.record_s(max(0.0, perf_s() - slot))
+        client.intended = slot
+        try:
+            next(steps)
+        except StopIteration:
+            steps = make_steps()
+        except Exception:
+            # already recorded by the TimedClient; the op cycle restarts
+            client.intended = None
+            steps = make_steps()
+
+
+def knee(steps: List[Dict[str, Any]], min_ratio: float = 0.95) -> Optional[float]:
+    """
+    Target rate of the first sweep step the system did not keep up with: it missed
+    arrivals, or completed ops slower than min_ratio of the rate they actually arrived at.
+    None if it kept up with all of them.
+    """
+    for st in steps:
+        if st["missed"] or st["throughput_ops_s"] < min_ratio * st["arrival_rate"]:
+            return float(st["offered_rate"])
+    return None
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import multiprocessing
+import queue
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from ...common.time_utils import now_s
+from .metrics import Recorder
+
+# what a measured phase returns: (elapsed seconds, every call, extra counters)
+PhaseResult = Tuple[float, Recorder, Dict[str, Any]]
+
+
+class StartGate:
+    """
+    Lines up the measured phase of several load generator processes: each one connects its
+    clients, then wait() returns the same wall clock start time to all of them.
+    """
+
+    def __init__(self, ctx: Any, parties: int, timeout_s: float = 120.0):
+        self._barrier = ctx.Barrier(parties, timeout=timeout_s)
+        self._start = ctx.Value("d", 0.0)
+
+    def wait(self, lead_s: float = 0.2) -> float:
+        if self._barrier.wait() == 0:
+            self._start.value = now_s() + lead_s
+        self._barrier.wait()
+        return float(self._start.value)
+
+    def abort(self) -> None:
+        self._barrier.abort()
+
+
+def start_time(gate: Optional[StartGate]) -> float:
+    """Wall clock start of the measured phase: agreed through gate, or shortly from now."""
+    return gate.wait() if gate is not None else now_s() + 0.1
+
+
+def sleep_until(wall_s: float) -> None:
+    delay = wall_s - now_s()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def _child(phase: Callable[..., PhaseResult], kwargs: Dict[str, Any], gate: StartGate, k: int, results: Any) -> None:
+    try:
+        elapsed, rec, extra = phase(gate=gate, **kwargs)
+        results.put((k, None, (elapsed, rec.to_dict(), extra)))
+    except BaseException as e:
+        gate.abort()  # don't leave the others waiting at the gate
+        results.put((k, f"{type(e).__name__}: {e}", None))
+
+
+def run_in_procs(phase: Callable[..., PhaseResult], jobs: List[Dict[str, Any]]) -> List[PhaseResult]:
+    """
+    Runs phase(gate=..., **job) for every job in its own process (spawned, so each has its
+    own GIL and imports) with a synchronized start; returns their results in job order,
+    Recorders rebuilt from to_dict(). phase must be a module level function.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    gate = StartGate(ctx, len(jobs))
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_child, args=(phase, job, gate, k, results), name=f"loadgen-{k}", daemon=True) for k, job in enumerate(jobs)]
+    for p in procs:
+        p.start()
+    out: Dict[int, PhaseResult] = {}
+    try:
+        while len(out) < len(jobs):
+            try:
+                k, err, res = results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [p for p in procs if p.exitcode is not None and p.exitcode != 0]
+                if dead:
+                    raise RuntimeError(f"load generator process {dead[0].name} exited with code {dead[0].exitcode}")
+                continue
+            if err is not None:
+                raise RuntimeError(f"load generator process loadgen-{k} failed: {err}")
+            elapsed, rec, extra = res
+            out[k] = (elapsed, Recorder.from_dict(rec), extra)
+    finally:
+        for p in procs:
+            if len(out) < len(jobs):
+                p.terminate()
+            p.join()
+    return [out[k] for k in range(len(jobs))]
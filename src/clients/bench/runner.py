@@ -1,60 +1,113 @@
 from __future__ import annotations
 
 import argparse
+import random
 import statistics
 import threading
-from typing import List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
-from ...common.config import load_config, get_endpoint
-from ...common.protocol import PersistentRpcClient
-from ...common.time_utils import monotonic_s
-from .workload import setup_sellers, setup_buyers, seller_1000_ops, buyer_1000_ops
+from ...common.config import Endpoint, load_config, get_endpoint
+from ...common.protocol import PersistentRpcClient, RetryPolicy, configure_compression
+from ...common.time_utils import monotonic_s, now_s, perf_s
+from .metrics import Recorder, TimedClient, write_reports
+from .mix import Catalog, WorkloadSpec, buyer_mix_ops, client_rng, load_workload, run_closed, seller_mix_ops
+from .openloop import ArrivalSchedule, OpenLoop, knee, run_worker
+from .procs import PhaseResult, StartGate, run_in_procs, sleep_until, start_time
+from .workload import setup_sellers, setup_buyers, seller_1000_ops, buyer_1000_ops, seller_ops, buyer_ops
 
 
-def run_once(n_sellers: int, n_buyers: int, items_per_seller: int, cfg_path: str) -> Tuple[float, float]:
+def _targets(cfg_path: str) -> Tuple[Endpoint, Endpoint, RetryPolicy]:
     cfg = load_config(cfg_path)
-    sf = get_endpoint(cfg.seller_frontend)
-    bf = get_endpoint(cfg.buyer_frontend)
+    configure_compression(cfg.compression)
+    return get_endpoint(cfg.seller_frontend), get_endpoint(cfg.buyer_frontend), RetryPolicy.from_config(cfg.rpc_retry)
 
-    # Setup phase (create accounts, login, register items)
-    seller_setup = PersistentRpcClient(sf.host, sf.port, timeout_s=30.0)
-    buyer_setup = PersistentRpcClient(bf.host, bf.port, timeout_s=30.0)
+
+def _prepare(
+    cfg_path: str, n_sellers: int, n_buyers: int, items_per_seller: int, workload: Optional[WorkloadSpec] = None
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Optional[Catalog]]:
+    """
+    Setup phase (create accounts, login, register items); returns (sellers, buyers, catalog).
+    With a workload spec its catalog is registered (items_per_seller comes from the spec)
+    and returned for the mixes; without one, catalog is None.
+    """
+    sf, bf, retry = _targets(cfg_path)
+    seller_setup = PersistentRpcClient(sf.host, sf.port, timeout_s=30.0, retry=retry)
+    buyer_setup = PersistentRpcClient(bf.host, bf.port, timeout_s=30.0, retry=retry)
     seller_setup.connect()
     buyer_setup.connect()
 
-    sellers = setup_sellers(seller_setup, n_sellers, items_per_seller, category=1)
+    if workload is None:
+        sellers = setup_sellers(seller_setup, n_sellers, items_per_seller, category=1)
+    else:
+        seed = workload.seed
+        payload = lambda i, j: workload.item_payload(random.Random(f"{seed}-item-{i}-{j}"), f"item{i}_{j}")
+        sellers = setup_sellers(seller_setup, n_sellers, workload.items_per_seller, item_payload=payload)
     buyers = setup_buyers(buyer_setup, n_buyers)
 
     seller_setup.close()
     buyer_setup.close()
+    return sellers, buyers, Catalog(sellers, workload) if workload is not None else None
 
-    # Measured phase: one persistent TCP connection per simulated client thread
+
+def _closed_phase(
+    cfg_path: str,
+    sellers: List[Dict[str, Any]],
+    buyers: List[Tuple[int, Dict[str, Any]]],
+    conditional: bool = True,
+    catalog: Optional[Catalog] = None,
+    gate: Optional[StartGate] = None,
+) -> PhaseResult:
+    """
+    Measured phase of a closed-loop run for some of the clients (buyers with their index,
+    which picks the item they buy). One persistent TCP connection per simulated client
+    thread and its own Recorder (merged below, so recording needs no lock). With a
+    catalog, clients run its spec's mixes instead of the fixed 1000-op cycles.
+    """
+    sf, bf, retry = _targets(cfg_path)
     threads: List[threading.Thread] = []
+    recorders: List[Recorder] = []
 
-    def seller_task(sess: str, item_ids):
-        c = PersistentRpcClient(sf.host, sf.port, timeout_s=30.0)
+    def seller_task(seller: Dict[str, Any], rec: Recorder):
+        c = PersistentRpcClient(sf.host, sf.port, timeout_s=30.0, retry=retry)
         c.connect()
         try:
-            seller_1000_ops(c, sess, item_ids)
+            if catalog is None:
+                seller_1000_ops(c, seller["session_id"], seller["item_ids"], recorder=rec)
+            else:
+                spec = catalog.spec
+                rng = client_rng(spec, "seller", seller["seller_id"])
+                run_closed(seller_mix_ops(rec.wrap(c), seller, spec, rng), spec.ops_per_client, spec.seller.think_ms, rng)
         finally:
             c.close()
 
-    def buyer_task(sess: str, pick: int):
-        c = PersistentRpcClient(bf.host, bf.port, timeout_s=30.0)
+    def buyer_task(buyer: Dict[str, Any], pick: int, rec: Recorder):
+        c = PersistentRpcClient(bf.host, bf.port, timeout_s=30.0, retry=retry)
         c.connect()
         try:
-            buyer_1000_ops(c, sess, 1, pick)
+            if catalog is None:
+                buyer_1000_ops(c, buyer["session_id"], 1, pick, conditional=conditional, recorder=rec)
+            else:
+                spec = catalog.spec
+                rng = client_rng(spec, "buyer", buyer["buyer_id"])
+                steps = buyer_mix_ops(rec.wrap(c), buyer, catalog, spec, rng, conditional=conditional)
+                run_closed(steps, spec.ops_per_client, spec.buyer.think_ms, rng)
         finally:
             c.close()
 
     for s in sellers:
-        t = threading.Thread(target=seller_task, args=(s["session_id"], s["item_ids"]), daemon=True)
+        recorders.append(Recorder())
+        t = threading.Thread(target=seller_task, args=(s, recorders[-1]), daemon=True)
         threads.append(t)
 
-    for i, b in enumerate(buyers):
-        t = threading.Thread(target=buyer_task, args=(b["session_id"], i), daemon=True)
+    for i, b in buyers:
+        recorders.append(Recorder())
+        t = threading.Thread(target=buyer_task, args=(b, i, recorders[-1]), daemon=True)
         threads.append(t)
 
+    started = start_time(gate)
+    for rec in recorders:
+        rec.started = started
+    sleep_until(started)
     start = monotonic_s()
     for t in threads:
         t.start()
@@ -62,18 +115,252 @@ def run_once(n_sellers: int, n_buyers: int, items_per_seller: int, cfg_path: str
         t.join()
     elapsed = monotonic_s() - start
 
-    total_clients = n_sellers + n_buyers
-    total_ops = total_clients * 1000
-    throughput = total_ops / elapsed if elapsed > 0 else 0.0
-    avg_resp = elapsed / total_ops if total_ops > 0 else 0.0
-    return avg_resp, throughput
+    total = Recorder(started)
+    for rec in recorders:
+        total.merge(rec)
+    return elapsed, total, {}
+
+
+def _merge(results: List[PhaseResult]) -> PhaseResult:
+    """Processes started together, so the run took as long as the slowest one."""
+    total = Recorder()
+    extra: Dict[str, Any] = {}
+    for _, rec, x in results:
+        total.merge(rec)
+        for key, v in x.items():
+            extra[key] = extra.get(key, 0) + v
+    return max(r[0] for r in results), total, extra
+
+
+def run_once(
+    n_sellers: int,
+    n_buyers: int,
+    items_per_seller: int,
+    cfg_path: str,
+    conditional: bool = True,
+    procs: int = 1,
+    workload: Optional[WorkloadSpec] = None,
+) -> Tuple[float, Recorder]:
+    """
+    Closed loop: every client sends its next op when the last one returns (after its think
+    time, with a workload spec). With procs > 1 the clients are dealt out round-robin to
+    that many load generator processes. Returns (elapsed seconds, every call of the
+    measured phase).
+    """
+    sellers, buyers, catalog = _prepare(cfg_path, n_sellers, n_buyers, items_per_seller, workload)
+    indexed = list(enumerate(buyers))
+    procs = max(1, min(procs, max(len(sellers), len(buyers))))
+    if procs == 1:
+        elapsed, rec, _ = _closed_phase(cfg_path, sellers, indexed, conditional, catalog)
+        return elapsed, rec
+    jobs = [
+        {"cfg_path": cfg_path, "sellers": sellers[k::procs], "buyers": indexed[k::procs], "conditional": conditional, "catalog": catalog}
+        for k in range(procs)
+    ]
+    elapsed, rec, _ = _merge(run_in_procs(_closed_phase, jobs))
+    return elapsed, rec
+
+
+def _open_phase(
+    cfg_path: str,
+    sellers: List[Dict[str, Any]],
+    buyers: List[Dict[str, Any]],
+    spec: OpenLoop,
+    conn_range: Tuple[int, int],
+    proc_index: int = 0,
+    conditional: bool = True,
+    catalog: Optional[Catalog] = None,
+    gate: Optional[StartGate] = None,
+) -> PhaseResult:
+    """
+    Measured phase of an open-loop run over connections conn_range (of spec.connections)
+    per frontend; this process takes that share of the arrivals. With a catalog each
+    connection logs in its own session and runs its spec's mix (think times do not apply:
+    the arrivals set the pace).
+    """
+    sf, bf, retry = _targets(cfg_path)
+    lo, hi = conn_range
+    share = (hi - lo) / spec.connections
+    n_sellers, n_buyers = len(sellers), len(buyers)
+    seller_rate = spec.rate * n_sellers / (n_sellers + n_buyers)
+    roles = [(True, sf, seller_rate, sellers), (False, bf, spec.rate - seller_rate, buyers)]
+    roles = [r for r in roles if r[2] > 0 and r[3]]
+
+    # connect everything before the schedule starts
+    conns: List[Tuple[bool, int, Dict[str, Any], PersistentRpcClient]] = []
+    for is_seller, ep, _, sessions in roles:
+        for i in range(lo, hi):
+            c = PersistentRpcClient(ep.host, ep.port, timeout_s=30.0, retry=retry)
+            c.connect()
+            account = sessions[i % len(sessions)]
+            if catalog is not None:
+                # its own session, so session churn on one connection leaves the others logged in
+                role = "seller" if is_seller else "buyer"
+                login = c.call("Login", {"username": account["username"], "password": "pw"}, role=role)
+                if not login.get("ok"):
+                    raise RuntimeError(f"{role} login failed: {login}")
+                account = {**account, "session_id": login["data"]["session_id"]}
+            conns.append((is_seller, i, account, c))
+
+    started = start_time(gate)
+    start = perf_s() + (started - now_s())
+    schedules = {}
+    for is_seller, _, role_rate, _ in roles:
+        seed = None if spec.seed is None else spec.seed + 2 * proc_index + int(is_seller)
+        # constant arrivals of the processes interleave instead of coinciding
+        offset = 0.0 if spec.poisson else proc_index / role_rate
+        schedules[is_seller] = ArrivalSchedule(role_rate * share, spec.duration_s, spec.poisson, start, seed, offset)
+    workers: List[Tuple[ArrivalSchedule, TimedClient, Any]] = []
+    for is_seller, i, sess, c in conns:
+        timed = TimedClient(c, Recorder(started))
+        if catalog is not None:
+            rng = client_rng(catalog.spec, "seller" if is_seller else "buyer", i)
+            if is_seller:
+                make = lambda timed=timed, sess=sess, rng=rng: seller_mix_ops(timed, sess, catalog.spec, rng)
+            else:
+                make = lambda timed=timed, sess=sess, rng=rng: buyer_mix_ops(timed, sess, catalog, catalog.spec, rng, conditional=conditional)
+        elif is_seller:
+            make = lambda timed=timed, sess=sess: seller_ops(timed, sess["session_id"], sess["item_ids"])
+        else:
+            make = lambda timed=timed, sess=sess, i=i: buyer_ops(timed, sess["session_id"], 1, i, conditional=conditional)
+        workers.append((schedules[is_seller], timed, make))
+
+    stop_at = start + spec.duration_s + spec.drain_s
+    threads = [threading.Thread(target=run_worker, args=(sched, timed, make, stop_at), daemon=True) for sched, timed, make in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = perf_s() - start
+    for _, _, _, c in conns:
+        c.close()
+
+    total = Recorder(started)
+    for _, timed, _ in workers:
+        total.merge(timed.recorder)
+    arrivals = {"sent": sum(s.taken for s in schedules.values()), "missed": sum(s.missed for s in schedules.values())}
+    return elapsed, total, arrivals
+
+
+def run_open(
+    n_sellers: int,
+    n_buyers: int,
+    items_per_seller: int,
+    cfg_path: str,
+    spec: OpenLoop,
+    conditional: bool = True,
+    procs: int = 1,
+    workload: Optional[WorkloadSpec] = None,
+) -> PhaseResult:
+    """
+    Open loop: ops arrive at spec.rate per second for spec.duration_s whatever the response
+    times, split between the frontends in proportion to sellers and buyers, and are sent
+    over spec.connections persistent connections per frontend (sessions shared round-robin;
+    with procs > 1 the connections and their share of the arrivals are dealt out to that
+    many load generator processes). Latency is measured from each op's intended send time.
+    Arrivals still unsent spec.drain_s after the schedule ends are given up (missed). Each
+    arrival is one op of the workload spec's mix, if given. Returns (elapsed seconds,
+    every call, arrival counts).
+    """
+    sellers, buyers, catalog = _prepare(cfg_path, n_sellers, n_buyers, items_per_seller, workload)
+    procs = max(1, min(procs, spec.connections))
+    if procs == 1:
+        return _open_phase(cfg_path, sellers, buyers, spec, (0, spec.connections), 0, conditional, catalog)
+    bounds = [k * spec.connections // procs for k in range(procs + 1)]
+    jobs = [
+        {
+            "cfg_path": cfg_path, "sellers": sellers, "buyers": buyers, "spec": spec,
+            "conn_range": (bounds[k], bounds[k + 1]), "proc_index": k, "conditional": conditional, "catalog": catalog,
+        }
+        for k in range(procs)
+    ]
+    return _merge(run_in_procs(_open_phase, jobs))
+
+
+def print_latency_table(summary: Dict[str, Any]) -> None:
+    print(f"{'api':<24} {'count':>7} {'errors':>6} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'p99.9':>8} {'max':>8}  (ms)")
+    rows = list(summary["apis"].items()) + [("all", {"latency_ms": summary["latency_ms"], "errors": None})]
+    for api, st in rows:
+        lat = st["latency_ms"]
+        n_err = summary["errors"] if st["errors"] is None else sum(st["errors"].values())
+        print(
+            f"{api:<24} {lat['count']:>7} {n_err:>6} {lat['mean']:>8.2f} {lat['p50']:>8.2f} {lat['p90']:>8.2f} "
+            f"{lat['p99']:>8.2f} {lat['p999']:>8.2f} {lat['max']:>8.2f}"
+        )
+        if st["errors"]:
+            print(f"{'':<24} errors: {st['errors']}")
+
+
+def _open_main(args: argparse.Namespace, n_sellers: int, n_buyers: int, items_per_seller: int, workload: Optional[WorkloadSpec]) -> None:
+    rates = [float(x) for x in args.rate.split(",") if x.strip()]
+    runs_per_rate = args.runs or 1
+    steps: List[Dict[str, Any]] = []
+    for rate in rates:
+        for r in range(runs_per_rate):
+            spec = OpenLoop(rate, args.duration, args.arrivals == "poisson", args.connections, args.drain, args.seed)
+            elapsed, rec, arrivals = run_open(
+                n_sellers, n_buyers, items_per_seller, args.config, spec, conditional=not args.no_etags, procs=args.procs,
+                workload=workload,
+            )
+            summary = rec.summary()
+            throughput = summary["ops"] / elapsed if elapsed > 0 else 0.0
+            summary.update({
+                "offered_rate": rate,
+                "arrival_rate": round((arrivals["sent"] + arrivals["missed"]) / args.duration, 2),
+                **arrivals,
+                "elapsed_s": round(elapsed, 3),
+                "throughput_ops_s": round(throughput, 2),
+            })
+            steps.append(summary)
+            lat, lag = summary["latency_ms"], summary.get("send_lag_ms", {})
+            print(
+                f"rate {rate:g}/s run {r+1}/{runs_per_rate}: sent={arrivals['sent']} missed={arrivals['missed']} "
+                f"throughput={throughput:.2f} ops/s, latency p50={lat['p50']:.2f}ms p99={lat['p99']:.2f}ms "
+                f"max={lat['max']:.2f}ms, send lag p99={lag.get('p99', 0.0):.2f}ms, errors={summary['errors']}"
+            )
+            if len(rates) == 1:
+                print_latency_table(summary)
+
+    print(f"\n=== Open loop, scenario {args.scenario}: sellers={n_sellers}, buyers={n_buyers}, {args.arrivals} arrivals, {args.duration:g}s per step ===")
+    print(f"{'rate':>8} {'achieved':>9} {'missed':>7} {'errors':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'p99.9':>8} {'max':>8}  (ops/s, ms)")
+    for st in steps:
+        lat = st["latency_ms"]
+        print(
+            f"{st['offered_rate']:>8g} {st['throughput_ops_s']:>9.2f} {st['missed']:>7} {st['errors']:>6} {lat['p50']:>8.2f} "
+            f"{lat['p90']:>8.2f} {lat['p99']:>8.2f} {lat['p999']:>8.2f} {lat['max']:>8.2f}"
+        )
+    k = knee(steps)
+    if k is None:
+        print("kept up with every rate")
+    else:
+        print(f"saturated at {k:g} ops/s (completed slower than ops arrived, or missed arrivals)")
+    meta = {
+        "mode": "open", "scenario": args.scenario, "sellers": n_sellers, "buyers": n_buyers, "rates": rates,
+        "runs_per_rate": runs_per_rate, "duration_s": args.duration, "arrivals": args.arrivals,
+        "connections": args.connections, "procs": args.procs, "etags": not args.no_etags, "config": args.config,
+        "workload": args.workload, "knee_ops_s": k,
+    }
+    # steps at different rates are not comparable, so no "all" summary
+    for path in write_reports(args.reports_dir, f"bench-open-scenario{args.scenario}", meta, steps, None):
+        print(f"wrote {path}")
 
 
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
     ap.add_argument("--scenario", type=int, required=True, choices=[1, 2, 3])
-    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--runs", type=int, default=None, help="runs (closed loop, default 10) or runs per rate (open loop, default 1)")
+    ap.add_argument("--no-etags", action="store_true", help="always re-fetch searches/items instead of revalidating")
+    ap.add_argument("--reports-dir", default="reports", help="where the JSON/CSV results go")
+    ap.add_argument("--mode", choices=["closed", "open"], default="closed", help="closed: 1000 ops per client back to back; open: ops arrive at --rate")
+    ap.add_argument("--rate", default="100", help="open loop: target ops/s, or a comma separated sweep (e.g. 100,200,400)")
+    ap.add_argument("--duration", type=float, default=30.0, help="open loop: seconds of arrivals per rate")
+    ap.add_argument("--arrivals", choices=["poisson", "constant"], default="poisson", help="open loop: arrival process")
+    ap.add_argument("--connections", type=int, default=16, help="open loop: connections per frontend")
+    ap.add_argument("--drain", type=float, default=10.0, help="open loop: seconds to keep sending late arrivals after the schedule ends")
+    ap.add_argument("--seed", type=int, default=None, help="open loop: seed for Poisson arrivals")
+    ap.add_argument("--workload", default=None, help="workload spec (YAML, see config/workload.sample.yaml) instead of the fixed op cycles")
+    ap.add_argument("--procs", type=int, default=1, help="load generator processes the clients (open loop: connections) are spread over")
     args = ap.parse_args()
 
     if args.scenario == 1:
@@ -84,19 +371,40 @@ def main() -> None:
         n_sellers, n_buyers = 100, 100
 
     items_per_seller = 10
-    avgs: List[float] = []
+    workload = load_workload(args.workload) if args.workload else None
+    if args.mode == "open":
+        _open_main(args, n_sellers, n_buyers, items_per_seller, workload)
+        return
+
+    n_runs = args.runs or 10
     thr: List[float] = []
+    runs: List[Dict[str, Any]] = []
+    overall = Recorder()
 
-    for r in range(args.runs):
-        avg_resp, throughput = run_once(n_sellers, n_buyers, items_per_seller, args.config)
-        avgs.append(avg_resp)
+    for r in range(n_runs):
+        elapsed, rec = run_once(
+            n_sellers, n_buyers, items_per_seller, args.config, conditional=not args.no_etags, procs=args.procs, workload=workload
+        )
+        summary = rec.summary()
+        throughput = summary["ops"] / elapsed if elapsed > 0 else 0.0
+        summary.update({"elapsed_s": round(elapsed, 3), "throughput_ops_s": round(throughput, 2)})
+        runs.append(summary)
+        overall.merge(rec)
         thr.append(throughput)
-        print(f"run {r+1}/{args.runs}: avg_resp={avg_resp:.6f}s, throughput={throughput:.2f} ops/s")
+        lat = summary["latency_ms"]
+        print(
+            f"run {r+1}/{n_runs}: throughput={throughput:.2f} ops/s, latency mean={lat['mean']:.2f}ms "
+            f"p50={lat['p50']:.2f}ms p99={lat['p99']:.2f}ms max={lat['max']:.2f}ms, errors={summary['errors']}"
+        )
 
-    print("\n=== Averages over runs ===")
+    total = overall.summary()
+    print("\n=== All runs ===")
     print(f"Scenario {args.scenario}: sellers={n_sellers}, buyers={n_buyers}")
-    print(f"Average response time (s/op): {statistics.mean(avgs):.6f}")
-    print(f"Average throughput (ops/s):    {statistics.mean(thr):.2f}")
+    print(f"Average throughput (ops/s): {statistics.mean(thr):.2f}")
+    print_latency_table(total)
+    meta = {"mode": "closed", "scenario": args.scenario, "sellers": n_sellers, "buyers": n_buyers, "runs": n_runs, "procs": args.procs, "etags": not args.no_etags, "config": args.config, "workload": args.workload}
+    for path in write_reports(args.reports_dir, f"bench-scenario{args.scenario}", meta, runs, total):
+        print(f"wrote {path}")
 
 
 if __name__ == "__main__":
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import random
-from typing import List, Dict, Any, Tuple
+from typing import Callable, List, Dict, Any, Iterator, Optional, Tuple
 import time
 
 from ...common.protocol import RpcClient
+from ..cache import ConditionalCache
+from .metrics import Recorder
 
 
 def _seller_username(i: int) -> str:
@@ -15,9 +17,17 @@ def _buyer_username(i: int) -> str:
     return f"buyer{i}"
 
 
-def setup_sellers(seller_client: RpcClient, n: int, items_per_seller: int, category: int = 1) -> List[Dict[str, Any]]:
+def setup_sellers(
+    seller_client: RpcClient,
+    n: int,
+    items_per_seller: int,
+    category: int = 1,
+    item_payload: Optional[Callable[[int, int], Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
     """
-    Returns list of dicts: {"seller_id": int, "session_id": str, "item_ids": [item_id,...]}
+    Returns list of dicts: {"seller_id": int, "username": str, "session_id": str, "item_ids": [item_id,...],
+    "items": [{"item_id", "category", "seller_id"},...]}
+    item_payload(i, j): RegisterItemForSale payload of seller i's item j (default: `category`, keywords s<id>/common/it<j>)
     """
     sellers = []
     for i in range(n):
@@ -35,18 +45,19 @@ def setup_sellers(seller_client: RpcClient, n: int, items_per_seller: int, categ
         sid = login["data"]["seller_id"]
 
         item_ids = []
+        items = []
         for j in range(items_per_seller):
-            name = f"item{i}_{j}"[:32]
-            kws = [f"s{sid}"[:8], "common"[:8], f"it{j}"[:8]]
-            reg = seller_client.call(
-                "RegisterItemForSale",
-                {"item_name": name, "item_category": category, "condition": "New", "sale_price": 10.0, "quantity": 100, "keywords": kws},
-                session_id=sess,
-                role="seller",
-            )
+            if item_payload is not None:
+                payload = item_payload(i, j)
+            else:
+                name = f"item{i}_{j}"[:32]
+                kws = [f"s{sid}"[:8], "common"[:8], f"it{j}"[:8]]
+                payload = {"item_name": name, "item_category": category, "condition": "New", "sale_price": 10.0, "quantity": 100, "keywords": kws}
+            reg = seller_client.call("RegisterItemForSale", payload, session_id=sess, role="seller")
             if reg.get("ok"):
                 item_ids.append(reg["data"]["item_id"])
-        sellers.append({"seller_id": sid, "session_id": sess, "item_ids": item_ids})
+                items.append({"item_id": reg["data"]["item_id"], "category": payload["item_category"], "seller_id": sid})
+        sellers.append({"seller_id": sid, "username": username, "session_id": sess, "item_ids": item_ids, "items": items})
     return sellers
 
 
@@ -62,39 +73,95 @@ def setup_buyers(buyer_client: RpcClient, n: int) -> List[Dict[str, Any]]:
         login = buyer_client.call("Login", {"username": username, "password": password}, role="buyer")
         if not login.get("ok"):
             raise RuntimeError(f"Buyer login failed: {login}")
-        buyers.append({"buyer_id": login["data"]["buyer_id"], "session_id": login["data"]["session_id"]})
+        buyers.append({"buyer_id": login["data"]["buyer_id"], "username": username, "session_id": login["data"]["session_id"]})
     return buyers
 
 
-def seller_1000_ops(client: RpcClient, session_id: str, item_ids: List[Dict[str, int]]) -> None:
-    # 250 * 4 = 1000 ops
-    if not item_ids:
-        # still do rating + display
-        for _ in range(500):
-            client.call("GetSellerRating", {}, session_id=session_id, role="seller")
-            client.call("DisplayItemsForSale", {}, session_id=session_id, role="seller")
-        return
-    for t in range(250):
+def seller_ops(client: RpcClient, session_id: str, item_ids: List[Dict[str, int]], rounds: Optional[int] = None) -> Iterator[str]:
+    """
+    The seller op cycle, one call per step (yields the API just called); endless unless
+    rounds is given. Each round is rating, display and two price changes (rating and
+    display only when the seller has no items).
+    """
+    t = 0
+    while rounds is None or t < rounds:
         client.call("GetSellerRating", {}, session_id=session_id, role="seller")
+        yield "GetSellerRating"
         client.call("DisplayItemsForSale", {}, session_id=session_id, role="seller")
-        it1 = item_ids[t % len(item_ids)]
-        it2 = item_ids[(t + 1) % len(item_ids)]
-        price1 = 9.99 if (t % 2 == 0) else 10.99
-        price2 = 10.49 if (t % 2 == 0) else 9.49
-        client.call("ChangeItemPrice", {"item_id": it1, "new_price": price1}, session_id=session_id, role="seller")
-        client.call("ChangeItemPrice", {"item_id": it2, "new_price": price2}, session_id=session_id, role="seller")
+        yield "DisplayItemsForSale"
+        if item_ids:
+            it1 = item_ids[t % len(item_ids)]
+            it2 = item_ids[(t + 1) % len(item_ids)]
+            price1 = 9.99 if (t % 2 == 0) else 10.99
+            price2 = 10.49 if (t % 2 == 0) else 9.49
+            client.call("ChangeItemPrice", {"item_id": it1, "new_price": price1}, session_id=session_id, role="seller")
+            yield "ChangeItemPrice"
+            client.call("ChangeItemPrice", {"item_id": it2, "new_price": price2}, session_id=session_id, role="seller")
+            yield "ChangeItemPrice"
+        t += 1
 
 
-def buyer_1000_ops(client: RpcClient, session_id: str, category: int = 1, pick_index: int = 0) -> None:
-    # 200 * 5 = 1000 ops
-    for t in range(200):
-        sr = client.call("SearchItemsForSale", {"item_category": category, "keywords": ["common"]}, session_id=session_id, role="buyer")
+def buyer_ops(
+    client: RpcClient,
+    session_id: str,
+    category: int = 1,
+    pick_index: int = 0,
+    conditional: bool = True,
+    rounds: Optional[int] = None,
+) -> Iterator[str]:
+    """
+    The buyer op cycle, one call per step (yields the API just called); endless unless
+    rounds is given. Each round searches, then gets, adds, removes and rates one item of
+    the results (a round ends after the search when it finds nothing).
+    conditional: revalidate searches and items by etag instead of re-fetching them.
+    """
+    cache = ConditionalCache() if conditional else None
+    t = 0
+    while rounds is None or t < rounds:
+        t += 1
+        if cache is not None:
+            sr = cache.call(client, "SearchItemsForSale", {"item_category": category, "keywords": ["common"]}, session_id=session_id, role="buyer")
+        else:
+            sr = client.call("SearchItemsForSale", {"item_category": category, "keywords": ["common"]}, session_id=session_id, role="buyer")
+        yield "SearchItemsForSale"
         if not sr.get("ok") or not sr["data"]["items"]:
             continue
         items = sr["data"]["items"]
         it = items[pick_index % len(items)]["item_id"]
-        client.call("GetItem", {"item_id": it}, session_id=session_id, role="buyer")
+        if cache is not None:
+            cache.call(client, "GetItem", {"item_id": it}, session_id=session_id, role="buyer")
+        else:
+            client.call("GetItem", {"item_id": it}, session_id=session_id, role="buyer")
+        yield "GetItem"
         client.call("AddItemToCart", {"item_id": it, "quantity": 1}, session_id=session_id, role="buyer")
+        yield "AddItemToCart"
         client.call("RemoveItemFromCart", {"item_id": it, "quantity": 1}, session_id=session_id, role="buyer")
-        vote = "up" if (t % 2 == 0) else "down"
+        yield "RemoveItemFromCart"
+        # t was advanced at the top of the round
+        vote = "up" if (t % 2 == 1) else "down"
         client.call("ProvideFeedback", {"item_id": it, "vote": vote}, session_id=session_id, role="buyer")
+        yield "ProvideFeedback"
+
+
+def seller_1000_ops(client: RpcClient, session_id: str, item_ids: List[Dict[str, int]], recorder: Optional[Recorder] = None) -> None:
+    # 250 * 4 = 1000 ops (500 * 2 without items)
+    if recorder is not None:
+        client = recorder.wrap(client)
+    for _ in seller_ops(client, session_id, item_ids, rounds=250 if item_ids else 500):
+        pass
+
+
+def buyer_1000_ops(
+    client: RpcClient,
+    session_id: str,
+    category: int = 1,
+    pick_index: int = 0,
+    conditional: bool = True,
+    recorder: Optional[Recorder] = None,
+) -> None:
+    # 200 * 5 = 1000 ops
+    # recorder: gets every call's latency and error code (revalidations count as calls)
+    if recorder is not None:
+        client = recorder.wrap(client)
+    for _ in buyer_ops(client, session_id, category, pick_index, conditional, rounds=200):
+        pass
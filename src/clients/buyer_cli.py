@@ -4,7 +4,8 @@ import argparse
 import json
 
 from ..common.config import load_config, get_endpoint, get_nested_endpoint
-from ..common.protocol import RpcClient
+from ..common.protocol import RpcClient, RetryPolicy, configure_compression
+from .cache import ConditionalCache
 
 
 HELP = """
@@ -14,6 +15,7 @@ Buyer CLI commands:
   login <username> <password>
   logout
   search <category> [kw1 ... kw5]
+  search_stream <category> [kw1 ... kw5]   (prints items as they arrive; for very large results)
   get_item <category:id>
   add_to_cart <category:id> <qty>
   remove_from_cart <category:id> <qty>
@@ -37,8 +39,11 @@ def main() -> None:
     ap.add_argument("--config", required=True)
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
     bf = get_endpoint(cfg.buyer_frontend)
-    client = RpcClient(bf.host, bf.port, timeout_s=10.0)
+    client = RpcClient(bf.host, bf.port, timeout_s=10.0, retry=RetryPolicy.from_config(cfg.rpc_retry))
+    # local copies of search/item/cart replies, revalidated by etag
+    cache = ConditionalCache()
 
     session_id = None
 
@@ -83,13 +88,24 @@ def main() -> None:
             if cmd == "search":
                 category = int(parts[1])
                 kws = parts[2:][:5]
-                resp = client.call("SearchItemsForSale", {"item_category": category, "keywords": kws}, session_id=session_id, role="buyer")
+                resp = cache.call(client, "SearchItemsForSale", {"item_category": category, "keywords": kws}, session_id=session_id, role="buyer")
                 print(json.dumps(resp, indent=2))
                 continue
 
+            if cmd == "search_stream":
+                category = int(parts[1])
+                kws = parts[2:][:5]
+                for frame in client.call_stream("SearchItemsForSale", {"item_category": category, "keywords": kws}, session_id=session_id, role="buyer"):
+                    if frame.get("more"):
+                        for item in frame["data"]["items"]:
+                            print(json.dumps(item))
+                    else:
+                        print(json.dumps(frame, indent=2))
+                continue
+
             if cmd == "get_item":
                 item_id = parse_item_id(parts[1])
-                resp = client.call("GetItem", {"item_id": item_id}, session_id=session_id, role="buyer")
+                resp = cache.call(client, "GetItem", {"item_id": item_id}, session_id=session_id, role="buyer")
                 print(json.dumps(resp, indent=2))
                 continue
 
@@ -118,7 +134,7 @@ def main() -> None:
                 continue
 
             if cmd == "display_cart":
-                resp = client.call("DisplayCart", {}, session_id=session_id, role="buyer")
+                resp = cache.call(client, "DisplayCart", {}, session_id=session_id, role="buyer")
                 print(json.dumps(resp, indent=2))
                 continue
 
@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+class ConditionalCache:
+    """
+    Client-side copies of GetItem / SearchItemsForSale / DisplayCart replies.
+
+    Repeated calls send the cached etag as if_none_match; when the server answers
+    not_modified, the cached reply is returned instead, so only a few bytes cross the wire.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = int(max_entries)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def call(self, client, api: str, payload: Dict[str, Any], session_id: Optional[str] = None, role: Optional[str] = None) -> Dict[str, Any]:
+        # carts are per session, so the session is part of the key
+        key = json.dumps([api, session_id, payload], sort_keys=True, separators=(",", ":"))
+        cached = self._entries.get(key)
+        p = dict(payload)
+        if cached is not None:
+            p["if_none_match"] = cached["data"]["etag"]
+        resp = client.call(api, p, session_id=session_id, role=role)
+        data = resp.get("data") if resp.get("ok") else None
+        if not isinstance(data, dict):
+            return resp
+        if data.get("not_modified") and cached is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return cached
+        self.misses += 1
+        if "etag" in data:
+            self._entries[key] = resp
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return resp
@@ -4,7 +4,7 @@ import argparse
 import json
 
 from ..common.config import load_config, get_endpoint
-from ..common.protocol import RpcClient
+from ..common.protocol import RpcClient, RetryPolicy, configure_compression
 
 
 HELP = """
@@ -18,6 +18,7 @@ Seller CLI commands:
   change_price <category:id> <new_price>
   update_units <category:id> <remove_qty>
   display_items
+  display_items_stream      (prints listings as they arrive; for very large inventories)
   exit
 """
 
@@ -32,8 +33,9 @@ def main() -> None:
     ap.add_argument("--config", required=True)
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
     sf = get_endpoint(cfg.seller_frontend)
-    client = RpcClient(sf.host, sf.port, timeout_s=10.0)
+    client = RpcClient(sf.host, sf.port, timeout_s=10.0, retry=RetryPolicy.from_config(cfg.rpc_retry))
 
     session_id = None
 
@@ -115,6 +117,15 @@ def main() -> None:
                 print(json.dumps(resp, indent=2))
                 continue
 
+            if cmd == "display_items_stream":
+                for frame in client.call_stream("DisplayItemsForSale", {}, session_id=session_id, role="seller"):
+                    if frame.get("more"):
+                        for item in frame["data"]["items"]:
+                            print(json.dumps(item))
+                    else:
+                        print(json.dumps(frame, indent=2))
+                continue
+
             print("Unknown command. Type 'help'.")
         except Exception as e:
             print(f"Error: {e}")
@@ -7,8 +7,12 @@ import yaml
 
 @dataclass(frozen=True)
 class Endpoint:
-    host: str
-    port: int
+    host: str  # hostname/IP, or "unix:///path/to.sock" for a colocated service
+    port: int  # ignored (0) for unix endpoints
+
+    @property
+    def is_unix(self) -> bool:
+        return self.host.startswith("unix://")
 
 
 @dataclass(frozen=True)
@@ -18,6 +22,16 @@ class AppConfig:
     product_db: Dict[str, Any]
     buyer_frontend: Dict[str, Any]
     seller_frontend: Dict[str, Any]
+    # optional ProductDB shard map; see common/sharding.py
+    product_db_shards: Optional[Dict[str, Any]] = None
+    # optional client retry policy; see RetryPolicy.from_config in common/protocol.py
+    rpc_retry: Optional[Dict[str, Any]] = None
+    # optional shared secret for frontend-signed user identities; see common/identity.py
+    internal_auth: Optional[Dict[str, Any]] = None
+    # optional frame compression; see configure_compression in common/protocol.py
+    compression: Optional[Dict[str, Any]] = None
+    # optional request tracing; see configure_tracing in common/tracing.py
+    tracing: Optional[Dict[str, Any]] = None
 
 
 def load_config(path: str) -> AppConfig:
@@ -29,11 +43,21 @@ def load_config(path: str) -> AppConfig:
         product_db=dict(raw["product_db"]),
         buyer_frontend=dict(raw["buyer_frontend"]),
         seller_frontend=dict(raw["seller_frontend"]),
+        product_db_shards=dict(raw["product_db_shards"]) if raw.get("product_db_shards") else None,
+        rpc_retry=dict(raw["rpc_retry"]) if raw.get("rpc_retry") else None,
+        internal_auth=dict(raw["internal_auth"]) if raw.get("internal_auth") else None,
+        compression=dict(raw["compression"]) if raw.get("compression") else None,
+        tracing=dict(raw["tracing"]) if raw.get("tracing") else None,
     )
 
 
 def get_endpoint(obj: Dict[str, Any]) -> Endpoint:
-    return Endpoint(host=str(obj["host"]), port=int(obj["port"]))
+    host = str(obj["host"])
+    if host.startswith("unix://"):
+        if len(host) <= len("unix://"):
+            raise ValueError(f"unix endpoint without a path: {host!r}")
+        return Endpoint(host=host, port=int(obj.get("port", 0)))
+    return Endpoint(host=host, port=int(obj["port"]))
 
 
 def get_nested_endpoint(obj: Dict[str, Any], key: str) -> Endpoint:
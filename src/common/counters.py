@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+
+
+class CounterAggregator(Generic[K]):
+    """
+    Accumulates thumbs up/down deltas in memory and hands them to the owning store in batches.
+
+    The store applies a batch to its in-memory objects and persists once, so a burst of votes
+    costs one snapshot write per flush instead of one per vote. Reads must add pending() on top
+    of the stored counters to see every accepted vote.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pending: Dict[K, list] = {}
+        self.votes_accepted = 0
+        self.flushes = 0
+
+    def add(self, key: K, vote: str, base: Optional[Callable[[], Tuple[int, int]]] = None) -> Tuple[int, int]:
+        """
+        Records one vote. Returns (up, down) for key: pending only, or base() + pending when
+        base is given. base() runs under the aggregator lock so a concurrent flush cannot be
+        counted twice.
+        """
+        with self._lock:
+            d = self._pending.get(key)
+            if d is None:
+                d = [0, 0]
+                self._pending[key] = d
+            if vote == "up":
+                d[0] += 1
+            else:
+                d[1] += 1
+            self.votes_accepted += 1
+            if base is None:
+                return d[0], d[1]
+            up, down = base()
+            return up + d[0], down + d[1]
+
+    def pending(self, key: K) -> Tuple[int, int]:
+        with self._lock:
+            d = self._pending.get(key)
+            if d is None:
+                return 0, 0
+            return d[0], d[1]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, apply: Callable[[Dict[K, Tuple[int, int]]], None]) -> int:
+        """
+        Swaps out the pending batch and calls apply(batch) while still holding the aggregator
+        lock, so readers never observe a delta both pending and applied (or neither).
+        apply should only touch memory; persist after flush() returns.
+        Returns the number of keys flushed.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            batch = {k: (v[0], v[1]) for k, v in self._pending.items()}
+            self._pending = {}
+            apply(batch)
+            self.flushes += 1
+            return len(batch)
+
+    def start_flusher(self, flush_fn: Callable[[], int], interval_s: float) -> threading.Thread:
+        """Calls flush_fn every interval_s in a daemon thread; flushing at exit is up to the caller."""
+        def loop() -> None:
+            while True:
+                time.sleep(interval_s)
+                try:
+                    flush_fn()
+                except Exception:
+                    pass
+
+        t = threading.Thread(target=loop, name="feedback-flusher", daemon=True)
+        t.start()
+        return t
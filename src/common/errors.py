@@ -25,3 +25,5 @@ NOT_FOUND = "NOT_FOUND"
 CONFLICT = "CONFLICT"
 FORBIDDEN = "FORBIDDEN"
 INTERNAL = "INTERNAL"
+UNAVAILABLE = "UNAVAILABLE"
+DEADLINE_EXCEEDED = "DEADLINE_EXCEEDED"
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional
+
+from .protocol import DeadlineExceeded, current_deadline, deadline_scope
+from .time_utils import monotonic_s, now_s
+from .tracing import current_span_id, current_trace, trace_scope
+
+
+class _Window:
+    """Recent latencies of one API; the percentile is recomputed every few samples."""
+
+    def __init__(self, size: int):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.since_sort = 0
+        self.cached: Optional[float] = None
+
+    def add(self, latency_s: float) -> None:
+        self.samples.append(latency_s)
+        self.since_sort += 1
+
+    def percentile(self, pct: float) -> float:
+        if self.cached is None or self.since_sort >= 50:
+            ordered = sorted(self.samples)
+            self.cached = ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+            self.since_sort = 0
+        return self.cached
+
+
+class Hedger:
+    """
+    Hedged requests for idempotent reads.
+
+    The first attempt runs on a worker thread. If it has not answered within the API's
+    recent p<percentile> latency, a second attempt is sent (callers point it at another
+    replica or connection) and whichever reply arrives first is returned. The slower one
+    finishes in the background and is dropped. Hedges are capped at max_hedge_ratio of all
+    calls so a slow backend does not receive double load, and no hedging happens until
+    min_samples latencies have been seen for the API.
+    """
+
+    def __init__(
+        self,
+        percentile: float = 95.0,
+        min_delay_s: float = 0.002,
+        max_delay_s: float = 1.0,
+        window: int = 1000,
+        min_samples: int = 100,
+        max_hedge_ratio: float = 0.1,
+        workers: int = 64,
+    ):
+        self.percentile = float(percentile)
+        self.min_delay_s = float(min_delay_s)
+        self.max_delay_s = float(max_delay_s)
+        self.window = int(window)
+        self.min_samples = int(min_samples)
+        self.max_hedge_ratio = float(max_hedge_ratio)
+        self._pool = ThreadPoolExecutor(max_workers=int(workers), thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self._windows: Dict[str, _Window] = {}
+        self.calls = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_skipped = 0  # over the hedge budget
+
+    @classmethod
+    def from_config(cls, section: Dict[str, Any]) -> Optional["Hedger"]:
+        """Reads the hedge_* keys of a frontend section; None when hedging is disabled."""
+        if not bool(section.get("hedge_enabled", True)):
+            return None
+        return cls(
+            percentile=float(section.get("hedge_percentile", 95)),
+            min_delay_s=float(section.get("hedge_min_delay_ms", 2)) / 1000.0,
+            max_delay_s=float(section.get("hedge_max_delay_ms", 1000)) / 1000.0,
+            max_hedge_ratio=float(section.get("hedge_max_ratio", 0.1)),
+            workers=int(section.get("hedge_workers", 64)),
+        )
+
+    def _record(self, api: str, latency_s: float) -> None:
+        with self._lock:
+            w = self._windows.get(api)
+            if w is None:
+                w = self._windows[api] = _Window(self.window)
+            w.add(latency_s)
+
+    def hedge_delay(self, api: str) -> Optional[float]:
+        with self._lock:
+            w = self._windows.get(api)
+            if w is None or len(w.samples) < self.min_samples:
+                return None
+            return min(self.max_delay_s, max(self.min_delay_s, w.percentile(self.percentile)))
+
+    def _submit(self, api: str, fn: Callable[[], Dict[str, Any]]) -> "Future[Dict[str, Any]]":
+        deadline = current_deadline()
+        trace, parent = current_trace(), current_span_id()
+
+        def run() -> Dict[str, Any]:
+            t0 = monotonic_s()
+            # worker threads don't see the handler's request context; carry the deadline
+            # and trace over
+            with deadline_scope(deadline), trace_scope(trace, parent):
+                resp = fn()
+            self._record(api, monotonic_s() - t0)
+            return resp
+
+        return self._pool.submit(run)
+
+    def call(self, api: str, first: Callable[[], Dict[str, Any]], second: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        delay = self.hedge_delay(api)
+        with self._lock:
+            self.calls += 1
+        if delay is None:
+            # still learning this API's latency
+            t0 = monotonic_s()
+            resp = first()
+            self._record(api, monotonic_s() - t0)
+            return resp
+
+        deadline = current_deadline()
+        f1 = self._submit(api, first)
+        done, _ = wait([f1], timeout=delay)
+        if not done:
+            with self._lock:
+                over_budget = self.hedges_fired >= self.max_hedge_ratio * self.calls
+                if over_budget:
+                    self.hedges_skipped += 1
+                else:
+                    self.hedges_fired += 1
+            pending = {f1}
+            if not over_budget:
+                f2 = self._submit(api, second)
+                pending.add(f2)
+            error: Optional[BaseException] = None
+            while pending:
+                timeout = None if deadline is None else max(0.0, deadline - now_s())
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded(f"no reply to {api} before the deadline")
+                for f in done:
+                    if f.exception() is None:
+                        if f is not f1:
+                            with self._lock:
+                                self.hedges_won += 1
+                        return f.result()
+                    error = error or f.exception()
+            assert error is not None
+            raise error
+        return f1.result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            delays = {}
+            for api, w in self._windows.items():
+                if len(w.samples) >= self.min_samples:
+                    delays[api] = round(min(self.max_delay_s, max(self.min_delay_s, w.percentile(self.percentile))) * 1000, 3)
+            return {
+                "calls": self.calls,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+                "hedges_skipped": self.hedges_skipped,
+                "hedge_rate": (self.hedges_fired / self.calls) if self.calls else 0.0,
+                "win_rate": (self.hedges_won / self.hedges_fired) if self.hedges_fired else 0.0,
+                "hedge_delay_ms": delays,
+            }
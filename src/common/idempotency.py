@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from .errors import Err, CONFLICT, DEADLINE_EXCEEDED, UNAVAILABLE
+from .protocol import make_err
+from .time_utils import monotonic_s, now_s
+
+
+# replies that mean "nothing was done, try again": never replayed from the cache
+_TRANSIENT = (DEADLINE_EXCEEDED, UNAVAILABLE)
+
+
+class IdempotencyCache:
+    """
+    Per-server memory of replies to mutating requests, keyed by (api, idempotency_key).
+
+    A retried request gets the stored reply instead of being applied a second time; a
+    replay that arrives while the original is still running waits for it. Only the APIs
+    listed in apis are tracked (reads are safe to repeat). Bounded by max_entries, oldest
+    first, and entries are forgotten after ttl_s. A key reused for a different request
+    (other payload or session) gets CONFLICT instead of the stored reply.
+    """
+
+    def __init__(self, apis: Iterable[str], max_entries: int = 10_000, ttl_s: float = 300.0):
+        self.apis = frozenset(apis)
+        self.max_entries = int(max_entries)
+        self.ttl_s = float(ttl_s)
+        self._lock = threading.Lock()
+        # insertion order == completion order, so expiry pops from the front
+        self._done: "OrderedDict[Tuple[str, str], Tuple[float, str, Dict[str, Any]]]" = OrderedDict()
+        self._running: Dict[Tuple[str, str], threading.Event] = {}
+        self.replays = 0
+        self.waited = 0
+        self.conflicts = 0
+
+    @classmethod
+    def from_config(cls, apis: Iterable[str], section: Dict[str, Any]) -> "IdempotencyCache":
+        """Reads idempotency_cache_entries / idempotency_ttl_seconds from a service section."""
+        return cls(
+            apis,
+            max_entries=int(section.get("idempotency_cache_entries", 10_000)),
+            ttl_s=float(section.get("idempotency_ttl_seconds", 300)),
+        )
+
+    def _expire(self, now: float) -> None:
+        while self._done:
+            k, (expires_at, _, _) = next(iter(self._done.items()))
+            if expires_at > now and len(self._done) <= self.max_entries:
+                return
+            del self._done[k]
+
+    def run(self, req: Dict[str, Any], fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        api = req.get("api")
+        key = req.get("idempotency_key")
+        if api not in self.apis or not isinstance(key, str):
+            return fn()
+        k = (str(api), key)
+        digest = _fingerprint(req)
+
+        while True:
+            with self._lock:
+                self._expire(monotonic_s())
+                hit = self._done.get(k)
+                if hit is not None:
+                    if hit[1] != digest:
+                        self.conflicts += 1
+                        return make_err(
+                            str(req.get("request_id", "req")),
+                            Err(CONFLICT, f"idempotency_key already used for a different {api} request"),
+                        )
+                    self.replays += 1
+                    return hit[2]
+                ev = self._running.get(k)
+                if ev is None:
+                    ev = threading.Event()
+                    self._running[k] = ev
+                    break
+                self.waited += 1
+            if not ev.wait(self._wait_s(req)):
+                return make_err(str(req.get("request_id", "req")), Err(DEADLINE_EXCEEDED, "Deadline passed waiting for the original request."))
+            # the original finished: loop to pick up its reply (or run it ourselves if the
+            # original failed transiently and was not stored)
+
+        resp: Optional[Dict[str, Any]] = None
+        try:
+            resp = fn()
+            return resp
+        finally:
+            with self._lock:
+                del self._running[k]
+                if isinstance(resp, dict) and (resp.get("error") or {}).get("code") not in _TRANSIENT:
+                    self._done[k] = (monotonic_s() + self.ttl_s, digest, resp)
+                    self._expire(monotonic_s())
+            ev.set()
+
+    @staticmethod
+    def _wait_s(req: Dict[str, Any]) -> Optional[float]:
+        deadline = req.get("deadline")
+        if not isinstance(deadline, (int, float)):
+            return None
+        return max(0.0, float(deadline) - now_s())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": len(self._done),
+                "in_flight": len(self._running),
+                "replays": self.replays,
+                "waited_for_original": self.waited,
+                "key_conflicts": self.conflicts,
+            }
+
+
+def _fingerprint(req: Dict[str, Any]) -> str:
+    """What makes a retry the same request: its payload (bar the per-hop request_id), session and caller."""
+    payload = req.get("payload")
+    if isinstance(payload, dict):
+        payload = {k: v for k, v in payload.items() if k != "request_id"}
+    ident = req.get("identity")
+    who = [ident.get("user_type"), ident.get("user_id")] if isinstance(ident, dict) else None
+    raw = json.dumps([payload, req.get("session_id"), who], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
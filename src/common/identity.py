@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from .config import AppConfig
+from .time_utils import now_s
+
+# a secret shorter than this, or still the sample's placeholder, is refused at startup
+MIN_SECRET_LENGTH = 16
+_PLACEHOLDER_MARKERS = ("change-me", "changeme")
+
+
+class ServiceIdentity:
+    """
+    Lets a frontend vouch for a user whose session it has just validated, so CustomerDB and
+    ProductDB can act for that user without a second ValidateAndTouchSession.
+
+    The identity travels in the request envelope as
+    {"user_type", "user_id", "issued_at", "sig"}, where sig is an HMAC-SHA256 over the other
+    fields keyed with a secret shared by all services. Backends only accept identities
+    younger than max_age_s.
+    """
+
+    def __init__(self, secret: str, max_age_s: float = 60.0):
+        if not secret:
+            raise ValueError("internal_auth.secret must not be empty")
+        self._key = secret.encode("utf-8")
+        self.max_age_s = float(max_age_s)
+
+    @classmethod
+    def from_config(cls, cfg: AppConfig) -> Optional["ServiceIdentity"]:
+        """
+        None when internal_auth is not configured: frontends then forward session ids.
+        The secret comes from the environment variable named by internal_auth.secret_env, the
+        file at internal_auth.secret_file, or internal_auth.secret itself. Raises ValueError
+        (the service refuses to start) for a missing, short or placeholder secret.
+        """
+        raw = cfg.internal_auth or {}
+        if not any(raw.get(k) for k in ("secret", "secret_env", "secret_file")):
+            return None
+        return cls(_load_secret(raw), max_age_s=float(raw.get("max_age_seconds", 60)))
+
+    def _sign(self, user_type: str, user_id: int, issued_at: float) -> str:
+        msg = f"{user_type}|{user_id}|{issued_at:.6f}".encode("utf-8")
+        return hmac.new(self._key, msg, hashlib.sha256).hexdigest()
+
+    def issue(self, user_type: str, user_id: int) -> Dict[str, Any]:
+        issued_at = round(now_s(), 6)
+        return {"user_type": user_type, "user_id": int(user_id), "issued_at": issued_at, "sig": self._sign(user_type, int(user_id), issued_at)}
+
+    def verify(self, ident: Any) -> Tuple[str, int]:
+        """Returns (user_type, user_id); raises ValueError for a forged, stale or malformed identity."""
+        if not isinstance(ident, dict):
+            raise ValueError("identity must be an object")
+        try:
+            user_type = str(ident["user_type"])
+            user_id = int(ident["user_id"])
+            issued_at = float(ident["issued_at"])
+            sig = str(ident["sig"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("malformed identity")
+        if not hmac.compare_digest(sig, self._sign(user_type, user_id, issued_at)):
+            raise ValueError("bad identity signature")
+        if abs(now_s() - issued_at) > self.max_age_s:
+            raise ValueError("identity expired")
+        return user_type, user_id
+
+
+def _load_secret(raw: Dict[str, Any]) -> str:
+    if raw.get("secret_env"):
+        name = str(raw["secret_env"])
+        secret = os.environ.get(name, "")
+        source = f"environment variable {name}"
+    elif raw.get("secret_file"):
+        path = str(raw["secret_file"])
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                secret = f.read().strip()
+        except OSError as e:
+            raise ValueError(f"internal_auth.secret_file: {e}")
+        source = path
+    else:
+        secret = str(raw["secret"])
+        source = "internal_auth.secret"
+    if not secret:
+        raise ValueError(f"internal_auth: no secret in {source}")
+    if any(m in secret.lower() for m in _PLACEHOLDER_MARKERS):
+        raise ValueError(f"internal_auth: the secret in {source} is a placeholder; set a long random one per deployment")
+    if len(secret) < MIN_SECRET_LENGTH:
+        raise ValueError(f"internal_auth: the secret in {source} is shorter than {MIN_SECRET_LENGTH} characters")
+    return secret
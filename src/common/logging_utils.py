@@ -1,10 +1,31 @@
 from __future__ import annotations
 
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
 
-def setup_logging(name: str) -> logging.Logger:
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the logging thread: records are dropped (and counted) when the queue is full."""
+
+    def __init__(self, q: "queue.Queue[logging.LogRecord]"):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(name: str, max_queued: int = 10_000) -> logging.Logger:
+    """
+    Logger writing to stdout from a background thread: request threads only put records
+    on a bounded queue, so a slow terminal or pipe cannot stall them.
+    """
     logger = logging.getLogger(name)
     if logger.handlers:
         return logger
@@ -15,6 +36,11 @@ def setup_logging(name: str) -> logging.Logger:
         datefmt="%Y-%m-%d %H:%M:%S",
     )
     h.setFormatter(fmt)
-    logger.addHandler(h)
+    q: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=max_queued)
+    listener = logging.handlers.QueueListener(q, h)
+    listener.start()
+    # registered before anything that logs at exit, so it stops (and drains) last
+    atexit.register(listener.stop)
+    logger.addHandler(_DroppingQueueHandler(q))
     logger.propagate = False
     return logger
@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import linecache
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .protocol import current_deadline
+from .time_utils import now_s
+
+MAX_PROFILE_SECONDS = 300.0
+
+# top frames of threads parked on I/O or a condition; a "sample" profile skips them (and
+# threads sitting in time.sleep) unless asked to include idle threads
+_IDLE_FRAMES = {
+    ("protocol.py", "_recv_exact"),
+    ("socket.py", "accept"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    # ThreadPoolExecutor worker waiting for work (the hedging pool): SimpleQueue.get is C code
+    ("thread.py", "_worker"),
+}
+
+
+@dataclass
+class _Profiling:
+    service: str = "unknown"
+    enabled: bool = False
+    reports_dir: str = "reports"
+
+
+_profiling = _Profiling()
+_busy = threading.Lock()  # one profile at a time per process
+
+
+def configure_profiling(service: str, section: Dict[str, Any]) -> None:
+    """Reads profile_api_enabled / profile_reports_dir from a service section."""
+    _profiling.service = service
+    _profiling.enabled = bool(section.get("profile_api_enabled", False))
+    _profiling.reports_dir = str(section.get("profile_reports_dir", "reports"))
+
+
+def profiling_allowed() -> bool:
+    return _profiling.enabled
+
+
+def _is_idle(frame: Any) -> bool:
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+        return True
+    return "sleep(" in linecache.getline(code.co_filename, frame.f_lineno)
+
+
+def _func(code: Any) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _report_path(mode: str, ext: str) -> str:
+    os.makedirs(_profiling.reports_dir, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now_s()))
+    return os.path.join(_profiling.reports_dir, f"profile-{_profiling.service}-{mode}-{stamp}.{ext}")
+
+
+def _sample(seconds: float, interval_s: float, include_idle: bool, top_n: int) -> Dict[str, Any]:
+    """Wall-clock sampling of every other thread's Python stack via sys._current_frames()."""
+    me = threading.get_ident()
+    self_counts: Counter = Counter()
+    cum_counts: Counter = Counter()
+    stacks: Counter = Counter()
+    samples = busy = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            samples += 1
+            if not include_idle and _is_idle(frame):
+                continue
+            busy += 1
+            funcs: List[str] = []
+            f: Any = frame
+            while f is not None:
+                funcs.append(_func(f.f_code))
+                f = f.f_back
+            self_counts[funcs[0]] += 1
+            cum_counts.update(set(funcs))
+            stacks[";".join(reversed(funcs))] += 1
+        time.sleep(interval_s)
+
+    def top(counts: Counter) -> List[Dict[str, Any]]:
+        return [{"func": fn, "samples": n, "pct": round(100.0 * n / max(busy, 1), 1)} for fn, n in counts.most_common(top_n)]
+
+    summary = {"samples": samples, "busy_samples": busy, "top_self": top(self_counts), "top_cumulative": top(cum_counts)}
+    txt = _report_path("sample", "txt")
+    with open(txt, "w", encoding="utf-8") as f:
+        f.write(f"{_profiling.service}: {seconds:.1f}s, one sample every {interval_s * 1000:.1f}ms, {busy}/{samples} thread samples busy\n\n")
+        for title, key in (("self", "top_self"), ("cumulative", "top_cumulative")):
+            f.write(f"top {title}:\n")
+            for row in summary[key]:
+                f.write(f"  {row['samples']:8d} {row['pct']:5.1f}%  {row['func']}\n")
+            f.write("\n")
+    # collapsed stacks, the input format of flamegraph.pl / speedscope
+    folded = _report_path("sample", "folded")
+    with open(folded, "w", encoding="utf-8") as f:
+        for stack, n in stacks.most_common():
+            f.write(f"{stack} {n}\n")
+    summary["files"] = [txt, folded]
+    return summary
+
+
+class _CProfileSession:
+    """cProfile only sees the thread that enabled it: each request thread gets its own Profile (see profiled())."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._profiles: Dict[int, cProfile.Profile] = {}
+        self._running: set = set()  # threads inside a profiled request
+        self.requests = 0
+        self.skipped = 0
+
+    def enter(self) -> Optional[cProfile.Profile]:
+        tid = threading.get_ident()
+        with self._lock:
+            prof = self._profiles.get(tid)
+            if prof is None:
+                prof = self._profiles[tid] = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12+ allows only one active cProfile per process
+            with self._lock:
+                self.skipped += 1
+            return None
+        with self._lock:
+            self._running.add(tid)
+            self.requests += 1
+        return prof
+
+    def leave(self, prof: cProfile.Profile) -> None:
+        prof.disable()
+        with self._lock:
+            self._running.discard(threading.get_ident())
+
+    def finish(self, wait_s: float = 1.0) -> Tuple[List[cProfile.Profile], int]:
+        """
+        Profiles of the threads whose requests have finished. A profiler can only be
+        stopped by its own thread, so threads still inside a request after wait_s are left out.
+        """
+        end = time.monotonic() + wait_s
+        while time.monotonic() < end:
+            with self._lock:
+                if not self._running:
+                    break
+            time.sleep(0.01)
+        with self._lock:
+            return [p for tid, p in self._profiles.items() if tid not in self._running], len(self._running)
+
+
+_cprofile: Optional[_CProfileSession] = None
+
+
+@contextmanager
+def profiled() -> Iterator[None]:
+    """Wraps the handling of one request; profiles it while a cprofile session is running."""
+    session = _cprofile
+    if session is None:
+        yield
+        return
+    prof = session.enter()
+    if prof is None:
+        yield
+        return
+    try:
+        yield
+    finally:
+        session.leave(prof)
+
+
+def _cprofile_run(seconds: float, top_n: int) -> Dict[str, Any]:
+    global _cprofile
+    session = _CProfileSession()
+    _cprofile = session
+    try:
+        time.sleep(seconds)
+    finally:
+        _cprofile = None
+    profiles, unfinished = session.finish()
+    summary: Dict[str, Any] = {"requests": session.requests, "skipped": session.skipped, "unfinished": unfinished}
+    stats: Optional[pstats.Stats] = None
+    for prof in profiles:
+        try:
+            if stats is None:
+                stats = pstats.Stats(prof)
+            else:
+                stats.add(prof)
+        except TypeError:
+            continue  # no data collected
+    if stats is None:
+        summary.update({"top_tottime": [], "top_cumtime": [], "files": []})
+        return summary
+
+    def top(sort: str) -> List[Dict[str, Any]]:
+        rows = sorted(stats.stats.items(), key=lambda kv: kv[1][2 if sort == "tottime" else 3], reverse=True)[:top_n]  # type: ignore[union-attr]
+        return [
+            {
+                "func": f"{name} ({os.path.basename(file)}:{line})",
+                "calls": nc,
+                "tottime_ms": round(tt * 1000.0, 3),
+                "cumtime_ms": round(ct * 1000.0, 3),
+            }
+            for (file, line, name), (cc, nc, tt, ct, _) in rows
+        ]
+
+    summary["top_tottime"] = top("tottime")
+    summary["top_cumtime"] = top("cumtime")
+    prof_path = _report_path("cprofile", "prof")
+    stats.dump_stats(prof_path)  # load with pstats / snakeviz
+    txt = _report_path("cprofile", "txt")
+    buf = io.StringIO()
+    pstats.Stats(prof_path, stream=buf).sort_stats("cumulative").print_stats(top_n * 3)
+    with open(txt, "w", encoding="utf-8") as f:
+        f.write(buf.getvalue())
+    summary["files"] = [prof_path, txt]
+    return summary
+
+
+def run_profile(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Profile admin API: profiles this process for payload["seconds"] and returns a top-N
+    summary; the full profile is written under profile_reports_dir.
+
+    mode "sample" (default): samples the Python stack of every thread every interval_ms
+    (wall clock; idle threads skipped unless include_idle). mode "cprofile": deterministic
+    profile of the requests handled during the window (request handling and reply encoding).
+    The run is cut short to finish within the request's deadline.
+    """
+    mode = str(payload.get("mode", "sample"))
+    if mode not in ("sample", "cprofile"):
+        raise ValueError("mode must be 'sample' or 'cprofile'")
+    seconds = min(max(float(payload.get("seconds", 10)), 0.1), MAX_PROFILE_SECONDS)
+    deadline = current_deadline()
+    if deadline is not None:
+        # leave time to write the report and reply
+        seconds = max(0.1, min(seconds, deadline - now_s() - 0.5))
+    top_n = min(max(int(payload.get("top", 20)), 1), 200)
+    if not _busy.acquire(blocking=False):
+        raise ValueError("a profile is already running in this process")
+    try:
+        if mode == "sample":
+            interval_s = min(max(float(payload.get("interval_ms", 5)), 1.0), 1000.0) / 1000.0
+            out = _sample(seconds, interval_s, bool(payload.get("include_idle", False)), top_n)
+        else:
+            out = _cprofile_run(seconds, top_n)
+    finally:
+        _busy.release()
+    return {"service": _profiling.service, "mode": mode, "seconds": round(seconds, 3), **out}
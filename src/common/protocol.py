@@ -1,16 +1,231 @@
 from __future__ import annotations
 
 import json
+import os
+import random
+import stat
 import socket
 import struct
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, Tuple
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from .errors import Err, INTERNAL, BAD_REQUEST
+from .errors import Err, INTERNAL, BAD_REQUEST, DEADLINE_EXCEEDED, UNAVAILABLE
+from .time_utils import now_s
+from .tracing import Trace, absorb, current_trace_id, outgoing_context, reply_frame, span
 
 
 MAX_MSG_BYTES = 8 * 1024 * 1024  # 8MB safety cap
 
+# Frame header: 4-byte big-endian length. Lengths never reach 2**31, so the top bit marks
+# a zlib-compressed body; MAX_MSG_BYTES applies to the decompressed JSON.
+COMPRESSED_FLAG = 0x80000000
+ACCEPT_ENCODING = "zlib"
+
+
+@dataclass
+class _Compression:
+    enabled: bool = False
+    threshold_bytes: int = 16 * 1024
+    level: int = 1
+
+
+_compression = _Compression()
+_compression_lock = threading.Lock()
+_compression_stats = {"frames_sent": 0, "frames_compressed": 0, "bytes_raw": 0, "bytes_sent": 0, "frames_received_compressed": 0}
+
+
+def configure_compression(raw: Optional[Dict[str, Any]]) -> None:
+    """
+    Applies the optional top-level compression config section for this process. When
+    enabled, requests announce accept_encoding and replies (and requests) at or above
+    threshold_bytes are sent zlib-compressed; receiving compressed frames always works.
+    """
+    raw = raw or {}
+    _compression.enabled = bool(raw.get("enabled", False))
+    _compression.threshold_bytes = int(raw.get("threshold_bytes", 16 * 1024))
+    _compression.level = int(raw.get("level", 1))
+
+
+def accepts_compression(req: Dict[str, Any]) -> bool:
+    """True when the peer that sent req can read compressed replies."""
+    return req.get("accept_encoding") == ACCEPT_ENCODING
+
+
+def compression_stats() -> Dict[str, Any]:
+    with _compression_lock:
+        out: Dict[str, Any] = dict(_compression_stats)
+    out["enabled"] = _compression.enabled
+    out["threshold_bytes"] = _compression.threshold_bytes
+    out["bytes_saved"] = out["bytes_raw"] - out["bytes_sent"]
+    out["ratio"] = (out["bytes_sent"] / out["bytes_raw"]) if out["bytes_raw"] else 1.0
+    return out
+
+# Per-thread context of the request being handled; safe_handle sets it so that backend
+# calls made while handling a request inherit the caller's deadline and derive their
+# idempotency keys from the caller's.
+_request_ctx = threading.local()
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def current_deadline() -> Optional[float]:
+    return getattr(_request_ctx, "deadline", None)
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]) -> Iterator[None]:
+    """Makes calls on this thread inherit deadline, e.g. on a worker thread of a handler."""
+    prev = current_deadline()
+    _request_ctx.deadline = deadline
+    try:
+        yield
+    finally:
+        _request_ctx.deadline = prev
+
+
+def _call_deadline(timeout_s: float, deadline: Optional[float]) -> float:
+    """
+    Absolute (wall clock) deadline for an outgoing call: our own timeout, capped by the
+    explicit deadline or the one inherited from the request being handled.
+    """
+    d = now_s() + timeout_s
+    inherited = deadline if deadline is not None else current_deadline()
+    if inherited is not None:
+        d = min(d, inherited)
+    return d
+
+
+def _call_key(explicit: Optional[str]) -> str:
+    """
+    Idempotency key for an outgoing call. Calls made while handling a keyed request get
+    "<parent key>.<n>" for the n-th backend call, so re-running a replayed request sends
+    the same keys downstream and backends can recognise the replay too.
+    """
+    if explicit is not None:
+        return explicit
+    parent = getattr(_request_ctx, "idempotency_key", None)
+    if parent is None:
+        return uuid.uuid4().hex
+    _request_ctx.calls += 1
+    return f"{parent}.{_request_ctx.calls}"
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How often a client re-sends a request after a connection error or timeout. Every
+    attempt carries the same idempotency key, so servers apply mutations at most once.
+    Attempts stop early when the call's deadline has passed.
+    """
+
+    attempts: int = 2
+    backoff_s: float = 0.05  # delay before the 2nd attempt, doubled for each further one
+    max_backoff_s: float = 1.0
+    jitter: float = 0.5  # each delay is scaled by a random factor in [1 - jitter, 1]
+
+    @classmethod
+    def from_config(cls, raw: Optional[Dict[str, Any]]) -> "RetryPolicy":
+        """Reads the optional top-level rpc_retry section."""
+        raw = raw or {}
+        return cls(
+            attempts=max(1, int(raw.get("attempts", 2))),
+            backoff_s=float(raw.get("backoff_ms", 50)) / 1000.0,
+            max_backoff_s=float(raw.get("max_backoff_ms", 1000)) / 1000.0,
+            jitter=min(1.0, max(0.0, float(raw.get("jitter", 0.5)))),
+        )
+
+    def delay(self, attempt: int) -> float:
+        """Sleep before attempt number attempt + 1."""
+        d = min(self.max_backoff_s, self.backoff_s * (2 ** (attempt - 1)))
+        return d * (1.0 - self.jitter * random.random())
+
+    def retry_after(self, attempt: int, deadline: float) -> Optional[float]:
+        """Delay before the next attempt, or None when we should give up."""
+        if attempt >= self.attempts:
+            return None
+        d = self.delay(attempt)
+        if now_s() + d >= deadline:
+            return None
+        return d
+
+
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+UNIX_PREFIX = "unix://"
+
+
+def unix_path(host: str) -> Optional[str]:
+    """The socket path of a "unix:///path" host, or None for a TCP host."""
+    if not host.startswith(UNIX_PREFIX):
+        return None
+    path = host[len(UNIX_PREFIX):]
+    if not path:
+        raise ValueError(f"unix endpoint without a path: {host!r}")
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("unix socket endpoints are not supported on this platform")
+    return path
+
+
+def format_addr(host: str, port: int) -> str:
+    return host if unix_path(host) is not None else f"{host}:{port}"
+
+
+def open_connection(host: str, port: int, timeout_s: Optional[float], short_lived: bool = False) -> socket.socket:
+    """
+    Connected socket for host/port, where host may be "unix:///path" for a colocated service.
+    Same framing either way; unix sockets skip the TCP stack entirely.
+    """
+    path = unix_path(host)
+    if path is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        addr: Any = path
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        addr = (host, port)
+        # reduce Windows port pain
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if short_lived:
+            # IMPORTANT: avoid TIME_WAIT explosion on Windows for short-lived connections
+            # (abortive close)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.settimeout(timeout_s)
+        sock.connect(addr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def listen_socket(host: str, port: int, backlog: int = 512) -> socket.socket:
+    """Listening socket for serve(); a "unix:///path" host binds that path instead of a TCP port."""
+    path = unix_path(host)
+    if path is None:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+    else:
+        # a socket file left behind by a previous run would make bind fail
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+    s.listen(backlog)
+    return s
+
 
 def _recv_exact(sock: socket.socket, n: int) -> bytes:
     chunks = []
@@ -24,21 +239,50 @@ def _recv_exact(sock: socket.socket, n: int) -> bytes:
     return b"".join(chunks)
 
 
-def send_json(sock: socket.socket, obj: Dict[str, Any]) -> None:
+def send_json(sock: socket.socket, obj: Dict[str, Any], compress: bool = False) -> int:
+    """compress: the peer understands compressed frames (see accepts_compression). Returns bytes written."""
     data = json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
     if len(data) > MAX_MSG_BYTES:
         raise ValueError("message too large")
-    header = struct.pack("!I", len(data))
+    raw_len = len(data)
+    flag = 0
+    if compress and _compression.enabled and raw_len >= _compression.threshold_bytes:
+        packed = zlib.compress(data, _compression.level)
+        if len(packed) < raw_len:
+            data = packed
+            flag = COMPRESSED_FLAG
+    with _compression_lock:
+        _compression_stats["frames_sent"] += 1
+        _compression_stats["bytes_raw"] += raw_len
+        _compression_stats["bytes_sent"] += len(data)
+        if flag:
+            _compression_stats["frames_compressed"] += 1
+    header = struct.pack("!I", len(data) | flag)
     sock.sendall(header + data)
+    return len(header) + len(data)
 
 
 def recv_json(sock: socket.socket) -> Dict[str, Any]:
+    return recv_json_sized(sock)[0]
+
+
+def recv_json_sized(sock: socket.socket) -> Tuple[Dict[str, Any], int]:
+    """recv_json that also returns the frame's size on the wire (for stats)."""
     header = _recv_exact(sock, 4)
     (n,) = struct.unpack("!I", header)
+    compressed = bool(n & COMPRESSED_FLAG)
+    n &= ~COMPRESSED_FLAG
     if n <= 0 or n > MAX_MSG_BYTES:
         raise ValueError("invalid message length")
     data = _recv_exact(sock, n)
-    return json.loads(data.decode("utf-8"))
+    if compressed:
+        d = zlib.decompressobj()
+        data = d.decompress(data, MAX_MSG_BYTES)
+        if d.unconsumed_tail:
+            raise ValueError("decompressed message too large")
+        with _compression_lock:
+            _compression_stats["frames_received_compressed"] += 1
+    return json.loads(data.decode("utf-8")), 4 + n
 
 
 def make_ok(request_id: str, data: Any) -> Dict[str, Any]:
@@ -49,6 +293,11 @@ def make_err(request_id: str, err: Err) -> Dict[str, Any]:
     return {"v": 1, "request_id": request_id, "ok": False, "error": err.to_dict(), "data": None}
 
 
+def make_not_modified(request_id: str, etag: str) -> Dict[str, Any]:
+    """Reply to a conditional read (payload if_none_match) whose etag still matches."""
+    return make_ok(request_id, {"not_modified": True, "etag": etag})
+
+
 def require_fields(payload: Dict[str, Any], fields: Tuple[str, ...]) -> Optional[str]:
     for f in fields:
         if f not in payload:
@@ -56,37 +305,229 @@ def require_fields(payload: Dict[str, Any], fields: Tuple[str, ...]) -> Optional
     return None
 
 
+def _envelope(
+    api: str,
+    payload: Dict[str, Any],
+    session_id: Optional[str],
+    role: Optional[str],
+    deadline: float,
+    idempotency_key: Optional[str],
+    identity: Optional[Dict[str, Any]],
+    want_spans: bool = False,
+) -> Dict[str, Any]:
+    req_id = payload.get("request_id", None)  # allow callers to pass, but not required
+    # unique per request unless the caller passes one through; inside a traced request
+    # backend calls reuse the trace id so logs on every hop line up
+    request_id = req_id if isinstance(req_id, str) else (current_trace_id() or uuid.uuid4().hex)
+    req = {
+        "v": 1,
+        "request_id": request_id,
+        "service": "internal",
+        "api": api,
+        "role": role,
+        "session_id": session_id,
+        "deadline": deadline,
+        "idempotency_key": _call_key(idempotency_key),
+        "payload": payload,
+    }
+    if identity is not None:
+        # user already authenticated by the calling frontend (common/identity.py)
+        req["identity"] = identity
+    if _compression.enabled:
+        req["accept_encoding"] = ACCEPT_ENCODING
+    trace = outgoing_context(want_spans)
+    if trace is not None:
+        # see common/tracing.py
+        req["trace"] = trace
+    return req
+
+
+def _stamp(req: Dict[str, Any]) -> None:
+    # a retry is sent later than the envelope was built
+    trace = req.get("trace")
+    if trace is not None and "sent_at" in trace:
+        trace["sent_at"] = round(now_s(), 6)
+
+
+# Streamed replies: a request whose payload has "stream": true may be answered with several
+# frames. Every frame but the last has "more": true; chunk frames carry data["items"], the
+# last frame (or an error) carries the summary. A plain reply is a stream of one frame.
+DEFAULT_STREAM_CHUNK = 500
+
+
+def is_last_frame(frame: Dict[str, Any]) -> bool:
+    return frame.get("more") is not True
+
+
+class StreamedResponse:
+    """Handler result sent as a sequence of frames (see send_response) instead of one reply."""
+
+    def __init__(self, frames: Iterable[Dict[str, Any]]):
+        self.frames = frames
+
+
+def stream_items(request_id: str, chunks: Iterable[List[Any]], final: Dict[str, Any]) -> StreamedResponse:
+    """Frames for chunks of items followed by the final summary frame."""
+
+    def frames() -> Iterator[Dict[str, Any]]:
+        try:
+            for i, items in enumerate(chunks):
+                yield {**make_ok(request_id, {"items": items, "chunk": i}), "more": True}
+            yield {**make_ok(request_id, final), "more": False}
+        finally:
+            _close(chunks)
+
+    return StreamedResponse(frames())
+
+
+def relay_stream(request_id: str, frames: Iterable[Dict[str, Any]]) -> StreamedResponse:
+    """
+    Passes a backend's frames on to our caller one by one (frontends), under our request_id.
+    Closing the relay closes frames, so a relay cut short drops the backend connection.
+    """
+
+    def relayed() -> Iterator[Dict[str, Any]]:
+        try:
+            for f in frames:
+                yield {**f, "request_id": request_id}
+        finally:
+            _close(frames)
+
+    return StreamedResponse(relayed())
+
+
+def _close(frames: Iterable[Any]) -> None:
+    close = getattr(frames, "close", None)
+    if close is not None:
+        close()
+
+
+def _error_code(frame: Dict[str, Any]) -> Optional[str]:
+    return (frame.get("error") or {}).get("code")
+
+
+def send_response(
+    sock: socket.socket, req: Dict[str, Any], resp: Union[Dict[str, Any], StreamedResponse], trace: Optional[Trace] = None
+) -> Tuple[int, Optional[str]]:
+    """
+    Sends a handler result: one frame, or every frame of a StreamedResponse as it is produced.
+    The last frame carries trace's spans if the caller asked for them. If producing a frame
+    fails (store error, backend stream cut), the stream ends with an error frame; only a
+    failed send to sock is raised. The frames are closed either way.
+    Returns (bytes written, error code of the reply or None).
+    """
+    compress = accepts_compression(req)
+    if not isinstance(resp, StreamedResponse):
+        return send_json(sock, reply_frame(trace, resp), compress=compress), _error_code(resp)
+    sent = 0
+    frames = iter(resp.frames)
+    try:
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                return sent, None
+            except Exception as e:
+                # the client is waiting for a last frame: end the stream with the error
+                request_id = str(req.get("request_id", "req"))
+                code = UNAVAILABLE if isinstance(e, OSError) else INTERNAL
+                err = make_err(request_id, Err(code, f"Stream failed: {type(e).__name__}: {e}"))
+                return sent + send_json(sock, reply_frame(trace, err), compress=compress), code
+            if is_last_frame(frame):
+                return sent + send_json(sock, reply_frame(trace, frame), compress=compress), _error_code(frame)
+            sent += send_json(sock, frame, compress=compress)
+    finally:
+        _close(frames)
+
+
+def _read_frames(sock: socket.socket, on_exit: Callable[[bool], None]) -> Iterator[Dict[str, Any]]:
+    finished = False
+    try:
+        while True:
+            frame = recv_json(sock)
+            if is_last_frame(frame):
+                absorb(frame)
+                finished = True
+                yield frame
+                return
+            yield frame
+    finally:
+        on_exit(finished)
+
+
 @dataclass
 class RpcClient:
     host: str
     port: int
     timeout_s: float = 5.0
-
-    def call(self, api: str, payload: Dict[str, Any], session_id: Optional[str] = None, role: Optional[str] = None) -> Dict[str, Any]:
-        req_id = payload.get("request_id", None)  # allow callers to pass, but not required
-        request_id = req_id if isinstance(req_id, str) else "req"
-        req = {
-            "v": 1,
-            "request_id": request_id,
-            "service": "internal",
-            "api": api,
-            "role": role,
-            "session_id": session_id,
-            "payload": payload,
-        }
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    retry: RetryPolicy = NO_RETRY
+
+    def call(
+        self,
+        api: str,
+        payload: Dict[str, Any],
+        session_id: Optional[str] = None,
+        role: Optional[str] = None,
+        deadline: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+        identity: Optional[Dict[str, Any]] = None,
+        want_spans: bool = False,
+    ) -> Dict[str, Any]:
+        """want_spans: ask for the request's trace spans in resp["trace"] (see common/tracing.py)."""
+        with span(f"rpc {api}", peer=format_addr(self.host, self.port)):
+            d = _call_deadline(self.timeout_s, deadline)
+            req = _envelope(api, payload, session_id, role, d, idempotency_key, identity, want_spans)
+            attempt = 0
+            while True:
+                attempt += 1
+                remaining = d - now_s()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"no time left to call {api}")
+                try:
+                    resp = self._call_once(req, remaining)
+                    absorb(resp)
+                    return resp
+                except OSError:
+                    delay = self.retry.retry_after(attempt, d)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+
+    def call_stream(
+        self,
+        api: str,
+        payload: Dict[str, Any],
+        session_id: Optional[str] = None,
+        role: Optional[str] = None,
+        deadline: Optional[float] = None,
+        identity: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Sends a streamed request (payload gets "stream": true) and returns a generator of its
+        frames, ending with the last one. The request is sent before this returns, so it
+        runs under the caller's deadline; each frame then gets timeout_s.
+        """
+        d = _call_deadline(self.timeout_s, deadline)
+        remaining = d - now_s()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"no time left to call {api}")
+        req = _envelope(api, {**payload, "stream": True}, session_id, role, d, None, identity)
+        with span("connect"):
+            sock = open_connection(self.host, self.port, remaining, short_lived=True)
         try:
+            send_json(sock, req, compress=_compression.enabled)
             sock.settimeout(self.timeout_s)
-
-            # reduce Windows port pain
-            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-            # IMPORTANT: avoid TIME_WAIT explosion on Windows for short-lived connections
-            # (abortive close)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
-
-            sock.connect((self.host, self.port))
-            send_json(sock, req)
+        except BaseException:
+            sock.close()
+            raise
+        return _read_frames(sock, lambda finished: sock.close())
+
+    def _call_once(self, req: Dict[str, Any], remaining: float) -> Dict[str, Any]:
+        with span("connect"):
+            sock = open_connection(self.host, self.port, remaining, short_lived=True)
+        try:
+            _stamp(req)
+            send_json(sock, req, compress=_compression.enabled)
             resp = recv_json(sock)
             return resp
         finally:
@@ -100,6 +541,7 @@ class PersistentRpcClient:
     host: str
     port: int
     timeout_s: float = 30.0
+    retry: RetryPolicy = field(default_factory=RetryPolicy)
 
     def __post_init__(self) -> None:
         self._sock: Optional[socket.socket] = None
@@ -108,16 +550,8 @@ class PersistentRpcClient:
     def connect(self) -> None:
         if self._sock is not None:
             return
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(self.timeout_s)
-
-        # Client-side options to reduce Windows port pain
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        sock.connect((self.host, self.port))
-        self._sock = sock
+        with span("connect"):
+            self._sock = open_connection(self.host, self.port, self.timeout_s)
 
 
     def close(self) -> None:
@@ -128,42 +562,155 @@ class PersistentRpcClient:
         finally:
             self._sock = None
 
-    def call(self, api: str, payload: Dict[str, Any], session_id: Optional[str] = None, role: Optional[str] = None) -> Dict[str, Any]:
-        req_id = payload.get("request_id", None)
-        request_id = req_id if isinstance(req_id, str) else "req"
-        req = {
-            "v": 1,
-            "request_id": request_id,
-            "service": "internal",
-            "api": api,
-            "role": role,
-            "session_id": session_id,
-            "payload": payload,
-        }
+    def call(
+        self,
+        api: str,
+        payload: Dict[str, Any],
+        session_id: Optional[str] = None,
+        role: Optional[str] = None,
+        deadline: Optional[float] = None,
+        idempotency_key: Optional[str] = None,
+        identity: Optional[Dict[str, Any]] = None,
+        want_spans: bool = False,
+    ) -> Dict[str, Any]:
+        with span(f"rpc {api}", peer=format_addr(self.host, self.port)):
+            d = _call_deadline(self.timeout_s, deadline)
+            req = _envelope(api, payload, session_id, role, d, idempotency_key, identity, want_spans)
+            attempt = 0
+            while True:
+                attempt += 1
+                remaining = d - now_s()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"no time left to call {api}")
+                try:
+                    if self._sock is None:
+                        self.connect()
+                    assert self._sock is not None
+                    self._sock.settimeout(min(self.timeout_s, remaining))
+                    _stamp(req)
+                    send_json(self._sock, req, compress=_compression.enabled)
+                    resp = recv_json(self._sock)
+                    absorb(resp)
+                    return resp
+                except OSError:
+                    # the reply may still arrive on this socket, so never reuse it
+                    self.close()
+                    delay = self.retry.retry_after(attempt, d)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+
+    def call_stream(
+        self,
+        api: str,
+        payload: Dict[str, Any],
+        session_id: Optional[str] = None,
+        role: Optional[str] = None,
+        deadline: Optional[float] = None,
+        identity: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Like RpcClient.call_stream, on this connection. Consume the generator to the end
+        before the next call; stopping early closes the connection (unread frames would
+        otherwise be taken as the next reply).
+        """
+        d = _call_deadline(self.timeout_s, deadline)
+        req = _envelope(api, {**payload, "stream": True}, session_id, role, d, None, identity)
         if self._sock is None:
             self.connect()
         assert self._sock is not None
-
         try:
-            send_json(self._sock, req)
-            return recv_json(self._sock)
-        except (OSError, ConnectionError):
-            # one retry with a fresh socket
+            self._sock.settimeout(self.timeout_s)
+            send_json(self._sock, req, compress=_compression.enabled)
+        except OSError:
             self.close()
-            self.connect()
-            assert self._sock is not None
-            send_json(self._sock, req)
-            return recv_json(self._sock)
+            raise
+
+        def on_exit(finished: bool) -> None:
+            if not finished:
+                self.close()
+
+        return _read_frames(self._sock, on_exit)
+
+
+
+def stream_call(
+    host: str,
+    port: int,
+    api: str,
+    payload: Dict[str, Any],
+    session_id: Optional[str] = None,
+    role: Optional[str] = None,
+    timeout_s: Optional[float] = 30.0,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Sends one request on a dedicated connection and yields every frame the server sends
+    back (e.g. Subscribe) until it closes the connection or the caller stops iterating.
+    timeout_s bounds the wait for each frame; keep it above the server heartbeat.
+    """
+    req_id = payload.get("request_id", None)
+    request_id = req_id if isinstance(req_id, str) else "req"
+    req = {
+        "v": 1,
+        "request_id": request_id,
+        "service": "internal",
+        "api": api,
+        "role": role,
+        "session_id": session_id,
+        "payload": payload,
+    }
+    if _compression.enabled:
+        req["accept_encoding"] = ACCEPT_ENCODING
+    sock = open_connection(host, port, timeout_s)
+    try:
+        send_json(sock, req)
+        while True:
+            try:
+                yield recv_json(sock)
+            except ConnectionError:
+                return
+    finally:
+        try:
+            sock.close()
+        except Exception:
+            pass
+
 
+def safe_handle(handler_fn, req: Dict[str, Any], dedup=None) -> Union[Dict[str, Any], StreamedResponse]:
+    """
+    Runs handler_fn(req) and turns exceptions into error replies. With an
+    IdempotencyCache (common/idempotency.py) as dedup, replays of a keyed mutating request
+    get the stored reply instead of running again.
+    """
+    if dedup is not None:
+        return dedup.run(req, lambda: _handle(handler_fn, req))
+    return _handle(handler_fn, req)
 
 
-def safe_handle(handler_fn, req: Dict[str, Any]) -> Dict[str, Any]:
+def _handle(handler_fn, req: Dict[str, Any]) -> Union[Dict[str, Any], StreamedResponse]:
     request_id = str(req.get("request_id", "req"))
+    deadline = req.get("deadline")
+    deadline = float(deadline) if isinstance(deadline, (int, float)) else None
+    if deadline is not None and now_s() >= deadline:
+        # the caller has already given up: don't queue for locks or do the work
+        return make_err(request_id, Err(DEADLINE_EXCEEDED, "Deadline passed before the request was handled."))
+    key = req.get("idempotency_key")
+    _request_ctx.deadline = deadline
+    _request_ctx.idempotency_key = key if isinstance(key, str) else None
+    _request_ctx.calls = 0
     try:
         return handler_fn(req)
+    except TimeoutError as e:
+        # a backend call timed out or had no budget left
+        if deadline is not None and now_s() >= deadline:
+            return make_err(request_id, Err(DEADLINE_EXCEEDED, f"Deadline exceeded: {e}"))
+        return make_err(request_id, Err(UNAVAILABLE, f"Backend timed out: {e}"))
     except KeyError as e:
         return make_err(request_id, Err(BAD_REQUEST, f"Missing key: {e}"))
     except ValueError as e:
         return make_err(request_id, Err(BAD_REQUEST, str(e)))
     except Exception as e:
         return make_err(request_id, Err(INTERNAL, f"Internal error: {type(e).__name__}: {e}"))
+    finally:
+        _request_ctx.deadline = None
+        _request_ctx.idempotency_key = None
@@ -0,0 +1,222 @@
+from __future__ import annotations
+
+import itertools
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .config import AppConfig, Endpoint, get_endpoint
+from .errors import UNAVAILABLE
+from .protocol import NO_RETRY, RetryPolicy, RpcClient
+
+# one attempt of a read, as handed to a Hedger
+ReadFn = Callable[[], Dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class ReplicaSpec:
+    endpoint: Endpoint  # address frontends connect to
+    listen_host: str  # address the replica binds (defaults to endpoint.host)
+    primary: Endpoint  # ProductDB the replica follows
+
+
+@dataclass(frozen=True)
+class ProductShard:
+    index: int
+    endpoint: Endpoint  # address frontends connect to
+    listen_host: str  # address the shard binds (defaults to endpoint.host)
+    data_path: str
+    replicas: List[ReplicaSpec] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class ShardMap:
+    """
+    ProductDB partitioning:
+    - items live on the shard that owns their category (category_map, else category % N)
+    - carts live on shard buyer_id % N, independent of where their items live
+    """
+
+    shards: List[ProductShard]
+    category_map: Dict[int, int] = field(default_factory=dict)
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def shard_for_category(self, category: int) -> int:
+        idx = self.category_map.get(int(category))
+        if idx is None:
+            idx = int(category) % len(self.shards)
+        return idx
+
+    def shard_for_buyer(self, buyer_id: int) -> int:
+        return int(buyer_id) % len(self.shards)
+
+
+def _replica_specs(raw: List[Dict[str, Any]], default_primary: Endpoint) -> List[ReplicaSpec]:
+    out = []
+    for r in raw:
+        ep = get_endpoint(r)
+        primary = get_endpoint(r["primary"]) if "primary" in r else default_primary
+        out.append(ReplicaSpec(endpoint=ep, listen_host=str(r.get("listen_host", ep.host)), primary=primary))
+    return out
+
+
+def load_replicas(cfg: AppConfig) -> List[ReplicaSpec]:
+    """Read replicas of an unsharded ProductDB (product_db.replicas)."""
+    return _replica_specs(cfg.product_db.get("replicas") or [], get_endpoint(cfg.product_db))
+
+
+def load_shard_map(cfg: AppConfig) -> Optional[ShardMap]:
+    """Returns the product_db_shards map from the config, or None for a single ProductDB."""
+    raw = cfg.product_db_shards
+    if not raw:
+        return None
+    shards: List[ProductShard] = []
+    for i, s in enumerate(raw["shards"]):
+        ep = get_endpoint(s)
+        shards.append(
+            ProductShard(
+                index=i,
+                endpoint=ep,
+                listen_host=str(s.get("listen_host", ep.host)),
+                data_path=str(s["data_path"]),
+                replicas=_replica_specs(s.get("replicas") or [], ep),
+            )
+        )
+    if not shards:
+        raise ValueError("product_db_shards.shards must not be empty")
+    category_map = {int(k): int(v) for k, v in (raw.get("category_map") or {}).items()}
+    for cat, idx in category_map.items():
+        if not 0 <= idx < len(shards):
+            raise ValueError(f"category {cat} mapped to unknown shard {idx}")
+    return ShardMap(shards=shards, category_map=category_map)
+
+
+
+class ProductRouter:
+    """
+    Picks the ProductDB client for a request; with no shard map everything goes to one client.
+    Reads sent through read() are spread round-robin over the shard's replicas and fall back
+    to the primary when a replica is down or reports itself too stale.
+    """
+
+    def __init__(self, clients: List[RpcClient], shard_map: Optional[ShardMap] = None, replicas: Optional[List[List[RpcClient]]] = None):
+        if shard_map is not None and len(clients) != len(shard_map):
+            raise ValueError("need one client per shard")
+        self.clients = clients
+        self.shard_map = shard_map
+        self.replicas = replicas or [[] for _ in clients]
+        self._rr = itertools.count()
+        self.replica_reads = 0
+        self.replica_fallbacks = 0
+
+    @classmethod
+    def build(
+        cls,
+        product_host: str,
+        product_port: int,
+        shard_map: Optional[ShardMap] = None,
+        replicas: Optional[List[ReplicaSpec]] = None,
+        retry: RetryPolicy = NO_RETRY,
+    ) -> "ProductRouter":
+        """retry applies to the primaries; a failed replica read falls back to the primary instead."""
+        if shard_map is None:
+            reps = [[RpcClient(r.endpoint.host, r.endpoint.port) for r in (replicas or [])]]
+            return cls([RpcClient(product_host, product_port, retry=retry)], replicas=reps)
+        clients = [RpcClient(s.endpoint.host, s.endpoint.port, retry=retry) for s in shard_map.shards]
+        reps = [[RpcClient(r.endpoint.host, r.endpoint.port) for r in s.replicas] for s in shard_map.shards]
+        return cls(clients, shard_map, reps)
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.clients) > 1
+
+    def _category_shard(self, category: Any) -> int:
+        if self.shard_map is None:
+            return 0
+        return self.shard_map.shard_for_category(int(category))
+
+    def _item_shard(self, item_id: Any) -> int:
+        if not isinstance(item_id, dict) or "category" not in item_id:
+            raise ValueError("item_id must be {category, id}")
+        return self._category_shard(item_id["category"])
+
+    def for_category(self, category: Any) -> RpcClient:
+        return self.clients[self._category_shard(category)]
+
+    def for_item(self, item_id: Any) -> RpcClient:
+        return self.clients[self._item_shard(item_id)]
+
+    def for_buyer(self, buyer_id: int) -> RpcClient:
+        if self.shard_map is None:
+            return self.clients[0]
+        return self.clients[self.shard_map.shard_for_buyer(buyer_id)]
+
+    def read(self, shard: int, api: str, payload: Dict[str, Any], replica: Optional[int] = None) -> Dict[str, Any]:
+        """replica: index of the replica to read from (default: the next one round-robin)."""
+        replicas = self.replicas[shard]
+        if replicas:
+            c = replicas[(next(self._rr) if replica is None else replica) % len(replicas)]
+            try:
+                resp = c.call(api, payload, role=None)
+                if resp.get("ok", False) or (resp.get("error") or {}).get("code") != UNAVAILABLE:
+                    self.replica_reads += 1
+                    return resp
+            except OSError:
+                pass
+            self.replica_fallbacks += 1
+        return self.clients[shard].call(api, payload, role=None)
+
+    def hedged_read(self, shard: int, api: str, payload: Dict[str, Any]) -> Tuple[ReadFn, Optional[ReadFn]]:
+        """
+        (first, hedge) attempts of a read() for a Hedger. first reads from the replica picked
+        round-robin; hedge from the replica after that one, or from the primary when the
+        shard has a single replica. hedge is None without replicas, where it would only send
+        the same read to the same server twice.
+        """
+        replicas = self.replicas[shard]
+        if not replicas:
+            return (lambda: self.read(shard, api, payload)), None
+        idx = next(self._rr) % len(replicas)
+        first: ReadFn = lambda: self.read(shard, api, payload, replica=idx)
+        if len(replicas) == 1:
+            return first, (lambda: self.clients[shard].call(api, payload, role=None))
+        return first, (lambda: self.read(shard, api, payload, replica=idx + 1))
+
+    def read_stream(self, shard: int, api: str, payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Streamed variant of read(): the replica is chosen by its first frame."""
+        replicas = self.replicas[shard]
+        if replicas:
+            c = replicas[next(self._rr) % len(replicas)]
+            try:
+                frames = c.call_stream(api, payload, role=None)
+                first = next(frames)
+                if first.get("ok", False) or (first.get("error") or {}).get("code") != UNAVAILABLE:
+                    self.replica_reads += 1
+                    return _prepend(first, frames)
+                frames.close()
+            except OSError:
+                pass
+            self.replica_fallbacks += 1
+        return self.clients[shard].call_stream(api, payload, role=None)
+
+    def read_category_stream(self, category: Any, api: str, payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        return self.read_stream(self._category_shard(category), api, payload)
+
+    def read_category(self, category: Any, api: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.read(self._category_shard(category), api, payload)
+
+    def read_item(self, item_id: Any, api: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.read(self._item_shard(item_id), api, payload)
+
+    def hedged_category(self, category: Any, api: str, payload: Dict[str, Any]) -> Tuple[ReadFn, Optional[ReadFn]]:
+        return self.hedged_read(self._category_shard(category), api, payload)
+
+    def hedged_item(self, item_id: Any, api: str, payload: Dict[str, Any]) -> Tuple[ReadFn, Optional[ReadFn]]:
+        return self.hedged_read(self._item_shard(item_id), api, payload)
+
+
+def _prepend(first: Dict[str, Any], frames: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    # unlike itertools.chain, closing this closes frames (and its connection)
+    yield first
+    yield from frames
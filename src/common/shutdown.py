@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+import atexit
+import signal
+import sys
+from typing import Callable
+
+
+def exit_on_sigterm() -> None:
+    """
+    Makes SIGTERM exit the process normally, so atexit hooks run (the default handling
+    skips them). Call from the main thread, e.g. a server's main().
+    """
+    signal.signal(signal.SIGTERM, _exit)
+
+
+def _exit(signum: int, frame: object) -> None:
+    sys.exit(0)
+
+
+def run_at_exit(fn: Callable[[], object]) -> None:
+    """Runs fn when the process exits, including on SIGTERM."""
+    atexit.register(fn)
+    exit_on_sigterm()
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from .protocol import DeadlineExceeded, current_deadline
+from .time_utils import now_s
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls with the same key into one: the first caller (leader) runs
+    fn, callers arriving while it is in flight wait and receive the same result or error.
+    Nothing is cached once the leader finishes.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.followers += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+                leader = True
+
+        if not leader:
+            # don't wait on the leader's call past our own caller's deadline
+            deadline = current_deadline()
+            if not call.done.wait(None if deadline is None else max(0.0, deadline - now_s())):
+                raise DeadlineExceeded("deadline passed while waiting for a coalesced call")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.leaders + self.followers
+            return {
+                "backend_calls": self.leaders,
+                "coalesced_calls": self.followers,
+                "in_flight": len(self._calls),
+                # share of requests that did not reach the backend
+                "coalescing_ratio": (self.followers / total) if total else 0.0,
+            }
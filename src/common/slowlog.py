@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+from typing import Any, Dict, Optional
+
+from .time_utils import monotonic_s
+
+
+class SlowRequestLog:
+    """
+    Logs requests slower than threshold_s: API, sizes (never payload contents), phase
+    timings, requests in flight and trace id. Only sample_rate of slow requests are
+    logged, and at most max_per_s lines per second (token bucket); the rest are counted.
+    Lines go through the logger's queue handler (see setup_logging), so the request
+    thread never writes to stdout.
+    """
+
+    def __init__(self, logger: logging.Logger, threshold_s: float, sample_rate: float = 1.0, max_per_s: float = 10.0):
+        self.logger = logger
+        self.threshold_s = float(threshold_s)
+        self.sample_rate = float(sample_rate)
+        self.max_per_s = float(max_per_s)
+        self._lock = threading.Lock()
+        self._tokens = self.max_per_s
+        self._refilled = monotonic_s()
+        self.slow = 0
+        self.logged = 0
+        self.sampled_out = 0
+        self.rate_limited = 0
+
+    @classmethod
+    def from_config(cls, section: Dict[str, Any], logger: logging.Logger) -> Optional["SlowRequestLog"]:
+        """Reads slow_request_ms / slow_log_sample_rate / slow_log_max_per_second; None when slow_request_ms is 0."""
+        threshold_ms = float(section.get("slow_request_ms", 0))
+        if threshold_ms <= 0:
+            return None
+        return cls(
+            logger,
+            threshold_ms / 1000.0,
+            sample_rate=float(section.get("slow_log_sample_rate", 1.0)),
+            max_per_s=float(section.get("slow_log_max_per_second", 10)),
+        )
+
+    def _admit(self) -> bool:
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return False
+        now = monotonic_s()
+        self._tokens = min(self.max_per_s, self._tokens + (now - self._refilled) * self.max_per_s)
+        self._refilled = now
+        if self._tokens < 1.0:
+            self.rate_limited += 1
+            return False
+        self._tokens -= 1.0
+        self.logged += 1
+        return True
+
+    def observe(
+        self,
+        api: str,
+        elapsed_s: float,
+        phases_s: Dict[str, float],
+        bytes_in: int,
+        bytes_out: int,
+        error_code: Optional[str],
+        in_flight: int,
+        trace_id: Optional[str],
+    ) -> None:
+        if elapsed_s < self.threshold_s:
+            return
+        with self._lock:
+            self.slow += 1
+            if not self._admit():
+                return
+        phases = " ".join(f"{k}={v * 1000.0:.1f}ms" for k, v in phases_s.items())
+        self.logger.warning(
+            f"slow {api} {elapsed_s * 1000.0:.1f}ms {phases} in={bytes_in}B out={bytes_out}B "
+            f"in_flight={in_flight} error={error_code or '-'} trace={trace_id or '-'}"
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "threshold_ms": round(self.threshold_s * 1000.0, 3),
+                "slow": self.slow,
+                "logged": self.logged,
+                "sampled_out": self.sampled_out,
+                "rate_limited": self.rate_limited,
+            }
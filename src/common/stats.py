@@ -0,0 +1,433 @@
+from __future__ import annotations
+
+import logging
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from .time_utils import monotonic_s, now_s, perf_s
+from .shutdown import run_at_exit
+from .slowlog import SlowRequestLog
+from .tracing import current_trace, current_trace_id, record_span
+
+
+# Log-linear buckets over integer microseconds, as in HDR histograms: values below 32us are
+# exact, above that each power of two is split into 16 buckets (<= ~6% relative error).
+_SUB_BITS = 4
+_SUB = 1 << _SUB_BITS
+_EXACT = _SUB * 2
+
+
+def _bucket(v: int) -> int:
+    if v < _EXACT:
+        return v
+    shift = v.bit_length() - (_SUB_BITS + 1)
+    return (shift << _SUB_BITS) + (v >> shift)
+
+
+def _bucket_floor(idx: int) -> int:
+    if idx < _EXACT:
+        return idx
+    shift = (idx >> _SUB_BITS) - 1
+    return (idx - (shift << _SUB_BITS)) << shift
+
+
+class Histogram:
+    """
+    Fixed-error latency histogram in microseconds. Cheap to record into, and mergeable
+    (to_dict/from_dict/merge) so histograms from several threads or processes add up.
+    Not thread-safe on its own; callers hold a lock.
+    """
+
+    def __init__(self) -> None:
+        self.counts: Dict[int, int] = {}
+        self.n = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def record_us(self, v: int) -> None:
+        v = max(0, int(v))
+        b = _bucket(v)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.n += 1
+        self.total_us += v
+        if v > self.max_us:
+            self.max_us = v
+
+    def record_s(self, seconds: float) -> None:
+        self.record_us(int(seconds * 1_000_000))
+
+    def percentile_us(self, pct: float) -> int:
+        if self.n == 0:
+            return 0
+        rank = max(1, int(round(self.n * pct / 100.0)))
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                # report the bucket's upper edge, never more than the real maximum
+                return min(self.max_us, _bucket_floor(b + 1) - 1 if b + 1 >= _EXACT else b)
+        return self.max_us
+
+    def merge(self, other: "Histogram") -> None:
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.n += other.n
+        self.total_us += other.total_us
+        self.max_us = max(self.max_us, other.max_us)
+
+    def summary_ms(self) -> Dict[str, float]:
+        def ms(us: float) -> float:
+            return round(us / 1000.0, 3)
+
+        return {
+            "count": self.n,
+            "mean": ms(self.total_us / self.n) if self.n else 0.0,
+            "p50": ms(self.percentile_us(50)),
+            "p90": ms(self.percentile_us(90)),
+            "p99": ms(self.percentile_us(99)),
+            "p999": ms(self.percentile_us(99.9)),
+            "max": ms(self.max_us),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"counts": {str(b): c for b, c in self.counts.items()}, "n": self.n, "total_us": self.total_us, "max_us": self.max_us}
+
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Histogram":
+        h = cls()
+        h.counts = {int(b): int(c) for b, c in d["counts"].items()}
+        h.n = int(d["n"])
+        h.total_us = int(d["total_us"])
+        h.max_us = int(d["max_us"])
+        return h
+
+
+class ApiStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.errors: Dict[str, int] = {}
+        self.latency = Histogram()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock_acquisitions = 0
+        self.lock_wait = Histogram()
+        self.lock_hold = Histogram()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": dict(self.errors),
+            "latency_ms": self.latency.summary_ms(),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "lock": {
+                "acquisitions": self.lock_acquisitions,
+                "wait_ms": self.lock_wait.summary_ms(),
+                "hold_ms": self.lock_hold.summary_ms(),
+                "wait_ms_total": round(self.lock_wait.total_us / 1000.0, 3),
+                "hold_ms_total": round(self.lock_hold.total_us / 1000.0, 3),
+            },
+        }
+
+
+class RequestTimer:
+    """One request being handled: returned by ServiceStats.begin, passed back to end."""
+
+    __slots__ = ("api", "started", "handled_at", "lock_wait_s", "lock_hold_s")
+
+    def __init__(self, api: str) -> None:
+        self.api = api
+        self.started = perf_s()
+        self.handled_at: Optional[float] = None
+        self.lock_wait_s = 0.0
+        self.lock_hold_s = 0.0
+
+    def handled(self) -> None:
+        """The handler returned; the rest is sending the reply."""
+        self.handled_at = perf_s()
+
+
+# request being handled on this thread, for attributing lock time; background threads
+# (flushers, sweepers) show up as BACKGROUND
+_current = threading.local()
+BACKGROUND = "(background)"
+# error code of a request whose reply never went out in full (client gone, stream cut, ...)
+ABORTED = "ABORTED"
+
+
+class ServiceStats:
+    """
+    Per-API counters of one service process: requests, errors by code, latency histogram
+    (receive done -> reply sent), bytes in/out and store lock wait/hold time. Other
+    components add their own sections (cart, coalescing, ...) with add_section; GetStats
+    returns snapshot(). Requests slower than the slow_log threshold are also logged.
+    """
+
+    def __init__(self, service: str) -> None:
+        self.service = service
+        self._lock = threading.Lock()
+        self._apis: Dict[str, ApiStats] = {}
+        self._sections: Dict[str, Callable[[], Any]] = {}
+        self._started = monotonic_s()
+        self.in_flight = 0
+        self.slow_log: Optional[SlowRequestLog] = None
+
+    def _api(self, api: str) -> ApiStats:
+        st = self._apis.get(api)
+        if st is None:
+            st = self._apis[api] = ApiStats()
+        return st
+
+    def begin(self, req: Dict[str, Any]) -> RequestTimer:
+        call = RequestTimer(str(req.get("api") or "?"))
+        _current.call = call
+        with self._lock:
+            self.in_flight += 1
+        return call
+
+    def end(self, call: RequestTimer, error_code: Optional[str], bytes_in: int, bytes_out: int) -> None:
+        done = perf_s()
+        elapsed = done - call.started
+        _current.call = None
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            st = self._api(call.api)
+            st.count += 1
+            st.latency.record_s(elapsed)
+            st.bytes_in += bytes_in
+            st.bytes_out += bytes_out
+            if error_code:
+                st.errors[error_code] = st.errors.get(error_code, 0) + 1
+        if self.slow_log is not None:
+            handled_at = call.handled_at if call.handled_at is not None else done
+            phases = {
+                "handle": handled_at - call.started,
+                "reply": done - handled_at,
+                "lock_wait": call.lock_wait_s,
+                "lock_hold": call.lock_hold_s,
+            }
+            self.slow_log.observe(call.api, elapsed, phases, bytes_in, bytes_out, error_code, in_flight, current_trace_id())
+
+    def record_lock(self, wait_s: float, hold_s: float) -> None:
+        call = getattr(_current, "call", None)
+        if call is not None:
+            call.lock_wait_s += wait_s
+            call.lock_hold_s += hold_s
+        api = call.api if call is not None else BACKGROUND
+        with self._lock:
+            st = self._api(api)
+            st.lock_acquisitions += 1
+            st.lock_wait.record_s(wait_s)
+            st.lock_hold.record_s(hold_s)
+
+    def add_section(self, name: str, fn: Callable[[], Any]) -> None:
+        self._sections[name] = fn
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            apis = {api: st.snapshot() for api, st in sorted(self._apis.items())}
+            in_flight = self.in_flight
+        out: Dict[str, Any] = {"service": self.service, "uptime_s": round(monotonic_s() - self._started, 1), "in_flight": in_flight, "apis": apis}
+        if self.slow_log is not None:
+            out["slow_requests"] = self.slow_log.stats()
+        for name, fn in self._sections.items():
+            try:
+                out[name] = fn()
+            except Exception as e:
+                out[name] = {"error": f"{type(e).__name__}: {e}"}
+        return out
+
+    def log_lines(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for api, st in sorted(self._apis.items()):
+                lat = st.latency.summary_ms()
+                lines.append(
+                    f"{api}: n={st.count} err={sum(st.errors.values())} p50={lat['p50']}ms p99={lat['p99']}ms max={lat['max']}ms "
+                    f"lock_wait={st.lock_wait.total_us / 1000.0:.1f}ms lock_hold={st.lock_hold.total_us / 1000.0:.1f}ms "
+                    f"in={st.bytes_in}B out={st.bytes_out}B"
+                )
+        return lines
+
+    def start_log_dump(self, interval_s: float, logger: logging.Logger) -> Optional[threading.Thread]:
+        """Logs one line per API every interval_s seconds (cumulative since start); 0 disables."""
+        if interval_s <= 0:
+            return None
+
+        def loop() -> None:
+            while True:
+                threading.Event().wait(interval_s)
+                for line in self.log_lines():
+                    logger.info(f"stats {line}")
+
+        t = threading.Thread(target=loop, name="stats-log", daemon=True)
+        t.start()
+        return t
+
+
+class _OpLockStats:
+    __slots__ = ("acquisitions", "contended", "wait_s", "max_wait_s", "hold_s", "max_hold_s", "blocked_by")
+
+    def __init__(self) -> None:
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_s = 0.0
+        self.max_wait_s = 0.0
+        self.hold_s = 0.0
+        self.max_hold_s = 0.0
+        self.blocked_by: Dict[str, float] = {}  # holder op -> time spent waiting for it
+
+
+class LockProfile:
+    """Wait and hold time of one lock per operation (the store method that took it)."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._lock = threading.Lock()
+        self._ops: Dict[str, _OpLockStats] = {}
+
+    def record(self, op: str, wait_s: float, hold_s: float, blocked_by: Optional[str]) -> None:
+        with self._lock:
+            st = self._ops.get(op)
+            if st is None:
+                st = self._ops[op] = _OpLockStats()
+            st.acquisitions += 1
+            st.wait_s += wait_s
+            st.hold_s += hold_s
+            st.max_wait_s = max(st.max_wait_s, wait_s)
+            st.max_hold_s = max(st.max_hold_s, hold_s)
+            if blocked_by is not None:
+                st.contended += 1
+                st.blocked_by[blocked_by] = st.blocked_by.get(blocked_by, 0.0) + wait_s
+
+    def top(self, n: int = 10) -> List[Dict[str, Any]]:
+        """The n operations that spent the most time waiting for the lock."""
+
+        def ms(s: float) -> float:
+            return round(s * 1000.0, 3)
+
+        with self._lock:
+            ranked = sorted(self._ops.items(), key=lambda kv: kv[1].wait_s, reverse=True)[: max(0, n)]
+            return [
+                {
+                    "op": op,
+                    "acquisitions": st.acquisitions,
+                    "contended": st.contended,
+                    "wait_ms_total": ms(st.wait_s),
+                    "wait_ms_max": ms(st.max_wait_s),
+                    "hold_ms_total": ms(st.hold_s),
+                    "hold_ms_max": ms(st.max_hold_s),
+                    "blocked_by_ms": {h: ms(w) for h, w in sorted(st.blocked_by.items(), key=lambda kv: kv[1], reverse=True)},
+                }
+                for op, st in ranked
+            ]
+
+
+# per-operation lock profiling (configure_lock_profiling); off by default, since it costs
+# a frame lookup and a second lock round trip per acquire
+_lock_profiling = False
+_lock_profiles: Dict[str, LockProfile] = {}
+
+
+def configure_lock_profiling(enabled: bool) -> None:
+    global _lock_profiling
+    _lock_profiling = bool(enabled)
+
+
+def lock_profiles(top_n: int = 10) -> Dict[str, Any]:
+    """Top contended operations of every TimedRLock in this process (GetStats "locks" section)."""
+    return {"enabled": _lock_profiling, "locks": {name: p.top(top_n) for name, p in sorted(_lock_profiles.items())}}
+
+
+def log_lock_profiles_at_exit(logger: logging.Logger, top_n: int = 10) -> None:
+    """Logs lock_profiles() when the process exits, including on SIGTERM."""
+    if not _lock_profiling:
+        return
+
+    def report() -> None:
+        for name, ops in lock_profiles(top_n)["locks"].items():
+            for o in ops:
+                logger.info(
+                    f"lock {name} op={o['op']} acquisitions={o['acquisitions']} contended={o['contended']} "
+                    f"wait={o['wait_ms_total']}ms (max {o['wait_ms_max']}ms) hold={o['hold_ms_total']}ms (max {o['hold_ms_max']}ms) "
+                    f"blocked_by={o['blocked_by_ms']}"
+                )
+
+    run_at_exit(report)
+
+
+class TimedRLock:
+    """
+    threading.RLock that reports how long the outermost acquire waited and how long the lock
+    was then held to service_stats(), attributed to the API being handled on this thread,
+    and as a "lock" span to a sampled trace. With lock profiling on it also records, per
+    store method that took the lock, the wait and hold time and which method was holding
+    it when it had to wait. Re-entrant acquires are not timed. Only supports use as a
+    context manager.
+    """
+
+    def __init__(self, name: str = "lock") -> None:
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._holder: Optional[str] = None  # op holding the lock (profiling only; read racily)
+        self.profile = _lock_profiles.setdefault(name, LockProfile(name))
+
+    def __enter__(self) -> "TimedRLock":
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if depth:
+            self._lock.acquire()
+        elif _lock_profiling:
+            op = sys._getframe(1).f_code.co_name
+            t0 = perf_s()
+            if self._lock.acquire(blocking=False):
+                local.blocked_by = None
+            else:
+                local.blocked_by = self._holder or "?"
+                self._lock.acquire()
+            local.acquired_at = perf_s()
+            local.wait_s = local.acquired_at - t0
+            local.op = self._holder = op
+        else:
+            t0 = perf_s()
+            self._lock.acquire()
+            local.acquired_at = perf_s()
+            local.wait_s = local.acquired_at - t0
+            local.op = None
+        local.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        local = self._local
+        local.depth -= 1
+        if local.depth:
+            self._lock.release()
+            return
+        hold_s = perf_s() - local.acquired_at
+        op = local.op
+        if op is not None:
+            self._holder = None
+        self._lock.release()
+        wait_s = local.wait_s
+        _service_stats.record_lock(wait_s, hold_s)
+        if op is not None:
+            self.profile.record(op, wait_s, hold_s, local.blocked_by)
+        trace = current_trace()
+        if trace is not None and trace.sampled:
+            record_span("lock", now_s() - wait_s - hold_s, wait_s + hold_s, wait_ms=round(wait_s * 1000.0, 3), hold_ms=round(hold_s * 1000.0, 3))
+
+
+_service_stats = ServiceStats("unknown")
+
+
+def init_service_stats(service: str) -> ServiceStats:
+    """Called once by each server's main(); the process serves one service."""
+    global _service_stats
+    _service_stats = ServiceStats(service)
+    return _service_stats
+
+
+def service_stats() -> ServiceStats:
+    return _service_stats
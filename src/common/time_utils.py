@@ -11,3 +11,8 @@ def now_s() -> float:
 def monotonic_s() -> float:
     """Monotonic time in seconds for measuring durations."""
     return time.monotonic()
+
+
+def perf_s() -> float:
+    """High-resolution timer for short intervals (request latency, lock waits)."""
+    return time.perf_counter()
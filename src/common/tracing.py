@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import json
+import os
+import queue
+import random
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from .time_utils import now_s, perf_s
+
+
+@dataclass
+class _Tracing:
+    enabled: bool = False
+    sample_rate: float = 1.0
+    collector_path: Optional[str] = None
+
+
+_tracing = _Tracing()
+_service = "unknown"
+_collector: Optional["queue.Queue[Dict[str, Any]]"] = None
+
+
+def configure_tracing(service: str, raw: Optional[Dict[str, Any]]) -> None:
+    """
+    Applies the optional top-level tracing config section for this process. Frontends
+    give every request a trace id and record spans for sample_rate of them when enabled
+    (and always when the client asks for spans); backends follow the caller's decision.
+    Recorded traces that nobody asked for are appended to collector_path.
+    """
+    global _service, _collector
+    raw = raw or {}
+    _service = service
+    _tracing.enabled = bool(raw.get("enabled", False))
+    _tracing.sample_rate = float(raw.get("sample_rate", 1.0))
+    _tracing.collector_path = str(raw["collector_path"]) if raw.get("collector_path") else None
+    if _tracing.collector_path and _collector is None:
+        _collector = queue.Queue(maxsize=10_000)
+        t = threading.Thread(target=_write_loop, args=(_collector, _tracing.collector_path), name="trace-writer", daemon=True)
+        t.start()
+
+
+def _write_loop(q: "queue.Queue[Dict[str, Any]]", path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        while True:
+            # one line per trace and hop; appends, so all services can share the file
+            f.write(json.dumps(q.get(), separators=(",", ":")) + "\n")
+            if q.empty():
+                f.flush()
+
+
+class Trace:
+    """
+    One request's trace as seen by this process. Unsampled traces only carry the id (for
+    propagation and logs); sampled ones collect spans, including those returned by the
+    backends this process called.
+    """
+
+    def __init__(self, trace_id: str, sampled: bool, parent_id: Optional[str] = None, return_spans: bool = False):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.parent_id = parent_id
+        self.return_spans = return_spans
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, dur_s: float, parent: Optional[str], span_id: Optional[str] = None, **attrs: Any) -> None:
+        if not self.sampled:
+            return
+        s = {
+            "id": span_id or new_span_id(),
+            "parent": parent,
+            "service": _service,
+            "name": name,
+            "start": round(start, 6),
+            "ms": round(dur_s * 1000.0, 3),
+        }
+        s.update(attrs)
+        with self._lock:
+            self.spans.append(s)
+
+    def extend(self, spans: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self.spans.extend(spans)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"trace_id": self.trace_id, "spans": list(self.spans)}
+
+
+def new_span_id() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+# trace and innermost open span of the request being handled on this thread
+_ctx = threading.local()
+
+
+def current_trace() -> Optional[Trace]:
+    return getattr(_ctx, "trace", None)
+
+
+def current_trace_id() -> Optional[str]:
+    trace = getattr(_ctx, "trace", None)
+    return trace.trace_id if trace is not None else None
+
+
+def begin_trace(req: Dict[str, Any], root: bool = False) -> Optional[Trace]:
+    """
+    Makes req's trace current on this thread. Backends join the trace in req["trace"] (if
+    any); frontends (root=True) start one, sampled per config or when the client sent
+    {"trace": {"return": true}} to get the spans back in the reply.
+    """
+    ctx = req.get("trace")
+    ctx = ctx if isinstance(ctx, dict) else {}
+    trace: Optional[Trace] = None
+    if isinstance(ctx.get("trace_id"), str):
+        trace = Trace(ctx["trace_id"], bool(ctx.get("sampled")), ctx.get("parent_id"), bool(ctx.get("return")))
+    elif root:
+        want = bool(ctx.get("return"))
+        sampled = want or (_tracing.enabled and random.random() < _tracing.sample_rate)
+        trace = Trace(uuid.uuid4().hex, sampled, None, want)
+    _ctx.trace = trace
+    _ctx.span = trace.parent_id if trace is not None else None
+    if trace is not None and trace.sampled and isinstance(ctx.get("sent_at"), (int, float)):
+        # caller sent -> request fully read here: network, socket queueing and decode
+        sent_at = float(ctx["sent_at"])
+        trace.add("queue", sent_at, max(0.0, now_s() - sent_at), trace.parent_id)
+    return trace
+
+
+def end_trace(trace: Optional[Trace]) -> None:
+    """Clears this thread's trace; sampled spans not returned to the caller go to the collector."""
+    _ctx.trace = None
+    _ctx.span = None
+    if trace is None or not trace.sampled or trace.return_spans or _collector is None:
+        return
+    rec = trace.snapshot()
+    rec["service"] = _service
+    try:
+        _collector.put_nowait(rec)
+    except queue.Full:
+        pass  # never block a request on the collector
+
+
+def reply_frame(trace: Optional[Trace], frame: Dict[str, Any]) -> Dict[str, Any]:
+    """The final reply frame, with the spans attached if the caller asked for them."""
+    if trace is None or not trace.return_spans:
+        return frame
+    # copy: the reply may also sit in the idempotency cache
+    return {**frame, "trace": trace.snapshot()}
+
+
+@contextmanager
+def trace_scope(trace: Optional[Trace], span_id: Optional[str]) -> Iterator[None]:
+    """Makes trace current on another thread running part of the request (e.g. hedging workers)."""
+    prev = (getattr(_ctx, "trace", None), getattr(_ctx, "span", None))
+    _ctx.trace, _ctx.span = trace, span_id
+    try:
+        yield
+    finally:
+        _ctx.trace, _ctx.span = prev
+
+
+def current_span_id() -> Optional[str]:
+    return getattr(_ctx, "span", None)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Optional[str]]:
+    """Times the block as a span of the current trace; spans opened inside become its children."""
+    trace = getattr(_ctx, "trace", None)
+    if trace is None or not trace.sampled:
+        yield None
+        return
+    parent = getattr(_ctx, "span", None)
+    span_id = new_span_id()
+    _ctx.span = span_id
+    start, t0 = now_s(), perf_s()
+    try:
+        yield span_id
+    finally:
+        _ctx.span = parent
+        trace.add(name, start, perf_s() - t0, parent, span_id, **attrs)
+
+
+def record_span(name: str, start: float, dur_s: float, **attrs: Any) -> None:
+    """Adds an already measured span (start: wall clock seconds) to the current trace."""
+    trace = getattr(_ctx, "trace", None)
+    if trace is not None and trace.sampled:
+        trace.add(name, start, dur_s, getattr(_ctx, "span", None), **attrs)
+
+
+def outgoing_context(want_spans: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    trace field for a backend call made now. Inside a traced request the backend joins the
+    trace and, if sampled, returns its spans for absorb(); a plain client can ask a
+    frontend for the spans with want_spans.
+    """
+    trace = getattr(_ctx, "trace", None)
+    if trace is None:
+        return {"return": True} if want_spans else None
+    ctx: Dict[str, Any] = {"trace_id": trace.trace_id, "sampled": trace.sampled}
+    if trace.sampled:
+        ctx.update({"parent_id": getattr(_ctx, "span", None), "return": True, "sent_at": round(now_s(), 6)})
+    return ctx
+
+
+def absorb(resp: Any) -> None:
+    """Moves the spans a backend returned in resp["trace"] into the current trace."""
+    trace = getattr(_ctx, "trace", None)
+    if trace is None or not isinstance(resp, dict) or "trace" not in resp:
+        return
+    t = resp.pop("trace")
+    if isinstance(t, dict) and isinstance(t.get("spans"), list):
+        trace.extend(t["spans"])
@@ -1,20 +1,54 @@
 from __future__ import annotations
 
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
 from .store import CustomerStore
-from ..common.protocol import make_ok, make_err
-from ..common.errors import Err, BAD_REQUEST, UNAUTHORIZED, SESSION_EXPIRED
+from ..common.protocol import compression_stats, make_ok, make_err
+from ..common.errors import Err, BAD_REQUEST, FORBIDDEN, UNAUTHORIZED, SESSION_EXPIRED
+from ..common.identity import ServiceIdentity
+from ..common.profiling import profiling_allowed, run_profile
+from ..common.stats import service_stats
+
+
+# APIs whose replies are remembered by idempotency key, so a retry does not apply them twice
+MUTATING_APIS = ("CreateAccount", "Login", "Logout", "UpdateSellerFeedback", "UpdateSellerFeedbackBatch")
 
 
 class CustomerHandlers:
-    def __init__(self, store: CustomerStore):
+    def __init__(self, store: CustomerStore, identity: Optional[ServiceIdentity] = None):
         self.store = store
+        # verifies user identities signed by the frontends (None: only session ids are accepted)
+        self.identity = identity
+
+    def _caller(self, req: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+        """
+        (user_type, user_id) vouched for by a frontend, or None when the request carries no
+        identity. Only deployments without internal_auth fall back to the session id.
+        """
+        ident = req.get("identity")
+        if ident is None:
+            return None
+        if self.identity is None:
+            raise ValueError("internal_auth is not configured")
+        return self.identity.verify(ident)
 
     def handle(self, req: Dict[str, Any]) -> Dict[str, Any]:
         api = req.get("api")
         request_id = str(req.get("request_id", "req"))
         payload = req.get("payload") or {}
+        try:
+            caller = self._caller(req)
+        except ValueError as e:
+            return make_err(request_id, Err(UNAUTHORIZED, f"Untrusted identity: {e}"))
+
+        if api == "GetStats":
+            return make_ok(request_id, service_stats().snapshot())
+        if api == "Profile":
+            if not profiling_allowed():
+                return make_err(request_id, Err(FORBIDDEN, "Profile is disabled on this service (profile_api_enabled)"))
+            return make_ok(request_id, run_profile(payload))
+        if api == "GetTransportStats":
+            return make_ok(request_id, compression_stats())
 
         if api == "CreateAccount":
             role = req.get("role")
@@ -65,6 +99,13 @@ class CustomerHandlers:
             # can be by session or by seller_id
             if "seller_id" in payload:
                 seller_id = int(payload["seller_id"])
+            elif caller is not None:
+                # the frontend has already validated the session
+                if caller[0] != "seller":
+                    return make_err(request_id, Err(UNAUTHORIZED, "Not a seller."))
+                seller_id = caller[1]
+            elif self.identity is not None:
+                return make_err(request_id, Err(UNAUTHORIZED, "GetSellerRating without seller_id needs a signed identity (internal_auth)"))
             else:
                 session_id = str(payload.get("session_id") or req.get("session_id") or "")
                 if not session_id:
@@ -84,15 +125,31 @@ class CustomerHandlers:
             up, down = self.store.update_seller_feedback(seller_id, vote)
             return make_ok(request_id, {"seller_id": seller_id, "thumbs_up": up, "thumbs_down": down})
 
+        if api == "UpdateSellerFeedbackBatch":
+            batch_id = str(payload.get("batch_id") or "")
+            if not batch_id:
+                return make_err(request_id, Err(BAD_REQUEST, "batch_id required"))
+            deltas = payload.get("deltas")
+            if not isinstance(deltas, list):
+                return make_err(request_id, Err(BAD_REQUEST, "deltas must be a list"))
+            applied, skipped = self.store.apply_seller_feedback_batch(batch_id, deltas)
+            return make_ok(request_id, {"batch_id": batch_id, "applied": applied, "duplicate": not applied, "skipped": skipped})
+
         if api == "GetBuyerPurchases":
             # MakePurchase not required, so purchases are empty in PA1
-            session_id = str(req.get("session_id") or payload.get("session_id") or "")
-            if not session_id:
-                return make_err(request_id, Err(BAD_REQUEST, "session_id required"))
-            try:
-                _ = self.store.get_user_id_from_session(session_id, "buyer")
-            except ValueError:
-                return make_err(request_id, Err(UNAUTHORIZED, "Invalid session"))
+            if caller is not None:
+                if caller[0] != "buyer":
+                    return make_err(request_id, Err(UNAUTHORIZED, "Not a buyer."))
+            elif self.identity is not None:
+                return make_err(request_id, Err(UNAUTHORIZED, "GetBuyerPurchases needs a signed identity (internal_auth)"))
+            else:
+                session_id = str(req.get("session_id") or payload.get("session_id") or "")
+                if not session_id:
+                    return make_err(request_id, Err(BAD_REQUEST, "session_id required"))
+                try:
+                    _ = self.store.get_user_id_from_session(session_id, "buyer")
+                except ValueError:
+                    return make_err(request_id, Err(UNAUTHORIZED, "Invalid session"))
             return make_ok(request_id, {"purchases": [], "note": "MakePurchase not implemented in assignment 1, so purchase history remains empty."})
 
         return make_err(request_id, Err(BAD_REQUEST, f"Unknown API: {api}"))
@@ -3,27 +3,52 @@ from __future__ import annotations
 import argparse
 import socket
 import threading
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..common.config import load_config, get_endpoint
+from ..common.idempotency import IdempotencyCache
+from ..common.identity import ServiceIdentity
 from ..common.logging_utils import setup_logging
-from ..common.protocol import recv_json, send_json, safe_handle
+from ..common.profiling import configure_profiling, profiled
+from ..common.protocol import compression_stats, configure_compression, format_addr, listen_socket, recv_json_sized, send_response, safe_handle
+from ..common.shutdown import run_at_exit
+from ..common.slowlog import SlowRequestLog
+from ..common.stats import ABORTED, configure_lock_profiling, init_service_stats, lock_profiles, log_lock_profiles_at_exit, service_stats
+from ..common.tracing import begin_trace, configure_tracing, end_trace, span
 from .store import CustomerStore
-from .handlers import CustomerHandlers
+from .handlers import CustomerHandlers, MUTATING_APIS
 
 
 logger = setup_logging("customer_db")
 
 
-def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: CustomerHandlers) -> None:
+def client_thread(
+    conn: socket.socket, addr: Tuple[str, int], handlers: CustomerHandlers, dedup: Optional[IdempotencyCache] = None
+) -> None:
+    stats = service_stats()
     try:
         while True:
-            req = recv_json(conn)
-            resp = safe_handle(handlers.handle, req)
-            send_json(conn, resp)
-    except Exception:
-        # client disconnect or error
+            req, n_in = recv_json_sized(conn)
+            call = stats.begin(req)
+            trace = begin_trace(req)
+            # counted as ABORTED unless the reply goes out (client gone, stream cut, ...)
+            code: Optional[str] = ABORTED
+            n_out = 0
+            try:
+                with profiled():
+                    with span("handle", api=req.get("api")):
+                        resp = safe_handle(handlers.handle, req, dedup)
+                    call.handled()
+                    with span("reply"):
+                        n_out, code = send_response(conn, req, resp, trace)
+            finally:
+                stats.end(call, code, n_in, n_out)
+                end_trace(trace)
+    except ConnectionError:
+        # client disconnect
         pass
+    except Exception as e:
+        logger.warning(f"Dropping connection from {addr}: {type(e).__name__}: {e}")
     finally:
         try:
             conn.close()
@@ -31,17 +56,20 @@ def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: Customer
             pass
 
 
-def serve(host: str, port: int, store: CustomerStore) -> None:
-    handlers = CustomerHandlers(store)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((host, port))
-        s.listen(512)
-        logger.info(f"Customer DB listening on {host}:{port}")
+def serve(
+    host: str,
+    port: int,
+    store: CustomerStore,
+    dedup: Optional[IdempotencyCache] = None,
+    identity: Optional[ServiceIdentity] = None,
+) -> None:
+    handlers = CustomerHandlers(store, identity)
+    with listen_socket(host, port) as s:
+        logger.info(f"Customer DB listening on {format_addr(host, port)}")
         while True:
             conn, addr = s.accept()
             conn.settimeout(None)
-            t = threading.Thread(target=client_thread, args=(conn, addr, handlers), daemon=True)
+            t = threading.Thread(target=client_thread, args=(conn, addr, handlers, dedup), daemon=True)
             t.start()
 
 
@@ -50,9 +78,34 @@ def main() -> None:
     ap.add_argument("--config", required=True)
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
+    configure_tracing("customer_db", cfg.tracing)
+    configure_profiling("customer_db", cfg.customer_db)
     ep = get_endpoint(cfg.customer_db)
-    store = CustomerStore(data_path=str(cfg.customer_db["data_path"]), session_timeout_s=cfg.session_timeout_seconds)
-    serve(ep.host, ep.port, store)
+    store = CustomerStore(
+        data_path=str(cfg.customer_db["data_path"]),
+        session_timeout_s=cfg.session_timeout_seconds,
+        session_grace_s=float(cfg.customer_db.get("session_grace_seconds", 60)),
+        feedback_flush_interval_s=float(cfg.customer_db.get("feedback_flush_interval_seconds", 1.0)),
+    )
+    store.start_feedback_flusher()
+    # votes still pending at shutdown were already acknowledged: apply them on the way out
+    run_at_exit(store.flush_feedback)
+    store.start_session_sweeper(
+        interval_s=float(cfg.customer_db.get("session_sweep_interval_seconds", 5)),
+        max_batch=int(cfg.customer_db.get("session_sweep_batch", 1000)),
+    )
+    dedup = IdempotencyCache.from_config(MUTATING_APIS, cfg.customer_db)
+    stats = init_service_stats("customer_db")
+    stats.add_section("transport", compression_stats)
+    stats.add_section("idempotency", dedup.stats)
+    stats.start_log_dump(float(cfg.customer_db.get("stats_log_interval_seconds", 0)), logger)
+    stats.slow_log = SlowRequestLog.from_config(cfg.customer_db, logger)
+    configure_lock_profiling(bool(cfg.customer_db.get("lock_profiling", False)))
+    top_n = int(cfg.customer_db.get("lock_profiling_top", 10))
+    stats.add_section("locks", lambda: lock_profiles(top_n))
+    log_lock_profiles_at_exit(logger, top_n)
+    serve(ep.host, ep.port, store, dedup, ServiceIdentity.from_config(cfg))
 
 
 if __name__ == "__main__":
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+import heapq
 import json
 import threading
-from typing import Dict, Any, Optional, Tuple, Literal
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple, Literal
 
 from .models import Buyer, Seller, Session, Feedback
+from ..common.counters import CounterAggregator
 from ..common.ids import new_session_id
+from ..common.stats import TimedRLock
+from ..common.tracing import span
 from ..common.time_utils import now_s
 
 import os
@@ -16,11 +21,20 @@ from pathlib import Path
 
 
 class CustomerStore:
-    def __init__(self, data_path: str, session_timeout_s: int):
+    def __init__(
+        self,
+        data_path: str,
+        session_timeout_s: int,
+        session_grace_s: float = 60.0,
+        feedback_flush_interval_s: float = 0.0,
+        max_applied_batches: int = 256,
+    ):
         self.data_path = data_path
         self.session_timeout_s = session_timeout_s
+        # expired sessions linger this long so a returning client still gets SESSION_EXPIRED
+        self.session_grace_s = float(session_grace_s)
 
-        self._lock = threading.RLock()
+        self._lock = TimedRLock("customer_store")
         self._next_seller_id = 1
         self._next_buyer_id = 1
 
@@ -30,6 +44,20 @@ class CustomerStore:
         self.buyer_by_username: Dict[str, int] = {}
 
         self.sessions: Dict[str, Session] = {}
+        # min-heap of (evict_at_s, session_id); entries are lazy and re-checked when popped
+        self._session_heap: List[Tuple[float, str]] = []
+        self.sessions_evicted = 0
+
+        # seller votes are coalesced here and applied every feedback_flush_interval_s
+        # (0 = apply and persist on every vote)
+        self.feedback_flush_interval_s = float(feedback_flush_interval_s)
+        self._votes: CounterAggregator[int] = CounterAggregator()
+
+        # batch_ids already applied by UpdateSellerFeedbackBatch (dedup for retried batches).
+        # They go into every snapshot, so the window stays small: an outbox only re-sends its
+        # oldest unacked batch, so a few hundred ids cover every frontend
+        self.max_applied_batches = int(max_applied_batches)
+        self._applied_batches: "OrderedDict[str, None]" = OrderedDict()
 
         self._load()
 
@@ -69,23 +97,33 @@ class CustomerStore:
                 self.buyer_by_username[buyer.username] = buyer.buyer_id
 
             for ss in raw.get("sessions", []):
+                # older snapshots kept logged-out sessions around; drop them on load
+                if not bool(ss.get("active", True)):
+                    continue
                 sess = Session(
                     session_id=str(ss["session_id"]),
                     user_type=str(ss["user_type"]),
                     user_id=int(ss["user_id"]),
                     last_activity_s=float(ss["last_activity_s"]),
-                    active=bool(ss.get("active", True)),
+                    active=True,
                 )
                 self.sessions[sess.session_id] = sess
+                self._session_heap.append((self._evict_at(sess), sess.session_id))
+            heapq.heapify(self._session_heap)
+
+            # newest last; an older snapshot may hold more than the current window
+            for batch_id in raw.get("applied_feedback_batches", [])[-self.max_applied_batches :]:
+                self._applied_batches[str(batch_id)] = None
 
     def _save(self) -> None:
-        with self._lock:
+        with self._lock, span("save"):
             raw = {
                 "next_seller_id": self._next_seller_id,
                 "next_buyer_id": self._next_buyer_id,
                 "sellers": [s.to_dict() for s in self.sellers_by_id.values()],
                 "buyers": [b.to_dict() for b in self.buyers_by_id.values()],
                 "sessions": [s.to_dict() for s in self.sessions.values()],
+                "applied_feedback_batches": list(self._applied_batches.keys()),
             }
 
             # Unique temp file avoids Windows collisions/locks
@@ -151,6 +189,7 @@ class CustomerStore:
             session_id = new_session_id()
             sess = Session(session_id=session_id, user_type=user_type, user_id=user_id, last_activity_s=now_s(), active=True)
             self.sessions[session_id] = sess
+            heapq.heappush(self._session_heap, (self._evict_at(sess), session_id))
             self._save()
             return session_id, user_id
 
@@ -159,9 +198,59 @@ class CustomerStore:
             sess = self.sessions.get(session_id)
             if not sess or not sess.active:
                 return False
-            sess.active = False
+            # a logged-out session is indistinguishable from an unknown one, so drop it now
+            # (its heap entry is skipped when popped)
+            del self.sessions[session_id]
             self._save()
             return True
+
+    def _evict_at(self, sess: Session) -> float:
+        return sess.last_activity_s + self.session_timeout_s + self.session_grace_s
+
+    def sweep_sessions(self, max_batch: int = 1000) -> int:
+        """
+        Evicts up to max_batch sessions that are idle past timeout + grace.
+        Returns the number evicted; persists once per batch, and only if something changed.
+        """
+        evicted = 0
+        with self._lock:
+            now = now_s()
+            heap = self._session_heap
+            while heap and evicted < max_batch and heap[0][0] <= now:
+                _, session_id = heapq.heappop(heap)
+                sess = self.sessions.get(session_id)
+                if sess is None:
+                    continue
+                evict_at = self._evict_at(sess)
+                if evict_at > now:
+                    # touched since this entry was pushed; requeue at the real deadline
+                    heapq.heappush(heap, (evict_at, session_id))
+                    continue
+                del self.sessions[session_id]
+                evicted += 1
+            if len(heap) > 2 * len(self.sessions) + 1024:
+                # mostly stale entries from logouts; rebuild from the live table
+                self._session_heap = [(self._evict_at(ss), sid) for sid, ss in self.sessions.items()]
+                heapq.heapify(self._session_heap)
+            if evicted:
+                self.sessions_evicted += evicted
+                self._save()
+        return evicted
+
+    def start_session_sweeper(self, interval_s: float = 5.0, max_batch: int = 1000) -> threading.Thread:
+        def loop() -> None:
+            while True:
+                try:
+                    n = self.sweep_sessions(max_batch)
+                except Exception:
+                    n = 0
+                # a full batch means there is likely a backlog; keep going without sleeping
+                if n < max_batch:
+                    time.sleep(interval_s)
+
+        t = threading.Thread(target=loop, name="session-sweeper", daemon=True)
+        t.start()
+        return t
         
     def _replace_with_retry(self, src_tmp: str, dst: str, retries: int = 30, delay_s: float = 0.02) -> None:
         # Force types in case something passed as string
@@ -192,8 +281,8 @@ class CustomerStore:
             now = now_s()
             idle = now - sess.last_activity_s
             if idle >= self.session_timeout_s:
-                # expire
-                sess.active = False
+                # expire; report it once, then forget the session
+                del self.sessions[session_id]
                 self._save()
                 return False, sess.user_type, sess.user_id, 0
             sess.last_activity_s = now
@@ -206,19 +295,63 @@ class CustomerStore:
             seller = self.sellers_by_id.get(seller_id)
             if not seller:
                 raise ValueError("seller not found")
-            return seller.feedback.thumbs_up, seller.feedback.thumbs_down
+            pu, pd = self._votes.pending(seller_id)
+            return seller.feedback.thumbs_up + pu, seller.feedback.thumbs_down + pd
 
     def update_seller_feedback(self, seller_id: int, vote: Literal["up", "down"]) -> Tuple[int, int]:
-        with self._lock:
+        # sellers are never removed, so a lock-free lookup is safe
+        seller = self.sellers_by_id.get(seller_id)
+        if not seller:
+            raise ValueError("seller not found")
+        up, down = self._votes.add(seller_id, vote, base=lambda: (seller.feedback.thumbs_up, seller.feedback.thumbs_down))
+        if self.feedback_flush_interval_s <= 0:
+            self.flush_feedback()
+        return up, down
+
+    def _apply_feedback(self, batch: Dict[int, Tuple[int, int]]) -> None:
+        for seller_id, (up, down) in batch.items():
             seller = self.sellers_by_id.get(seller_id)
-            if not seller:
-                raise ValueError("seller not found")
-            if vote == "up":
-                seller.feedback.thumbs_up += 1
-            else:
-                seller.feedback.thumbs_down += 1
+            if seller is None:
+                continue
+            seller.feedback.thumbs_up += up
+            seller.feedback.thumbs_down += down
+
+    def flush_feedback(self) -> int:
+        """Applies pending seller votes and persists once. Returns the number of sellers touched."""
+        with self._lock:
+            n = self._votes.flush(self._apply_feedback)
+            if n:
+                self._save()
+            return n
+
+    def apply_seller_feedback_batch(self, batch_id: str, deltas: List[Dict[str, Any]]) -> Tuple[bool, int]:
+        """
+        Applies aggregated seller votes sent by a frontend outbox, at most once per batch_id.
+        Returns (applied, skipped): applied=False means the batch was a duplicate; skipped
+        counts deltas for unknown sellers, which are dropped rather than retried forever.
+        """
+        with self._lock:
+            if batch_id in self._applied_batches:
+                return False, 0
+            skipped = 0
+            for d in deltas:
+                seller = self.sellers_by_id.get(int(d["seller_id"]))
+                if seller is None:
+                    skipped += 1
+                    continue
+                seller.feedback.thumbs_up += int(d.get("thumbs_up", 0))
+                seller.feedback.thumbs_down += int(d.get("thumbs_down", 0))
+            self._applied_batches[batch_id] = None
+            while len(self._applied_batches) > self.max_applied_batches:
+                self._applied_batches.popitem(last=False)
+            # counters and the dedup record land in the same snapshot
             self._save()
-            return seller.feedback.thumbs_up, seller.feedback.thumbs_down
+            return True, skipped
+
+    def start_feedback_flusher(self) -> Optional[threading.Thread]:
+        if self.feedback_flush_interval_s <= 0:
+            return None
+        return self._votes.start_flusher(self.flush_feedback, self.feedback_flush_interval_s)
 
     def get_user_id_from_session(self, session_id: str, expected: Literal["buyer", "seller"]) -> int:
         valid, user_type, user_id, _ = self.validate_and_touch(session_id)
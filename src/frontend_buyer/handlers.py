@@ -1,31 +1,117 @@
 from __future__ import annotations
 
-from typing import Dict, Any, Optional
-
-from ..common.protocol import make_ok, make_err, RpcClient
-from ..common.errors import Err, BAD_REQUEST, UNAUTHORIZED, SESSION_EXPIRED
-
+import json
+from typing import Callable, Dict, Any, List, Optional
+
+from ..common.protocol import compression_stats, make_ok, make_err, relay_stream, NO_RETRY, RetryPolicy, RpcClient
+from ..common.errors import Err, BAD_REQUEST, FORBIDDEN, UNAUTHORIZED, SESSION_EXPIRED
+from ..common.hedging import Hedger
+from ..common.identity import ServiceIdentity
+from ..common.profiling import profiling_allowed, run_profile
+from ..common.sharding import ProductRouter, ReplicaSpec, ShardMap
+from ..common.singleflight import SingleFlight
+from ..common.stats import service_stats
+from .outbox import FeedbackOutbox
+
+
+# APIs whose replies are remembered by idempotency key, so a retry does not apply them twice
+MUTATING_APIS = (
+    "CreateAccount",
+    "Login",
+    "Logout",
+    "AddItemToCart",
+    "RemoveItemFromCart",
+    "SaveCart",
+    "ClearCart",
+    "ProvideFeedback",
+    "MakePurchase",
+)
 
 class BuyerFrontendHandlers:
     """
     Stateless frontend: does NOT store session/cart/item state.
     Every request requiring auth is validated against CustomerDB (ValidateAndTouchSession).
     All persistent state lives in CustomerDB/ProductDB.
+
+    With a ProductDB shard map, item requests go to the shard owning the item's category and
+    cart requests to the buyer's cart shard. AddItemToCart for an item on another shard checks
+    the item there first and then adds the line on the cart shard; this is not atomic, so the
+    item can sell out in between (same as a stale cart line without sharding).
+
+    SearchItemsForSale and GetItem may be served by a ProductDB read replica (bounded
+    staleness); cart operations, feedback and the AddItemToCart item check use the primary.
+
+    Identical concurrent SearchItemsForSale / GetItem / GetSellerRating requests (after
+    session validation) share one backend call; see GetCoalescingStats.
+
+    With a Hedger and ProductDB read replicas, SearchItemsForSale / GetItem calls that run
+    longer than the API's recent tail latency are sent a second time to another endpoint
+    (the next replica, or the primary) and the first reply wins; see GetHedgeStats.
+    Reads with a single endpoint are never hedged.
+
+    With internal_auth configured, backend calls carry a signed identity of the validated
+    buyer instead of the session id, so the session is validated once per request.
     """
 
-    def __init__(self, customer_host: str, customer_port: int, product_host: str, product_port: int):
-        self.customer = RpcClient(customer_host, customer_port)
-        self.product = RpcClient(product_host, product_port)
+    def __init__(
+        self,
+        customer_host: str,
+        customer_port: int,
+        product_host: str,
+        product_port: int,
+        feedback_outbox: Optional[FeedbackOutbox] = None,
+        shard_map: Optional[ShardMap] = None,
+        replicas: Optional[List[ReplicaSpec]] = None,
+        hedger: Optional[Hedger] = None,
+        identity: Optional[ServiceIdentity] = None,
+        retry: RetryPolicy = NO_RETRY,
+    ):
+        # retry: rpc_retry policy for CustomerDB and the ProductDB primaries
+        self.customer = RpcClient(customer_host, customer_port, retry=retry)
+        # replicas: read replicas of an unsharded ProductDB (sharded replicas come from shard_map)
+        self.products = ProductRouter.build(product_host, product_port, shard_map, replicas, retry=retry)
+        # when set, seller votes are queued locally instead of calling CustomerDB inline
+        self.feedback_outbox = feedback_outbox
+        self.reads = SingleFlight()
+        self.hedger = hedger
+        self.identity = identity
 
     def _validate(self, request_id: str, session_id: str) -> Dict[str, Any]:
         resp = self.customer.call("ValidateAndTouchSession", {"request_id": request_id, "session_id": session_id}, role=None)
         return resp
 
+    def _coalesced(self, api: str, request_id: str, payload: Dict[str, Any], fn: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+        body = {k: v for k, v in payload.items() if k != "request_id"}
+        key = (api, json.dumps(body, sort_keys=True, separators=(",", ":")))
+        resp = self.reads.do(key, fn)
+        # every waiter gets its own envelope; the data is shared read-only
+        return {**resp, "request_id": request_id}
+
+    def _hedged(self, api: str, fn: Callable[[], Dict[str, Any]], hedge: Optional[Callable[[], Dict[str, Any]]]) -> Dict[str, Any]:
+        # fn, hedge: the same read on two endpoints (ProductRouter.hedged_*); hedge is None
+        # when there is only one
+        if self.hedger is None or hedge is None:
+            return fn()
+        return self.hedger.call(api, fn, hedge)
+
     def handle(self, req: Dict[str, Any]) -> Dict[str, Any]:
         api = req.get("api")
         request_id = str(req.get("request_id", "req"))
         payload = req.get("payload") or {}
 
+        if api == "GetStats":
+            return make_ok(request_id, service_stats().snapshot())
+        if api == "Profile":
+            if not profiling_allowed():
+                return make_err(request_id, Err(FORBIDDEN, "Profile is disabled on this service (profile_api_enabled)"))
+            return make_ok(request_id, run_profile(payload))
+        if api == "GetCoalescingStats":
+            return make_ok(request_id, self.reads.stats())
+        if api == "GetHedgeStats":
+            return make_ok(request_id, self.hedger.stats() if self.hedger is not None else {"enabled": False})
+        if api == "GetTransportStats":
+            return make_ok(request_id, compression_stats())
+
         # Unauthenticated
         if api == "CreateAccount":
             resp = self.customer.call("CreateAccount", {"request_id": request_id, **payload}, role="buyer")
@@ -46,42 +132,77 @@ class BuyerFrontendHandlers:
         if user["user_type"] != "buyer":
             return make_err(request_id, Err(UNAUTHORIZED, "Session is not a buyer session."))
         buyer_id = int(user["user_id"])
+        ident = self.identity.issue("buyer", buyer_id) if self.identity is not None else None
 
         if api == "Logout":
             # First logout in CustomerDB
             out = self.customer.call("Logout", {"request_id": request_id, "session_id": session_id}, role=None)
             # Cleanup cart if not saved
-            _ = self.product.call("LogoutCleanup", {"request_id": request_id, "buyer_id": buyer_id}, role=None)
+            _ = self.products.for_buyer(buyer_id).call("LogoutCleanup", {"request_id": request_id, "buyer_id": buyer_id}, role=None, identity=ident)
             return out
 
+        if api == "SearchItemsForSale" and payload.get("stream"):
+            # large result: pass ProductDB's chunks through as they arrive (no coalescing/hedging)
+            frames = self.products.read_category_stream(payload["item_category"], "SearchItemsForSale", {"request_id": request_id, **payload})
+            return relay_stream(request_id, frames)
+
         if api == "SearchItemsForSale":
-            resp = self.product.call("SearchItemsForSale", {"request_id": request_id, **payload}, role=None)
+            resp = self._coalesced(
+                api,
+                request_id,
+                payload,
+                lambda: self._hedged(
+                    api,
+                    *self.products.hedged_category(payload["item_category"], "SearchItemsForSale", {"request_id": request_id, **payload}),
+                ),
+            )
             return resp
 
         if api == "GetItem":
-            resp = self.product.call("GetItem", {"request_id": request_id, **payload}, role=None)
+            resp = self._coalesced(
+                api,
+                request_id,
+                payload,
+                lambda: self._hedged(
+                    api,
+                    *self.products.hedged_item(payload["item_id"], "GetItem", {"request_id": request_id, **payload}),
+                ),
+            )
             return resp
 
         if api == "AddItemToCart":
-            p = {"request_id": request_id, "buyer_id": buyer_id, **payload}
-            resp = self.product.call("AddItemToCart", p, role=None)
+            cart_db = self.products.for_buyer(buyer_id)
+            item_db = self.products.for_item(payload["item_id"])
+            p = {"request_id": request_id, "buyer_id": buyer_id, **payload, "item_verified": False}
+            if item_db is not cart_db:
+                # item lives on another shard: check it there, the cart shard cannot
+                r = item_db.call("GetItem", {"request_id": request_id, "item_id": payload["item_id"]}, role=None)
+                if not r.get("ok", False):
+                    return r
+                if int(r["data"]["quantity"]) <= 0:
+                    return make_err(request_id, Err(BAD_REQUEST, "item unavailable"))
+                p["item_verified"] = True
+            resp = cart_db.call("AddItemToCart", p, role=None, identity=ident)
             return resp
 
         if api == "RemoveItemFromCart":
             p = {"request_id": request_id, "buyer_id": buyer_id, **payload}
-            resp = self.product.call("RemoveItemFromCart", p, role=None)
+            resp = self.products.for_buyer(buyer_id).call("RemoveItemFromCart", p, role=None, identity=ident)
             return resp
 
         if api == "SaveCart":
-            resp = self.product.call("SaveCart", {"request_id": request_id, "buyer_id": buyer_id}, role=None)
+            resp = self.products.for_buyer(buyer_id).call("SaveCart", {"request_id": request_id, "buyer_id": buyer_id}, role=None, identity=ident)
             return resp
 
         if api == "ClearCart":
-            resp = self.product.call("ClearCart", {"request_id": request_id, "buyer_id": buyer_id}, role=None)
+            resp = self.products.for_buyer(buyer_id).call("ClearCart", {"request_id": request_id, "buyer_id": buyer_id}, role=None, identity=ident)
             return resp
 
         if api == "DisplayCart":
-            resp = self.product.call("DisplayCart", {"request_id": request_id, "buyer_id": buyer_id}, role=None)
+            p = {"request_id": request_id, "buyer_id": buyer_id}
+            if "if_none_match" in payload:
+                p["if_none_match"] = payload["if_none_match"]
+            resp = self.products.for_buyer(buyer_id).call("DisplayCart", p, role=None, identity=ident)
             return resp
 
         if api == "ProvideFeedback":
@@ -89,21 +210,32 @@ class BuyerFrontendHandlers:
             if vote not in ("up", "down"):
                 return make_err(request_id, Err(BAD_REQUEST, "vote must be up or down"))
             # Update item feedback in ProductDB (returns seller_id)
-            r1 = self.product.call("ProvideFeedback", {"request_id": request_id, **payload}, role=None)
+            r1 = self.products.for_item(payload["item_id"]).call("ProvideFeedback", {"request_id": request_id, **payload}, role=None)
             if not r1.get("ok", False):
                 return r1
             seller_id = int(r1["data"]["seller_id"])
             # Update seller feedback in CustomerDB
-            _ = self.customer.call("UpdateSellerFeedback", {"request_id": request_id, "seller_id": seller_id, "vote": vote}, role=None)
+            if self.feedback_outbox is not None:
+                self.feedback_outbox.enqueue(seller_id, vote)
+            else:
+                _ = self.customer.call("UpdateSellerFeedback", {"request_id": request_id, "seller_id": seller_id, "vote": vote}, role=None)
             return r1
 
         if api == "GetSellerRating":
             # by seller_id
-            resp = self.customer.call("GetSellerRating", {"request_id": request_id, **payload}, role=None)
+            resp = self._coalesced(
+                api,
+                request_id,
+                payload,
+                lambda: self.customer.call("GetSellerRating", {"request_id": request_id, **payload}, role=None),
+            )
             return resp
 
         if api == "GetBuyerPurchases":
-            resp = self.customer.call("GetBuyerPurchases", {"request_id": request_id, "session_id": session_id}, role=None)
+            if ident is not None:
+                resp = self.customer.call("GetBuyerPurchases", {"request_id": request_id}, role=None, identity=ident)
+            else:
+                resp = self.customer.call("GetBuyerPurchases", {"request_id": request_id, "session_id": session_id}, role=None)
             return resp
 
         if api == "MakePurchase":
@@ -0,0 +1,258 @@
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from ..common.errors import DEADLINE_EXCEEDED, INTERNAL, UNAVAILABLE
+from ..common.logging_utils import setup_logging
+from ..common.protocol import RpcClient
+
+
+logger = setup_logging("buyer_frontend.outbox")
+
+# CustomerDB error codes worth retrying a batch on; any other rejection would repeat forever
+_TRANSIENT_CODES = {UNAVAILABLE, DEADLINE_EXCEEDED, INTERNAL}
+
+
+class FeedbackOutbox:
+    """
+    Durable queue of seller votes waiting to be applied in CustomerDB.
+
+    ProvideFeedback only appends the vote to a local journal; a background sender groups
+    pending votes into batches, sends them with UpdateSellerFeedbackBatch and retries with
+    backoff until acknowledged. The journal records which votes went into which batch, so a
+    restarted frontend re-sends the same batch_id and CustomerDB drops the duplicate.
+    A batch CustomerDB rejects for good, or that failed max_attempts times in a row, is
+    written to the dead-letter file (for inspection or replay) and acked, so it no longer
+    blocks the batches behind it.
+
+    Journal records (one JSON object per line):
+      {"op": "vote", "id": str, "seller_id": int, "vote": "up"|"down"}
+      {"op": "batch", "batch_id": str, "ids": [vote ids], "deltas": [{"seller_id", "thumbs_up", "thumbs_down"}]}
+      {"op": "ack", "batch_id": str}
+
+    Dead-letter records (dead_letter_path, default path + ".dead"):
+      {"batch_id": str, "deltas": [...], "attempts": int, "error": str, "at": float}
+    """
+
+    def __init__(
+        self,
+        path: str,
+        customer: RpcClient,
+        flush_interval_s: float = 0.5,
+        max_batch: int = 500,
+        max_backoff_s: float = 10.0,
+        fsync: bool = False,
+        compact_after_lines: int = 100_000,
+        max_attempts: int = 20,
+        dead_letter_path: Optional[str] = None,
+    ):
+        self.path = path
+        self.customer = customer
+        self.flush_interval_s = float(flush_interval_s)
+        self.max_batch = int(max_batch)
+        self.max_backoff_s = float(max_backoff_s)
+        self.fsync = bool(fsync)
+        self.compact_after_lines = int(compact_after_lines)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.dead_letter_path = dead_letter_path or f"{path}.dead"
+
+        self._cv = threading.Condition()
+        # vote id -> (seller_id, vote), in arrival order
+        self._pending: Dict[str, Tuple[int, str]] = {}
+        # batches formed but not yet acked, oldest first: (batch_id, vote ids, deltas)
+        self._inflight: List[Tuple[str, List[str], List[Dict[str, int]]]] = []
+        self._journal_lines = 0
+        # failed sends of the oldest in-flight batch (the only one being sent)
+        self._attempts = 0
+
+        self.votes_enqueued = 0
+        self.batches_sent = 0
+        self.send_failures = 0
+        self.batches_dead_lettered = 0
+
+        self._recover()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._journal = open(self.path, "a", encoding="utf-8")
+
+    def _recover(self) -> None:
+        votes: Dict[str, Tuple[int, str]] = {}
+        batches: Dict[str, Tuple[List[str], List[Dict[str, int]]]] = {}
+        acked = set()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        # torn last line after a crash
+                        continue
+                    self._journal_lines += 1
+                    op = rec.get("op")
+                    if op == "vote":
+                        votes[str(rec["id"])] = (int(rec["seller_id"]), str(rec["vote"]))
+                    elif op == "batch":
+                        batches[str(rec["batch_id"])] = ([str(x) for x in rec["ids"]], list(rec["deltas"]))
+                    elif op == "ack":
+                        acked.add(str(rec["batch_id"]))
+        except FileNotFoundError:
+            return
+
+        # un-acked batches are re-sent verbatim (same batch_id) so CustomerDB can dedup them
+        batched = set()
+        for batch_id, (ids, deltas) in batches.items():
+            batched.update(ids)
+            if batch_id not in acked:
+                self._inflight.append((batch_id, ids, deltas))
+        self._pending = {vid: v for vid, v in votes.items() if vid not in batched}
+        if self._inflight or self._pending:
+            logger.info(f"Outbox recovered {len(self._pending)} pending votes and {len(self._inflight)} unacked batches")
+
+    def _append(self, rec: Dict[str, Any]) -> None:
+        self._journal.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._journal_lines += 1
+
+    @staticmethod
+    def _deltas(votes: List[Tuple[int, str]]) -> List[Dict[str, int]]:
+        by_seller: Dict[int, List[int]] = {}
+        for seller_id, vote in votes:
+            d = by_seller.setdefault(seller_id, [0, 0])
+            if vote == "up":
+                d[0] += 1
+            else:
+                d[1] += 1
+        return [{"seller_id": sid, "thumbs_up": up, "thumbs_down": down} for sid, (up, down) in by_seller.items()]
+
+    def enqueue(self, seller_id: int, vote: str) -> None:
+        vote_id = uuid.uuid4().hex
+        with self._cv:
+            self._append({"op": "vote", "id": vote_id, "seller_id": int(seller_id), "vote": vote})
+            self._pending[vote_id] = (int(seller_id), vote)
+            self.votes_enqueued += 1
+            if len(self._pending) >= self.max_batch:
+                self._cv.notify()
+
+    def backlog(self) -> int:
+        with self._cv:
+            return len(self._pending) + sum(len(b[1]) for b in self._inflight)
+
+    def _next_batch(self) -> Optional[Tuple[str, List[str], List[Dict[str, int]]]]:
+        with self._cv:
+            if self._inflight:
+                return self._inflight[0]
+            if not self._pending:
+                return None
+            ids = list(self._pending.keys())[: self.max_batch]
+            batch_id = uuid.uuid4().hex
+            deltas = self._deltas([self._pending.pop(i) for i in ids])
+            self._append({"op": "batch", "batch_id": batch_id, "ids": ids, "deltas": deltas})
+            self._inflight.append((batch_id, ids, deltas))
+            return self._inflight[0]
+
+    def _ack(self, batch_id: str) -> None:
+        with self._cv:
+            self._append({"op": "ack", "batch_id": batch_id})
+            self._inflight = [b for b in self._inflight if b[0] != batch_id]
+            self._attempts = 0
+            if not self._pending and not self._inflight:
+                # nothing outstanding: restart the journal instead of letting it grow forever
+                self._journal.seek(0)
+                self._journal.truncate()
+                self._journal_lines = 0
+            elif self._journal_lines > self.compact_after_lines:
+                self._compact()
+
+    def _compact(self) -> None:
+        # rewrite the journal with only outstanding records; call with self._cv held
+        lines = []
+        for batch_id, ids, deltas in self._inflight:
+            lines.append({"op": "batch", "batch_id": batch_id, "ids": ids, "deltas": deltas})
+        for vote_id, (seller_id, vote) in self._pending.items():
+            lines.append({"op": "vote", "id": vote_id, "seller_id": seller_id, "vote": vote})
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for rec in lines:
+                f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+        self._journal.close()
+        os.replace(tmp, self.path)
+        self._journal = open(self.path, "a", encoding="utf-8")
+        self._journal_lines = len(lines)
+
+    def _dead_letter(self, batch_id: str, deltas: List[Dict[str, int]], error: str) -> None:
+        rec = {"batch_id": batch_id, "deltas": deltas, "attempts": self._attempts, "error": error, "at": round(time.time(), 3)}
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        logger.error(f"Seller feedback batch {batch_id} dead-lettered after {self._attempts} attempts: {error}")
+        self.batches_dead_lettered += 1
+        self._ack(batch_id)
+
+    def _failed(self, batch_id: str, deltas: List[Dict[str, int]], error: str, transient: bool) -> bool:
+        self.send_failures += 1
+        self._attempts += 1
+        if transient and self._attempts < self.max_attempts:
+            logger.warning(f"Seller feedback batch {batch_id} failed (attempt {self._attempts}): {error}")
+            return False
+        self._dead_letter(batch_id, deltas, error)
+        return True
+
+    def send_once(self) -> bool:
+        """
+        Sends (or re-sends) one batch. Returns False if the batch could not be delivered
+        and should be retried after a backoff.
+        """
+        batch = self._next_batch()
+        if batch is None:
+            return True
+        batch_id, _, deltas = batch
+        try:
+            resp = self.customer.call(
+                "UpdateSellerFeedbackBatch",
+                {"request_id": f"outbox-{batch_id}", "batch_id": batch_id, "deltas": deltas},
+                role=None,
+            )
+        except Exception as e:
+            return self._failed(batch_id, deltas, f"{type(e).__name__}: {e}", transient=True)
+        if not resp.get("ok", False):
+            err = resp.get("error") or {}
+            return self._failed(batch_id, deltas, f"rejected: {err}", transient=err.get("code") in _TRANSIENT_CODES)
+        self.batches_sent += 1
+        self._ack(batch_id)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backlog": self.backlog(),
+            "batches_sent": self.batches_sent,
+            "send_failures": self.send_failures,
+            "batches_dead_lettered": self.batches_dead_lettered,
+        }
+
+    def start(self) -> threading.Thread:
+        def loop() -> None:
+            backoff = self.flush_interval_s
+            while True:
+                with self._cv:
+                    # send when a batch fills up, on every interval, or right away when retrying
+                    self._cv.wait_for(lambda: len(self._pending) >= self.max_batch or bool(self._inflight), timeout=self.flush_interval_s)
+                if self.send_once():
+                    backoff = self.flush_interval_s
+                else:
+                    time.sleep(backoff)
+                    backoff = min(max(backoff, 0.05) * 2, self.max_backoff_s)
+
+        t = threading.Thread(target=loop, name="feedback-outbox", daemon=True)
+        t.start()
+        return t
@@ -3,25 +3,53 @@ from __future__ import annotations
 import argparse
 import socket
 import threading
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..common.config import load_config, get_endpoint, get_nested_endpoint
+from ..common.hedging import Hedger
+from ..common.idempotency import IdempotencyCache
+from ..common.identity import ServiceIdentity
 from ..common.logging_utils import setup_logging
-from ..common.protocol import recv_json, send_json, safe_handle
-from .handlers import BuyerFrontendHandlers
+from ..common.profiling import configure_profiling, profiled
+from ..common.protocol import compression_stats, configure_compression, format_addr, listen_socket, recv_json_sized, send_response, safe_handle, RetryPolicy, RpcClient
+from ..common.sharding import load_replicas, load_shard_map
+from ..common.slowlog import SlowRequestLog
+from ..common.stats import ABORTED, init_service_stats, service_stats
+from ..common.tracing import begin_trace, configure_tracing, end_trace, span
+from .handlers import BuyerFrontendHandlers, MUTATING_APIS
+from .outbox import FeedbackOutbox
 
 
 logger = setup_logging("buyer_frontend")
 
 
-def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: BuyerFrontendHandlers) -> None:
+def client_thread(
+    conn: socket.socket, addr: Tuple[str, int], handlers: BuyerFrontendHandlers, dedup: Optional[IdempotencyCache] = None
+) -> None:
+    stats = service_stats()
     try:
         while True:
-            req = recv_json(conn)
-            resp = safe_handle(handlers.handle, req)
-            send_json(conn, resp)
-    except Exception:
+            req, n_in = recv_json_sized(conn)
+            call = stats.begin(req)
+            trace = begin_trace(req, root=True)
+            # counted as ABORTED unless the reply goes out (client gone, stream cut, ...)
+            code: Optional[str] = ABORTED
+            n_out = 0
+            try:
+                with profiled():
+                    with span("handle", api=req.get("api")):
+                        resp = safe_handle(handlers.handle, req, dedup)
+                    call.handled()
+                    with span("reply"):
+                        n_out, code = send_response(conn, req, resp, trace)
+            finally:
+                stats.end(call, code, n_in, n_out)
+                end_trace(trace)
+    except ConnectionError:
+        # client disconnect
         pass
+    except Exception as e:
+        logger.warning(f"Dropping connection from {addr}: {type(e).__name__}: {e}")
     finally:
         try:
             conn.close()
@@ -29,16 +57,13 @@ def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: BuyerFro
             pass
 
 
-def serve(host: str, port: int, handlers: BuyerFrontendHandlers) -> None:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((host, port))
-        s.listen(512)
-        logger.info(f"Buyer Frontend listening on {host}:{port}")
+def serve(host: str, port: int, handlers: BuyerFrontendHandlers, dedup: Optional[IdempotencyCache] = None) -> None:
+    with listen_socket(host, port) as s:
+        logger.info(f"Buyer Frontend listening on {format_addr(host, port)}")
         while True:
             conn, addr = s.accept()
             conn.settimeout(None)
-            t = threading.Thread(target=client_thread, args=(conn, addr, handlers), daemon=True)
+            t = threading.Thread(target=client_thread, args=(conn, addr, handlers, dedup), daemon=True)
             t.start()
 
 
@@ -47,13 +72,49 @@ def main() -> None:
     ap.add_argument("--config", required=True)
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
+    configure_tracing("buyer_frontend", cfg.tracing)
+    configure_profiling("buyer_frontend", cfg.buyer_frontend)
 
     ep = get_endpoint(cfg.buyer_frontend)
     cdb = get_nested_endpoint(cfg.buyer_frontend, "customer_db")
     pdb = get_nested_endpoint(cfg.buyer_frontend, "product_db")
 
-    handlers = BuyerFrontendHandlers(cdb.host, cdb.port, pdb.host, pdb.port)
-    serve(ep.host, ep.port, handlers)
+    bcfg = cfg.buyer_frontend
+    retry = RetryPolicy.from_config(cfg.rpc_retry)
+    outbox = FeedbackOutbox(
+        path=str(bcfg.get("feedback_outbox_path", "data/buyer_frontend_outbox.jsonl")),
+        customer=RpcClient(cdb.host, cdb.port, retry=retry),
+        flush_interval_s=float(bcfg.get("feedback_outbox_flush_interval_seconds", 0.5)),
+        max_batch=int(bcfg.get("feedback_outbox_max_batch", 500)),
+        fsync=bool(bcfg.get("feedback_outbox_fsync", False)),
+        max_attempts=int(bcfg.get("feedback_outbox_max_attempts", 20)),
+    )
+    outbox.start()
+
+    handlers = BuyerFrontendHandlers(
+        cdb.host,
+        cdb.port,
+        pdb.host,
+        pdb.port,
+        feedback_outbox=outbox,
+        shard_map=load_shard_map(cfg),
+        replicas=load_replicas(cfg),
+        hedger=Hedger.from_config(bcfg),
+        identity=ServiceIdentity.from_config(cfg),
+        retry=retry,
+    )
+    dedup = IdempotencyCache.from_config(MUTATING_APIS, bcfg)
+    stats = init_service_stats("buyer_frontend")
+    stats.add_section("transport", compression_stats)
+    stats.add_section("idempotency", dedup.stats)
+    stats.add_section("coalescing", handlers.reads.stats)
+    if handlers.hedger is not None:
+        stats.add_section("hedging", handlers.hedger.stats)
+    stats.add_section("feedback_outbox", outbox.stats)
+    stats.start_log_dump(float(bcfg.get("stats_log_interval_seconds", 0)), logger)
+    stats.slow_log = SlowRequestLog.from_config(bcfg, logger)
+    serve(ep.host, ep.port, handlers, dedup)
 
 
 if __name__ == "__main__":
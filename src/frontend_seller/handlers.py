@@ -1,19 +1,71 @@
 from __future__ import annotations
 
-from typing import Dict, Any
-
-from ..common.protocol import make_ok, make_err, RpcClient
-from ..common.errors import Err, BAD_REQUEST, UNAUTHORIZED
+import heapq
+import itertools
+from typing import Dict, Any, Iterator, List, Optional
+
+from ..common.protocol import (
+    DEFAULT_STREAM_CHUNK,
+    StreamedResponse,
+    compression_stats,
+    is_last_frame,
+    make_ok,
+    make_err,
+    relay_stream,
+    stream_items,
+    NO_RETRY,
+    RetryPolicy,
+    RpcClient,
+)
+from ..common.errors import Err, BAD_REQUEST, FORBIDDEN, UNAUTHORIZED
+from ..common.identity import ServiceIdentity
+from ..common.profiling import profiling_allowed, run_profile
+from ..common.sharding import ProductRouter, ShardMap
+from ..common.stats import service_stats
+
+
+# APIs whose replies are remembered by idempotency key, so a retry does not apply them twice
+MUTATING_APIS = ("CreateAccount", "Login", "Logout", "RegisterItemForSale", "ChangeItemPrice", "UpdateUnitsForSale")
+
+
+class ShardStreamError(RuntimeError):
+    pass
+
+
+def _stream_items(frames: Iterator[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    for f in frames:
+        if not f.get("ok", False):
+            err = f.get("error") or {}
+            raise ShardStreamError(f"{err.get('code')}: {err.get('message')}")
+        if is_last_frame(f):
+            return
+        yield from f["data"]["items"]
 
 
 class SellerFrontendHandlers:
     """
     Stateless frontend: validates session via CustomerDB on every authenticated request.
+    With a ProductDB shard map, item writes go to the category's shard and
+    DisplayItemsForSale is gathered from every shard.
+
+    With internal_auth configured, backend calls carry a signed identity of the validated
+    seller instead of the session id, so the session is validated once per request.
     """
 
-    def __init__(self, customer_host: str, customer_port: int, product_host: str, product_port: int):
-        self.customer = RpcClient(customer_host, customer_port)
-        self.product = RpcClient(product_host, product_port)
+    def __init__(
+        self,
+        customer_host: str,
+        customer_port: int,
+        product_host: str,
+        product_port: int,
+        shard_map: Optional[ShardMap] = None,
+        identity: Optional[ServiceIdentity] = None,
+        retry: RetryPolicy = NO_RETRY,
+    ):
+        # retry: rpc_retry policy for CustomerDB and the ProductDB primaries
+        self.customer = RpcClient(customer_host, customer_port, retry=retry)
+        self.products = ProductRouter.build(product_host, product_port, shard_map, retry=retry)
+        self.identity = identity
 
     def _validate(self, request_id: str, session_id: str) -> Dict[str, Any]:
         return self.customer.call("ValidateAndTouchSession", {"request_id": request_id, "session_id": session_id}, role=None)
@@ -23,6 +75,15 @@ class SellerFrontendHandlers:
         request_id = str(req.get("request_id", "req"))
         payload = req.get("payload") or {}
 
+        if api == "GetStats":
+            return make_ok(request_id, service_stats().snapshot())
+        if api == "Profile":
+            if not profiling_allowed():
+                return make_err(request_id, Err(FORBIDDEN, "Profile is disabled on this service (profile_api_enabled)"))
+            return make_ok(request_id, run_profile(payload))
+        if api == "GetTransportStats":
+            return make_ok(request_id, compression_stats())
+
         # Unauthenticated
         if api == "CreateAccount":
             return self.customer.call("CreateAccount", {"request_id": request_id, **payload}, role="seller")
@@ -40,27 +101,69 @@ class SellerFrontendHandlers:
         if data["user_type"] != "seller":
             return make_err(request_id, Err(UNAUTHORIZED, "Session is not a seller session."))
         seller_id = int(data["user_id"])
+        ident = self.identity.issue("seller", seller_id) if self.identity is not None else None
 
         if api == "Logout":
             return self.customer.call("Logout", {"request_id": request_id, "session_id": session_id}, role=None)
 
         if api == "GetSellerRating":
+            if ident is not None:
+                return self.customer.call("GetSellerRating", {"request_id": request_id}, role=None, identity=ident)
             return self.customer.call("GetSellerRating", {"request_id": request_id, "session_id": session_id}, role=None)
 
         if api == "RegisterItemForSale":
             p = {"request_id": request_id, "seller_id": seller_id, **payload}
-            return self.product.call("RegisterItemForSale", p, role=None)
+            return self.products.for_category(payload["item_category"]).call("RegisterItemForSale", p, role=None, identity=ident)
 
         if api == "ChangeItemPrice":
             p = {"request_id": request_id, "seller_id": seller_id, **payload}
-            return self.product.call("ChangeItemPrice", p, role=None)
+            return self.products.for_item(payload["item_id"]).call("ChangeItemPrice", p, role=None, identity=ident)
 
         if api == "UpdateUnitsForSale":
             p = {"request_id": request_id, "seller_id": seller_id, **payload}
-            return self.product.call("UpdateUnitsForSale", p, role=None)
+            return self.products.for_item(payload["item_id"]).call("UpdateUnitsForSale", p, role=None, identity=ident)
+
+        if api == "DisplayItemsForSale" and payload.get("stream"):
+            return self._display_items_stream(request_id, seller_id, payload, ident)
 
         if api == "DisplayItemsForSale":
             p = {"request_id": request_id, "seller_id": seller_id}
-            return self.product.call("DisplayItemsForSale", p, role=None)
+            if not self.products.sharded:
+                return self.products.clients[0].call("DisplayItemsForSale", p, role=None, identity=ident)
+            # a seller's items can be in any category: gather from all shards, fail if any shard does
+            items: List[Dict[str, Any]] = []
+            for product in self.products.clients:
+                r = product.call("DisplayItemsForSale", p, role=None, identity=ident)
+                if not r.get("ok", False):
+                    return r
+                items.extend(r["data"]["items"])
+            items.sort(key=lambda x: (x["item_id"]["category"], x["item_id"]["id"]))
+            return make_ok(request_id, {"items": items})
 
         return make_err(request_id, Err(BAD_REQUEST, f"Unknown API: {api}"))
+
+    def _display_items_stream(self, request_id: str, seller_id: int, payload: Dict[str, Any], ident: Optional[Dict[str, Any]]) -> StreamedResponse:
+        chunk_size = min(max(int(payload.get("chunk_size", DEFAULT_STREAM_CHUNK)), 1), 10_000)
+        p = {"request_id": request_id, "seller_id": seller_id, "chunk_size": chunk_size}
+        if not self.products.sharded:
+            return relay_stream(request_id, self.products.clients[0].call_stream("DisplayItemsForSale", p, role=None, identity=ident))
+        # every shard streams its items sorted by item_id; merge them into one sorted stream
+        # without holding more than a chunk from each shard
+        streams = [c.call_stream("DisplayItemsForSale", p, role=None, identity=ident) for c in self.products.clients]
+        merged = heapq.merge(*(_stream_items(s) for s in streams), key=lambda x: (x["item_id"]["category"], x["item_id"]["id"]))
+        final = {"count": 0}
+
+        def chunks() -> Iterator[List[Dict[str, Any]]]:
+            try:
+                while True:
+                    chunk = list(itertools.islice(merged, chunk_size))
+                    if not chunk:
+                        return
+                    # final is sent after the last chunk, so the count is complete by then
+                    final["count"] += len(chunk)
+                    yield chunk
+            finally:
+                for s in streams:
+                    s.close()
+
+        return stream_items(request_id, chunks(), final)
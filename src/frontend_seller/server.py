@@ -3,25 +3,51 @@ from __future__ import annotations
 import argparse
 import socket
 import threading
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..common.config import load_config, get_endpoint, get_nested_endpoint
+from ..common.idempotency import IdempotencyCache
+from ..common.identity import ServiceIdentity
 from ..common.logging_utils import setup_logging
-from ..common.protocol import recv_json, send_json, safe_handle
-from .handlers import SellerFrontendHandlers
+from ..common.profiling import configure_profiling, profiled
+from ..common.protocol import compression_stats, configure_compression, format_addr, listen_socket, recv_json_sized, send_response, safe_handle, RetryPolicy
+from ..common.sharding import load_shard_map
+from ..common.slowlog import SlowRequestLog
+from ..common.stats import ABORTED, init_service_stats, service_stats
+from ..common.tracing import begin_trace, configure_tracing, end_trace, span
+from .handlers import SellerFrontendHandlers, MUTATING_APIS
 
 
 logger = setup_logging("seller_frontend")
 
 
-def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: SellerFrontendHandlers) -> None:
+def client_thread(
+    conn: socket.socket, addr: Tuple[str, int], handlers: SellerFrontendHandlers, dedup: Optional[IdempotencyCache] = None
+) -> None:
+    stats = service_stats()
     try:
         while True:
-            req = recv_json(conn)
-            resp = safe_handle(handlers.handle, req)
-            send_json(conn, resp)
-    except Exception:
+            req, n_in = recv_json_sized(conn)
+            call = stats.begin(req)
+            trace = begin_trace(req, root=True)
+            # counted as ABORTED unless the reply goes out (client gone, stream cut, ...)
+            code: Optional[str] = ABORTED
+            n_out = 0
+            try:
+                with profiled():
+                    with span("handle", api=req.get("api")):
+                        resp = safe_handle(handlers.handle, req, dedup)
+                    call.handled()
+                    with span("reply"):
+                        n_out, code = send_response(conn, req, resp, trace)
+            finally:
+                stats.end(call, code, n_in, n_out)
+                end_trace(trace)
+    except ConnectionError:
+        # client disconnect
         pass
+    except Exception as e:
+        logger.warning(f"Dropping connection from {addr}: {type(e).__name__}: {e}")
     finally:
         try:
             conn.close()
@@ -29,16 +55,13 @@ def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: SellerFr
             pass
 
 
-def serve(host: str, port: int, handlers: SellerFrontendHandlers) -> None:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((host, port))
-        s.listen(512)
-        logger.info(f"Seller Frontend listening on {host}:{port}")
+def serve(host: str, port: int, handlers: SellerFrontendHandlers, dedup: Optional[IdempotencyCache] = None) -> None:
+    with listen_socket(host, port) as s:
+        logger.info(f"Seller Frontend listening on {format_addr(host, port)}")
         while True:
             conn, addr = s.accept()
             conn.settimeout(None)
-            t = threading.Thread(target=client_thread, args=(conn, addr, handlers), daemon=True)
+            t = threading.Thread(target=client_thread, args=(conn, addr, handlers, dedup), daemon=True)
             t.start()
 
 
@@ -47,13 +70,30 @@ def main() -> None:
     ap.add_argument("--config", required=True)
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
+    configure_tracing("seller_frontend", cfg.tracing)
+    configure_profiling("seller_frontend", cfg.seller_frontend)
 
     ep = get_endpoint(cfg.seller_frontend)
     cdb = get_nested_endpoint(cfg.seller_frontend, "customer_db")
     pdb = get_nested_endpoint(cfg.seller_frontend, "product_db")
 
-    handlers = SellerFrontendHandlers(cdb.host, cdb.port, pdb.host, pdb.port)
-    serve(ep.host, ep.port, handlers)
+    handlers = SellerFrontendHandlers(
+        cdb.host,
+        cdb.port,
+        pdb.host,
+        pdb.port,
+        shard_map=load_shard_map(cfg),
+        identity=ServiceIdentity.from_config(cfg),
+        retry=RetryPolicy.from_config(cfg.rpc_retry),
+    )
+    dedup = IdempotencyCache.from_config(MUTATING_APIS, cfg.seller_frontend)
+    stats = init_service_stats("seller_frontend")
+    stats.add_section("transport", compression_stats)
+    stats.add_section("idempotency", dedup.stats)
+    stats.start_log_dump(float(cfg.seller_frontend.get("stats_log_interval_seconds", 0)), logger)
+    stats.slow_log = SlowRequestLog.from_config(cfg.seller_frontend, logger)
+    serve(ep.host, ep.port, handlers, dedup)
 
 
 if __name__ == "__main__":
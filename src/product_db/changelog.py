@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import threading
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Any, Deque, Dict, List, Tuple
+
+
+# change kinds recorded for items
+REGISTERED = "registered"
+PRICE = "price"
+QUANTITY = "quantity"
+FEEDBACK = "feedback"
+
+
+class ChangeLog:
+    """
+    Bounded, in-memory log of item mutations with monotonically increasing sequence numbers.
+
+    Each entry carries the full item state after the mutation, so applying entries in order
+    (upsert by item_id) reproduces the catalog. The epoch changes every time the process
+    starts; a follower that sees a new epoch, or asks for entries that have already been
+    trimmed, must re-bootstrap from a snapshot.
+    """
+
+    def __init__(self, capacity: int = 100_000):
+        self.epoch = uuid.uuid4().hex
+        self.capacity = int(capacity)
+        self._entries: Deque[Dict[str, Any]] = deque()
+        self._seq = 0
+        self._cv = threading.Condition()
+
+    @property
+    def head_seq(self) -> int:
+        with self._cv:
+            return self._seq
+
+    def append(self, kind: str, item: Dict[str, Any]) -> int:
+        with self._cv:
+            self._seq += 1
+            self._entries.append({"seq": self._seq, "kind": kind, "item": item})
+            while len(self._entries) > self.capacity:
+                self._entries.popleft()
+            self._cv.notify_all()
+            return self._seq
+
+    def read_after(self, after_seq: int, max_entries: int = 1000, wait_s: float = 0.0) -> Tuple[List[Dict[str, Any]], int, bool]:
+        """
+        Returns (entries with seq > after_seq, head_seq, truncated). Blocks up to wait_s for
+        new entries when there are none. truncated=True means entries after after_seq were
+        already dropped (or after_seq is from another epoch) and the caller must resync.
+        """
+        with self._cv:
+            if wait_s > 0 and after_seq >= self._seq:
+                self._cv.wait_for(lambda: self._seq > after_seq, timeout=wait_s)
+            if after_seq > self._seq:
+                return [], self._seq, True
+            if after_seq == self._seq:
+                return [], self._seq, False
+            oldest = self._entries[0]["seq"] if self._entries else self._seq + 1
+            if after_seq + 1 < oldest:
+                return [], self._seq, True
+            start = after_seq + 1 - oldest
+            out = list(islice(self._entries, start, start + max_entries))
+            return out, self._seq, False
@@ -1,20 +1,181 @@
 from __future__ import annotations
 
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Optional
 
 from .store import ProductStore
-from ..common.protocol import make_ok, make_err
-from ..common.errors import Err, BAD_REQUEST
+from .replica import Follower
+from ..common.protocol import DEFAULT_STREAM_CHUNK, compression_stats, make_ok, make_err, make_not_modified, stream_items
+from ..common.errors import Err, BAD_REQUEST, CONFLICT, DEADLINE_EXCEEDED, FORBIDDEN, UNAUTHORIZED, UNAVAILABLE
+from ..common.identity import ServiceIdentity
+from ..common.profiling import profiling_allowed, run_profile
+from ..common.stats import service_stats
+from ..common.time_utils import now_s
+
+
+# APIs a read replica serves; everything else must go to the primary
+REPLICA_READ_APIS = ("SearchItemsForSale", "GetItem", "DisplayItemsForSale", "GetStats", "GetTransportStats", "Profile")
+
+# APIs whose replies are remembered by idempotency key, so a retry does not apply them twice
+MUTATING_APIS = (
+    "RegisterItemForSale",
+    "ChangeItemPrice",
+    "UpdateUnitsForSale",
+    "AddItemToCart",
+    "RemoveItemFromCart",
+    "SaveCart",
+    "ClearCart",
+    "ProvideFeedback",
+    "LogoutCleanup",
+)
+
+# APIs acting for one user, by the payload id they take; with internal_auth configured they
+# need a signed identity of that user
+USER_SCOPED_APIS = {
+    "RegisterItemForSale": "seller",
+    "ChangeItemPrice": "seller",
+    "UpdateUnitsForSale": "seller",
+    "DisplayItemsForSale": "seller",
+    "AddItemToCart": "buyer",
+    "RemoveItemFromCart": "buyer",
+    "SaveCart": "buyer",
+    "ClearCart": "buyer",
+    "DisplayCart": "buyer",
+    "LogoutCleanup": "buyer",
+}
+
+
+def _chunk_size(payload: Dict[str, Any]) -> int:
+    return min(max(int(payload.get("chunk_size", DEFAULT_STREAM_CHUNK)), 1), 10_000)
 
 
 class ProductHandlers:
-    def __init__(self, store: ProductStore):
+    def __init__(self, store: ProductStore, follower: Optional[Follower] = None, identity: Optional[ServiceIdentity] = None):
         self.store = store
+        # set when this process is a read replica
+        self.follower = follower
+        # verifies user identities signed by the frontends
+        self.identity = identity
+
+    def _check_identity(self, request_id: str, api: Any, ident: Any, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        ProductDB takes buyer_id / seller_id from the payload. With internal_auth configured,
+        a user-scoped API (USER_SCOPED_APIS) needs a signed identity of that buyer / seller;
+        without it, the payload id is trusted (the frontend validated the session). An
+        identity sent anyway must verify and match the payload id. Returns an error reply,
+        or None if ok.
+        """
+        scope = USER_SCOPED_APIS.get(api) if self.identity is not None else None
+        if ident is None:
+            if scope is not None:
+                return make_err(request_id, Err(UNAUTHORIZED, f"{api} needs a signed identity (internal_auth)"))
+            return None
+        if self.identity is None:
+            return make_err(request_id, Err(UNAUTHORIZED, "Untrusted identity: internal_auth is not configured"))
+        try:
+            user_type, user_id = self.identity.verify(ident)
+        except ValueError as e:
+            return make_err(request_id, Err(UNAUTHORIZED, f"Untrusted identity: {e}"))
+        if scope is not None and user_type != scope:
+            return make_err(request_id, Err(FORBIDDEN, f"{api} is not allowed for a {user_type}"))
+        key = f"{user_type}_id"
+        if (scope is not None or key in payload) and int(payload.get(key, -1)) != user_id:
+            return make_err(request_id, Err(FORBIDDEN, f"{key} does not belong to the calling user"))
+        return None
 
     def handle(self, req: Dict[str, Any]) -> Dict[str, Any]:
+        if self.follower is not None:
+            return self._handle_replica(req)
+        return self._handle(req)
+
+    def subscribe(self, req: Dict[str, Any], send: Callable[[Dict[str, Any]], None]) -> None:
+        """
+        Subscribe: streams item change events on this connection until the client goes away.
+
+        payload: from_seq (resume after this seq, default: current head), epoch (the epoch
+        from_seq belongs to), kinds / categories (optional filters), max_batch, heartbeat_s.
+        The first frame acknowledges the subscription; each later frame carries
+        {"epoch", "events": [{"seq", "kind", "item"}...], "resume_seq", "head_seq"}. Frames
+        with no events are heartbeats. Reconnect with from_seq=resume_seq of the last frame
+        seen, which also skips entries the filters dropped.
+        If the resume point is gone (restart or log trimmed) a CONFLICT error is sent and the
+        subscriber must reload with GetCatalogSnapshot.
+        Runs outside safe_handle, so a bad request or a passed deadline is answered here
+        with an error frame before the connection closes.
+        """
+        request_id = str(req.get("request_id", "req"))
+        payload = req.get("payload") or {}
+        if self.follower is not None:
+            send(make_err(request_id, Err(FORBIDDEN, "Subscribe is only served by the primary")))
+            return
+        deadline = req.get("deadline")
+        if isinstance(deadline, (int, float)) and now_s() >= deadline:
+            send(make_err(request_id, Err(DEADLINE_EXCEEDED, "Deadline passed before the request was handled.")))
+            return
+        changes = self.store.changes
+        head = changes.head_seq
+        try:
+            if not isinstance(payload, dict):
+                raise TypeError("payload must be an object")
+            seq = int(payload.get("from_seq", head))
+            kinds = set(str(k) for k in payload.get("kinds") or [])
+            categories = set(int(c) for c in payload.get("categories") or [])
+            max_batch = max(1, int(payload.get("max_batch", 500)))
+            heartbeat_s = min(max(float(payload.get("heartbeat_s", 5.0)), 0.1), 60.0)
+        except (TypeError, ValueError) as e:
+            send(make_err(request_id, Err(BAD_REQUEST, f"Invalid Subscribe payload: {e}")))
+            return
+        if seq < 0:
+            send(make_err(request_id, Err(BAD_REQUEST, "from_seq must be >= 0")))
+            return
+
+        epoch = str(payload.get("epoch", changes.epoch))
+        _, _, truncated = changes.read_after(seq, 1)
+        if epoch != changes.epoch or truncated:
+            send(make_err(request_id, Err(CONFLICT, "resume point no longer available; reload with GetCatalogSnapshot", {"epoch": changes.epoch, "head_seq": head})))
+            return
+        send(make_ok(request_id, {"subscribed": True, "epoch": changes.epoch, "from_seq": seq, "head_seq": head}))
+
+        while True:
+            entries, head, truncated = changes.read_after(seq, max_batch, wait_s=heartbeat_s)
+            if truncated:
+                # subscriber fell behind the bounded log
+                send(make_err(request_id, Err(CONFLICT, "subscriber fell behind the change log; reload with GetCatalogSnapshot", {"epoch": changes.epoch, "head_seq": head})))
+                return
+            events = []
+            for e in entries:
+                if kinds and e["kind"] not in kinds:
+                    continue
+                if categories and int(e["item"]["item_id"]["category"]) not in categories:
+                    continue
+                events.append(e)
+            if entries:
+                seq = int(entries[-1]["seq"])
+            send(make_ok(request_id, {"epoch": changes.epoch, "events": events, "resume_seq": seq, "head_seq": head}))
+
+    def _handle_replica(self, req: Dict[str, Any]) -> Dict[str, Any]:
+        api = req.get("api")
+        request_id = str(req.get("request_id", "req"))
+        if api not in REPLICA_READ_APIS:
+            return make_err(request_id, Err(FORBIDDEN, f"{api} is not served by a read replica"))
+        status = self.follower.status()
+        if api in ("GetStats", "Profile"):
+            # introspection is most useful exactly when the replica is lagging
+            return self._handle(req)
+        if not self.follower.is_fresh():
+            # callers fall back to the primary on UNAVAILABLE
+            return make_err(request_id, Err(UNAVAILABLE, "replica is too stale", status))
+        resp = self._handle(req)
+        if isinstance(resp, dict):
+            resp["replica"] = status
+        return resp
+
+    def _handle(self, req: Dict[str, Any]) -> Dict[str, Any]:
         api = req.get("api")
         request_id = str(req.get("request_id", "req"))
         payload = req.get("payload") or {}
+        err = self._check_identity(request_id, api, req.get("identity"), payload)
+        if err is not None:
+            return err
 
         if api == "RegisterItemForSale":
             item_id = self.store.register_item(
@@ -45,19 +206,40 @@ class ProductHandlers:
             return make_ok(request_id, {"updated": True, "remaining_quantity": remaining})
 
         if api == "DisplayItemsForSale":
+            if payload.get("stream"):
+                chunks, count = self.store.display_items_for_seller_chunks(int(payload["seller_id"]), _chunk_size(payload))
+                return stream_items(request_id, chunks, {"count": count})
             items = self.store.display_items_for_seller(int(payload["seller_id"]))
             return make_ok(request_id, {"items": items})
 
+        # GetItem / SearchItemsForSale / DisplayCart accept if_none_match=<etag from an earlier
+        # reply> and answer {"not_modified": true, "etag"} when nothing changed
+        inm = payload.get("if_none_match")
+
         if api == "SearchItemsForSale":
-            items, semantics = self.store.search(int(payload["item_category"]), [str(k) for k in payload.get("keywords", [])])
-            return make_ok(request_id, {"items": items, "semantics": semantics})
+            category = int(payload["item_category"])
+            if inm is not None and inm == self.store.search_etag(category):
+                return make_not_modified(request_id, inm)
+            keywords = [str(k) for k in payload.get("keywords", [])]
+            if payload.get("stream"):
+                chunks, count, semantics, etag = self.store.search_chunks(category, keywords, _chunk_size(payload))
+                return stream_items(request_id, chunks, {"count": count, "semantics": semantics, "etag": etag})
+            items, semantics, etag = self.store.search(category, keywords)
+            return make_ok(request_id, {"items": items, "semantics": semantics, "etag": etag})
 
         if api == "GetItem":
-            it = self.store.get_item(dict(payload["item_id"]))
-            return make_ok(request_id, it.to_dict())
+            item_id = dict(payload["item_id"])
+            if inm is not None and inm == self.store.item_etag(item_id):
+                return make_not_modified(request_id, inm)
+            return make_ok(request_id, self.store.get_item_dict(item_id))
 
         if api == "AddItemToCart":
-            sz = self.store.add_to_cart(int(payload["buyer_id"]), dict(payload["item_id"]), int(payload["quantity"]))
+            sz = self.store.add_to_cart(
+                int(payload["buyer_id"]),
+                dict(payload["item_id"]),
+                int(payload["quantity"]),
+                item_verified=bool(payload.get("item_verified", False)),
+            )
             return make_ok(request_id, {"added": True, "cart_size": sz})
 
         if api == "RemoveItemFromCart":
@@ -73,8 +255,11 @@ class ProductHandlers:
             return make_ok(request_id, {"cleared": True})
 
         if api == "DisplayCart":
-            items = self.store.display_cart(int(payload["buyer_id"]))
-            return make_ok(request_id, {"items": items})
+            buyer_id = int(payload["buyer_id"])
+            if inm is not None and inm == self.store.cart_etag(buyer_id):
+                return make_not_modified(request_id, inm)
+            items, etag = self.store.display_cart(buyer_id)
+            return make_ok(request_id, {"items": items, "etag": etag})
 
         if api == "ProvideFeedback":
             vote = str(payload.get("vote", ""))
@@ -83,6 +268,34 @@ class ProductHandlers:
             up, down, seller_id = self.store.provide_item_feedback(dict(payload["item_id"]), vote)
             return make_ok(request_id, {"updated": True, "thumbs_up": up, "thumbs_down": down, "seller_id": seller_id})
 
+        if api == "GetCatalogSnapshot":
+            epoch, seq, items, category_seq = self.store.catalog_snapshot()
+            cat_seq = {str(c): s for c, s in category_seq.items()}
+            return make_ok(request_id, {"epoch": epoch, "seq": seq, "items": items, "category_seq": cat_seq})
+
+        if api == "GetMutations":
+            changes = self.store.changes
+            after_seq = int(payload.get("after_seq", 0))
+            if str(payload.get("epoch", changes.epoch)) != changes.epoch:
+                return make_ok(request_id, {"epoch": changes.epoch, "entries": [], "head_seq": changes.head_seq, "truncated": True})
+            wait_s = min(max(float(payload.get("wait_s", 0.0)), 0.0), 10.0)
+            entries, head, truncated = changes.read_after(after_seq, int(payload.get("max", 1000)), wait_s)
+            return make_ok(request_id, {"epoch": changes.epoch, "entries": entries, "head_seq": head, "truncated": truncated})
+
+        if api == "GetStats":
+            return make_ok(request_id, service_stats().snapshot())
+
+        if api == "Profile":
+            if not profiling_allowed():
+                return make_err(request_id, Err(FORBIDDEN, "Profile is disabled on this service (profile_api_enabled)"))
+            return make_ok(request_id, run_profile(payload))
+
+        if api == "GetCartStats":
+            return make_ok(request_id, self.store.cart_metrics())
+
+        if api == "GetTransportStats":
+            return make_ok(request_id, compression_stats())
+
         if api == "LogoutCleanup":
             self.store.logout_cleanup(int(payload["buyer_id"]))
             return make_ok(request_id, {"ok": True})
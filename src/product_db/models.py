@@ -24,10 +24,28 @@ class Item:
     quantity: int
     seller_id: int
     feedback: Feedback
+    version: int = 1  # bumped on every stored mutation
 
     def item_id(self) -> Dict[str, int]:
         return {"category": self.category, "id": self.id}
 
+    @classmethod
+    def from_dict(cls, d: Dict[str, Any]) -> "Item":
+        fb = d.get("feedback", {})
+        item_id = d["item_id"]
+        return cls(
+            category=int(item_id["category"]),
+            id=int(item_id["id"]),
+            item_name=str(d["item_name"]),
+            keywords=[str(x) for x in d.get("keywords", [])],
+            condition=str(d["condition"]),
+            sale_price=float(d["sale_price"]),
+            quantity=int(d["quantity"]),
+            seller_id=int(d["seller_id"]),
+            feedback=Feedback(int(fb.get("thumbs_up", 0)), int(fb.get("thumbs_down", 0))),
+            version=int(d.get("version", 1)),
+        )
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             "item_id": self.item_id(),
@@ -39,6 +57,7 @@ class Item:
             "quantity": self.quantity,
             "seller_id": self.seller_id,
             "feedback": self.feedback.to_dict(),
+            "version": self.version,
         }
 
 
@@ -47,6 +66,7 @@ class Cart:
     buyer_id: int
     items: Dict[str, int]  # item_id_str -> qty
     saved: bool = False
+    version: int = 0  # store-wide counter value at the last change; not persisted
 
     def to_dict(self) -> Dict[str, Any]:
         return {"buyer_id": self.buyer_id, "items": dict(self.items), "saved": self.saved}
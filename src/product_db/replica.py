@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from .models import Item
+from .store import ProductStore
+from ..common.ids import item_id_to_str
+from ..common.logging_utils import setup_logging
+from ..common.protocol import PersistentRpcClient
+from ..common.time_utils import monotonic_s
+
+
+logger = setup_logging("product_db.replica")
+
+
+class ReplicaStore(ProductStore):
+    """
+    Read-only copy of a primary's catalog. Nothing is loaded from or saved to disk; the
+    Follower bootstraps it from GetCatalogSnapshot and then applies GetMutations entries.
+    Carts are not replicated.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(data_path="")
+
+    def _load(self) -> None:
+        return
+
+    def _save(self) -> None:
+        return
+
+    def reset(self, items: List[Dict[str, Any]], epoch: str, seq: int, category_seq: Optional[Dict[str, int]] = None) -> None:
+        with self._lock:
+            self.items_by_key = {item_id_to_str(d["item_id"]): Item.from_dict(d) for d in items}
+            # search etags use the primary's epoch and seqs, so replicas in the same state agree
+            self.changes.epoch = epoch
+            if category_seq is not None:
+                self._category_seq = {int(c): int(s) for c, s in category_seq.items()}
+            else:
+                self._category_seq = {it.category: seq for it in self.items_by_key.values()}
+
+    def apply(self, entries: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            for e in entries:
+                it = Item.from_dict(e["item"])
+                self.items_by_key[item_id_to_str(it.item_id())] = it
+                self._category_seq[it.category] = int(e["seq"])
+
+
+class Follower:
+    """
+    Keeps a ReplicaStore in step with the primary by long-polling GetMutations.
+
+    Staleness is measured from when the last fully caught-up poll response arrived: the
+    replica had everything the primary had committed when it answered (give or take one
+    network hop).
+    """
+
+    def __init__(
+        self,
+        store: ReplicaStore,
+        primary_host: str,
+        primary_port: int,
+        poll_wait_s: float = 0.5,
+        batch: int = 1000,
+        max_staleness_s: float = 5.0,
+    ):
+        self.store = store
+        self.primary = PersistentRpcClient(primary_host, primary_port, timeout_s=max(5.0, poll_wait_s * 4))
+        self.poll_wait_s = float(poll_wait_s)
+        self.batch = int(batch)
+        self.max_staleness_s = float(max_staleness_s)
+
+        self.epoch: Optional[str] = None
+        self.seq = 0
+        self.primary_seq = 0
+        self._caught_up_at: Optional[float] = None
+        self.resyncs = 0
+
+    def staleness_s(self) -> float:
+        if self._caught_up_at is None:
+            return float("inf")
+        return monotonic_s() - self._caught_up_at
+
+    def is_fresh(self) -> bool:
+        return self.staleness_s() <= self.max_staleness_s
+
+    def status(self) -> Dict[str, Any]:
+        st = self.staleness_s()
+        return {
+            "seq": self.seq,
+            "primary_seq": self.primary_seq,
+            "staleness_ms": None if st == float("inf") else int(st * 1000),
+        }
+
+    def _resync(self) -> None:
+        resp = self.primary.call("GetCatalogSnapshot", {"request_id": "replica-sync"})
+        if not resp.get("ok", False):
+            raise RuntimeError(f"snapshot failed: {resp.get('error')}")
+        data = resp["data"]
+        self.store.reset(data["items"], str(data["epoch"]), int(data["seq"]), data.get("category_seq"))
+        self.epoch = str(data["epoch"])
+        self.seq = self.primary_seq = int(data["seq"])
+        self.resyncs += 1
+        logger.info(f"Replica synced {len(data['items'])} items at seq {self.seq}")
+
+    def poll_once(self) -> None:
+        if self.epoch is None:
+            self._resync()
+        resp = self.primary.call(
+            "GetMutations",
+            {"request_id": "replica-poll", "epoch": self.epoch, "after_seq": self.seq, "max": self.batch, "wait_s": self.poll_wait_s},
+        )
+        if not resp.get("ok", False):
+            raise RuntimeError(f"poll failed: {resp.get('error')}")
+        data = resp["data"]
+        if data["truncated"] or data["epoch"] != self.epoch:
+            # primary restarted or we fell behind its log
+            self._resync()
+            return
+        entries = data["entries"]
+        self.store.apply(entries)
+        if entries:
+            self.seq = int(entries[-1]["seq"])
+        self.primary_seq = int(data["head_seq"])
+        if self.seq >= self.primary_seq:
+            self._caught_up_at = monotonic_s()
+
+    def start(self) -> threading.Thread:
+        def loop() -> None:
+            backoff = 0.1
+            while True:
+                try:
+                    self.poll_once()
+                    backoff = 0.1
+                except Exception as e:
+                    logger.warning(f"Replica poll failed: {type(e).__name__}: {e}")
+                    self.primary.close()
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 5.0)
+
+        t = threading.Thread(target=loop, name="replica-follower", daemon=True)
+        t.start()
+        return t
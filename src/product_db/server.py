@@ -3,26 +3,78 @@ from __future__ import annotations
 import argparse
 import socket
 import threading
-from typing import Tuple
+from typing import Optional, Tuple
 
 from ..common.config import load_config, get_endpoint
+from ..common.errors import Err, INTERNAL
+from ..common.sharding import load_replicas, load_shard_map
+from ..common.idempotency import IdempotencyCache
+from ..common.identity import ServiceIdentity
 from ..common.logging_utils import setup_logging
-from ..common.protocol import recv_json, send_json, safe_handle
+from ..common.profiling import configure_profiling, profiled
+from ..common.protocol import (
+    accepts_compression,
+    compression_stats,
+    configure_compression,
+    format_addr,
+    listen_socket,
+    make_err,
+    recv_json_sized,
+    send_json,
+    send_response,
+    safe_handle,
+)
+from ..common.shutdown import run_at_exit
+from ..common.slowlog import SlowRequestLog
+from ..common.stats import ABORTED, configure_lock_profiling, init_service_stats, lock_profiles, log_lock_profiles_at_exit, service_stats
+from ..common.tracing import begin_trace, configure_tracing, end_trace, span
 from .store import ProductStore
-from .handlers import ProductHandlers
+from .handlers import ProductHandlers, MUTATING_APIS
+from .replica import Follower, ReplicaStore
 
 
 logger = setup_logging("product_db")
 
 
-def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: ProductHandlers) -> None:
+def client_thread(
+    conn: socket.socket, addr: Tuple[str, int], handlers: ProductHandlers, dedup: Optional[IdempotencyCache] = None
+) -> None:
+    stats = service_stats()
     try:
         while True:
-            req = recv_json(conn)
-            resp = safe_handle(handlers.handle, req)
-            send_json(conn, resp)
-    except Exception:
+            req, n_in = recv_json_sized(conn)
+            if req.get("api") == "Subscribe":
+                # the connection becomes a one-way event stream until the client disconnects
+                send = lambda msg: send_json(conn, msg, compress=accepts_compression(req))
+                try:
+                    handlers.subscribe(req, send)
+                except OSError:
+                    raise
+                except Exception as e:
+                    # the subscriber is waiting for frames: tell it why the stream ends
+                    send(make_err(str(req.get("request_id", "req")), Err(INTERNAL, f"Subscribe failed: {type(e).__name__}: {e}")))
+                    raise
+                break
+            call = stats.begin(req)
+            trace = begin_trace(req)
+            # counted as ABORTED unless the reply goes out (client gone, stream cut, ...)
+            code: Optional[str] = ABORTED
+            n_out = 0
+            try:
+                with profiled():
+                    with span("handle", api=req.get("api")):
+                        resp = safe_handle(handlers.handle, req, dedup)
+                    call.handled()
+                    with span("reply"):
+                        n_out, code = send_response(conn, req, resp, trace)
+            finally:
+                stats.end(call, code, n_in, n_out)
+                end_trace(trace)
+    except ConnectionError:
+        # client disconnect
         pass
+    except Exception as e:
+        logger.warning(f"Dropping connection from {addr}: {type(e).__name__}: {e}")
     finally:
         try:
             conn.close()
@@ -30,28 +82,86 @@ def client_thread(conn: socket.socket, addr: Tuple[str, int], handlers: ProductH
             pass
 
 
-def serve(host: str, port: int, store: ProductStore) -> None:
-    handlers = ProductHandlers(store)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind((host, port))
-        s.listen(512)
-        logger.info(f"Product DB listening on {host}:{port}")
+def serve(
+    host: str,
+    port: int,
+    store: ProductStore,
+    follower: Optional[Follower] = None,
+    dedup: Optional[IdempotencyCache] = None,
+    identity: Optional[ServiceIdentity] = None,
+) -> None:
+    handlers = ProductHandlers(store, follower, identity)
+    with listen_socket(host, port) as s:
+        role = "replica" if follower is not None else "primary"
+        logger.info(f"Product DB ({role}) listening on {format_addr(host, port)}")
         while True:
             conn, addr = s.accept()
             conn.settimeout(None)
-            t = threading.Thread(target=client_thread, args=(conn, addr, handlers), daemon=True)
+            t = threading.Thread(target=client_thread, args=(conn, addr, handlers, dedup), daemon=True)
             t.start()
 
 
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
+    ap.add_argument("--shard", type=int, default=None, help="index into product_db_shards.shards")
+    ap.add_argument("--replica", type=int, default=None, help="run as read replica K of the primary (or of --shard)")
     args = ap.parse_args()
     cfg = load_config(args.config)
+    configure_compression(cfg.compression)
+    configure_tracing("product_db", cfg.tracing)
+    configure_profiling("product_db", cfg.product_db)
+    stats = init_service_stats("product_db")
+    stats.add_section("transport", compression_stats)
+    stats.start_log_dump(float(cfg.product_db.get("stats_log_interval_seconds", 0)), logger)
+    stats.slow_log = SlowRequestLog.from_config(cfg.product_db, logger)
+    configure_lock_profiling(bool(cfg.product_db.get("lock_profiling", False)))
+    top_n = int(cfg.product_db.get("lock_profiling_top", 10))
+    stats.add_section("locks", lambda: lock_profiles(top_n))
+    log_lock_profiles_at_exit(logger, top_n)
     ep = get_endpoint(cfg.product_db)
-    store = ProductStore(data_path=str(cfg.product_db["data_path"]))
-    serve(ep.host, ep.port, store)
+    host, port = ep.host, ep.port
+    data_path = str(cfg.product_db["data_path"])
+    replicas = load_replicas(cfg)
+    if args.shard is not None:
+        sm = load_shard_map(cfg)
+        if sm is None or not 0 <= args.shard < len(sm):
+            raise SystemExit(f"--shard {args.shard} is not defined in product_db_shards")
+        shard = sm.shards[args.shard]
+        host, port, data_path = shard.listen_host, shard.endpoint.port, shard.data_path
+        replicas = shard.replicas
+        logger.info(f"Running as ProductDB shard {args.shard}/{len(sm)}")
+
+    if args.replica is not None:
+        if not 0 <= args.replica < len(replicas):
+            raise SystemExit(f"--replica {args.replica} is not defined in the config")
+        spec = replicas[args.replica]
+        replica_store = ReplicaStore()
+        follower = Follower(
+            replica_store,
+            spec.primary.host,
+            spec.primary.port,
+            poll_wait_s=float(cfg.product_db.get("replica_poll_wait_seconds", 0.5)),
+            max_staleness_s=float(cfg.product_db.get("replica_max_staleness_seconds", 5.0)),
+        )
+        follower.start()
+        stats.add_section("replication", follower.status)
+        serve(spec.listen_host, spec.endpoint.port, replica_store, follower, identity=ServiceIdentity.from_config(cfg))
+        return
+
+    store = ProductStore(
+        data_path=data_path,
+        max_cart_lines=int(cfg.product_db.get("max_cart_lines", 100)),
+        max_total_cart_lines=int(cfg.product_db.get("max_total_cart_lines", 1_000_000)),
+        feedback_flush_interval_s=float(cfg.product_db.get("feedback_flush_interval_seconds", 1.0)),
+    )
+    store.start_feedback_flusher()
+    # votes still pending at shutdown were already acknowledged: apply them on the way out
+    run_at_exit(store.flush_feedback)
+    dedup = IdempotencyCache.from_config(MUTATING_APIS, cfg.product_db)
+    stats.add_section("cart", store.cart_metrics)
+    stats.add_section("idempotency", dedup.stats)
+    serve(host, port, store, dedup=dedup, identity=ServiceIdentity.from_config(cfg))
 
 
 if __name__ == "__main__":
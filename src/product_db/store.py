@@ -3,28 +3,64 @@ from __future__ import annotations
 import json
 import os
 import threading
-from typing import Dict, Any, List, Tuple, Optional, Literal
+from typing import Dict, Any, Iterator, List, Tuple, Optional, Literal
 
 from .models import Item, Feedback, Cart
+from .changelog import ChangeLog, REGISTERED, PRICE, QUANTITY, FEEDBACK
+from ..common.counters import CounterAggregator
 from ..common.ids import item_id_to_str
+from ..common.stats import TimedRLock
+from ..common.tracing import span
 
 import uuid
 import time
 from pathlib import Path
 
 
+SEARCH_SEMANTICS = "category match + score=#keyword exact matches (case-insensitive); quantity>0; sorted by score desc then net_feedback desc then price asc then item_id asc; if no keywords, returns all in category"
+
+
 class ProductStore:
-    def __init__(self, data_path: str):
+    def __init__(
+        self,
+        data_path: str,
+        max_cart_lines: int = 100,
+        max_total_cart_lines: int = 1_000_000,
+        feedback_flush_interval_s: float = 0.0,
+        changelog_capacity: int = 100_000,
+    ):
         self.data_path = data_path
-        self._lock = threading.RLock()
+        self._lock = TimedRLock("product_store")
 
         # items_by_key: "cat:id" -> Item
         self.items_by_key: Dict[str, Item] = {}
         self.next_item_seq_by_cat: Dict[int, int] = {}  # category -> next int id
 
-        # carts by buyer_id
+        # carts by buyer_id; only buyers with lines in their cart have an entry
         self.carts: Dict[int, Cart] = {}
 
+        # cart limits: distinct lines per buyer, and lines across all carts (memory budget)
+        self.max_cart_lines = int(max_cart_lines)
+        self.max_total_cart_lines = int(max_total_cart_lines)
+        self._total_cart_lines = 0
+        self._cart_rejects = 0
+        self._carts_dropped = 0
+
+        # item votes are coalesced here and applied every feedback_flush_interval_s
+        # (0 = apply and persist on every vote)
+        self.feedback_flush_interval_s = float(feedback_flush_interval_s)
+        self._votes: CounterAggregator[str] = CounterAggregator()
+        # votes not yet flushed, per category (guarded by the aggregator's lock): a flush
+        # turns them into FEEDBACK changes, which move the category's seq instead
+        self._category_votes: Dict[int, int] = {}
+
+        # item mutations, in commit order, for replicas and subscribers
+        self.changes = ChangeLog(changelog_capacity)
+        # change seq of the latest mutation per category, and a counter for cart versions;
+        # together with changes.epoch these make the etags for conditional reads
+        self._category_seq: Dict[int, int] = {}
+        self._cart_seq = 0
+
         self._load()
 
     def _load(self) -> None:
@@ -37,27 +73,20 @@ class ProductStore:
         with self._lock:
             self.next_item_seq_by_cat = {int(k): int(v) for k, v in raw.get("next_item_seq_by_cat", {}).items()}
             for it in raw.get("items", []):
-                fb = it.get("feedback", {})
-                item_id = it["item_id"]
-                key = item_id_to_str(item_id)
-                self.items_by_key[key] = Item(
-                    category=int(item_id["category"]),
-                    id=int(item_id["id"]),
-                    item_name=str(it["item_name"]),
-                    keywords=[str(x) for x in it.get("keywords", [])],
-                    condition=str(it["condition"]),
-                    sale_price=float(it["sale_price"]),
-                    quantity=int(it["quantity"]),
-                    seller_id=int(it["seller_id"]),
-                    feedback=Feedback(int(fb.get("thumbs_up", 0)), int(fb.get("thumbs_down", 0))),
-                )
+                self.items_by_key[item_id_to_str(it["item_id"])] = Item.from_dict(it)
             for c in raw.get("carts", []):
                 cart = Cart(
                     buyer_id=int(c["buyer_id"]),
                     items={str(k): int(v) for k, v in c.get("items", {}).items()},
                     saved=bool(c.get("saved", False)),
                 )
+                if not cart.items:
+                    # older snapshots contain an empty cart for every buyer who browsed
+                    continue
+                self._cart_seq += 1
+                cart.version = self._cart_seq
                 self.carts[cart.buyer_id] = cart
+                self._total_cart_lines += len(cart.items)
                 
     def _replace_with_retry(self, src_tmp: str, dst: str, retries: int = 30, delay_s: float = 0.02) -> None:
         # Force types in case something passed as string
@@ -77,7 +106,7 @@ class ProductStore:
 
 
     def _save(self) -> None:
-        with self._lock:
+        with self._lock, span("save"):
             raw = {
                 "next_item_seq_by_cat": {str(k): int(v) for k, v in self.next_item_seq_by_cat.items()},
                 "items": [it.to_dict() for it in self.items_by_key.values()],
@@ -131,6 +160,7 @@ class ProductStore:
                 feedback=Feedback(0, 0),
             )
             self.items_by_key[item_id_to_str(item.item_id())] = item
+            self._record_change(REGISTERED, item)
             self._save()
             return item.item_id()
 
@@ -142,6 +172,67 @@ class ProductStore:
                 raise ValueError("item not found")
             return it
 
+    def get_item_dict(self, item_id: Dict[str, int]) -> Dict[str, Any]:
+        with self._lock:
+            it = self.get_item(item_id)
+            # tag first: a vote landing in between makes the tag older than the body, never newer
+            etag = self._item_etag(it)
+            d = self._item_dict(it)
+            d["etag"] = etag
+            return d
+
+    def _record_change(self, kind: str, it: Item) -> None:
+        # call with self._lock held, right after mutating it. Always the stored state
+        # (to_dict(), never _item_dict() with pending votes): replicas and subscribers must
+        # see the same content for the same item version
+        seq = self.changes.append(kind, it.to_dict())
+        self._category_seq[it.category] = seq
+
+    def _item_etag(self, it: Item) -> str:
+        pu, pd = self._votes.pending(item_id_to_str(it.item_id()))
+        if pu or pd:
+            return f"{it.version}+{pu}-{pd}"
+        return str(it.version)
+
+    def item_etag(self, item_id: Dict[str, int]) -> str:
+        with self._lock:
+            return self._item_etag(self.get_item(item_id))
+
+    def _search_etag(self, category: int) -> str:
+        # a vote in the category may reorder its results: pending ones count here, flushed
+        # ones are FEEDBACK changes (so replicas, which have no pending votes, agree)
+        tag = f"{self.changes.epoch[:8]}.{self._category_seq.get(category, 0)}"
+        pending = self._category_votes.get(category, 0)
+        return f"{tag}+{pending}" if pending else tag
+
+    def search_etag(self, category: int) -> str:
+        with self._lock:
+            return self._search_etag(category)
+
+    def _cart_etag(self, cart: Optional[Cart]) -> str:
+        if cart is None:
+            return "empty"
+        return f"{self.changes.epoch[:8]}.{cart.version}"
+
+    def cart_etag(self, buyer_id: int) -> str:
+        with self._lock:
+            return self._cart_etag(self._get_cart(buyer_id))
+
+    def _touch_cart(self, cart: Cart) -> None:
+        self._cart_seq += 1
+        cart.version = self._cart_seq
+
+    def _feedback(self, it: Item) -> Tuple[int, int]:
+        # stored counters plus votes not yet flushed; call with self._lock held
+        pu, pd = self._votes.pending(item_id_to_str(it.item_id()))
+        return it.feedback.thumbs_up + pu, it.feedback.thumbs_down + pd
+
+    def _item_dict(self, it: Item) -> Dict[str, Any]:
+        d = it.to_dict()
+        up, down = self._feedback(it)
+        d["feedback"] = {"thumbs_up": up, "thumbs_down": down}
+        return d
+
     def change_price(self, seller_id: int, item_id: Dict[str, int], new_price: float) -> None:
         key = item_id_to_str(item_id)
         with self._lock:
@@ -151,6 +242,8 @@ class ProductStore:
             if it.seller_id != seller_id:
                 raise ValueError("forbidden: not item owner")
             it.sale_price = float(new_price)
+            it.version += 1
+            self._record_change(PRICE, it)
             self._save()
 
     def update_units_remove(self, seller_id: int, item_id: Dict[str, int], remove_qty: int) -> int:
@@ -166,82 +259,188 @@ class ProductStore:
             if remove_qty > it.quantity:
                 raise ValueError("cannot remove more than available quantity")
             it.quantity -= int(remove_qty)
+            it.version += 1
+            self._record_change(QUANTITY, it)
             self._save()
             return it.quantity
 
+    def catalog_snapshot(self) -> Tuple[str, int, List[Dict[str, Any]], Dict[int, int]]:
+        """
+        Returns (epoch, seq, items, category_seq) such that replaying changes after seq on
+        items is exact; category_seq (latest change per category) keeps search etags equal.
+        """
+        with self._lock:
+            items = [it.to_dict() for it in self.items_by_key.values()]
+            return self.changes.epoch, self.changes.head_seq, items, dict(self._category_seq)
+
     def display_items_for_seller(self, seller_id: int) -> List[Dict[str, Any]]:
         with self._lock:
-            items = [it.to_dict() for it in self.items_by_key.values() if it.seller_id == seller_id]
+            items = [self._item_dict(it) for it in self.items_by_key.values() if it.seller_id == seller_id]
             items.sort(key=lambda x: (x["item_id"]["category"], x["item_id"]["id"]))
             return items
 
-    def search(self, category: int, keywords: List[str]) -> Tuple[List[Dict[str, Any]], str]:
+    def display_items_for_seller_chunks(self, seller_id: int, chunk_size: int) -> Tuple[Iterator[List[Dict[str, Any]]], int]:
+        """Streaming variant of display_items_for_seller(); see _chunks. Returns (chunks, count)."""
+        with self._lock:
+            mine = sorted((it for it in self.items_by_key.values() if it.seller_id == seller_id), key=lambda it: (it.category, it.id))
+        return self._chunks([(None, it) for it in mine], chunk_size), len(mine)
+
+    def _chunks(self, ranked: List[Tuple[Optional[int], Item]], chunk_size: int) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Builds the reply dicts of a streamed result one chunk at a time: the result set is
+        fixed as item references when the stream starts, and each chunk reads its items
+        (under the lock) when it is about to be sent, so only one chunk of dicts is alive.
+        """
+        for i in range(0, len(ranked), chunk_size):
+            out = []
+            with self._lock:
+                for score, it in ranked[i : i + chunk_size]:
+                    d = self._item_dict(it)
+                    if score is not None:
+                        d["score"] = score
+                    out.append(d)
+            yield out
+
+    def search(self, category: int, keywords: List[str]) -> Tuple[List[Dict[str, Any]], str, str]:
         """
         Semantics:
         - category must match, quantity>0
         - score = count of query keywords that exactly match an item keyword (case-insensitive)
         - if no keywords, score is 0 and all items in category returned
         - sort by score desc, net_feedback desc, price asc, item_id asc
+        Returns (items, semantics, etag); the etag covers the whole category, not just the query.
         """
-        q = [k.strip() for k in keywords if k.strip()]
-        q_lower = [k.lower() for k in q]
         with self._lock:
-            candidates = []
-            for it in self.items_by_key.values():
-                if it.category != category or it.quantity <= 0:
-                    continue
-                it_kw = [kw.lower() for kw in it.keywords]
-                score = 0
-                if q_lower:
-                    score = sum(1 for k in q_lower if k in it_kw)
-                    if score == 0:
-                        continue
-                net_fb = it.feedback.thumbs_up - it.feedback.thumbs_down
-                candidates.append((score, net_fb, it.sale_price, it.category, it.id, it))
-
-            candidates.sort(key=lambda t: (-t[0], -t[1], t[2], t[3], t[4]))
+            # tag first: a vote landing in between makes the tag older than the body, never newer
+            etag = self._search_etag(category)
+            ranked = self._rank(category, keywords)
             items = []
-            for score, _, _, _, _, it in candidates:
-                d = it.to_dict()
+            for score, it in ranked:
+                d = self._item_dict(it)
                 d["score"] = score
                 items.append(d)
+        return items, SEARCH_SEMANTICS, etag
 
-        semantics = "category match + score=#keyword exact matches (case-insensitive); quantity>0; sorted by score desc then net_feedback desc then price asc then item_id asc; if no keywords, returns all in category"
-        return items, semantics
+    def search_chunks(self, category: int, keywords: List[str], chunk_size: int) -> Tuple[Iterator[List[Dict[str, Any]]], int, str, str]:
+        """
+        Streaming variant of search(): ranks once under the lock, then builds the reply in
+        chunks (see _chunks). Returns (chunks, count, semantics, etag).
+        """
+        with self._lock:
+            etag = self._search_etag(category)
+            ranked = self._rank(category, keywords)
+        return self._chunks(ranked, chunk_size), len(ranked), SEARCH_SEMANTICS, etag
+
+    def _rank(self, category: int, keywords: List[str]) -> List[Tuple[Optional[int], Item]]:
+        """(score, item) of the search hits in reply order. Caller holds the lock."""
+        q_lower = [k.strip().lower() for k in keywords if k.strip()]
+        candidates = []
+        for it in self.items_by_key.values():
+            if it.category != category or it.quantity <= 0:
+                continue
+            it_kw = [kw.lower() for kw in it.keywords]
+            score = 0
+            if q_lower:
+                score = sum(1 for k in q_lower if k in it_kw)
+                if score == 0:
+                    continue
+            up, down = self._feedback(it)
+            net_fb = up - down
+            candidates.append((score, net_fb, it.sale_price, it.category, it.id, it))
+        candidates.sort(key=lambda t: (-t[0], -t[1], t[2], t[3], t[4]))
+        return [(t[0], t[5]) for t in candidates]
 
     def provide_item_feedback(self, item_id: Dict[str, int], vote: Literal["up", "down"]) -> Tuple[int, int, int]:
+        """
+        Records the vote in the aggregator without taking the store lock; it reaches the
+        snapshot on the next flush_feedback(). Returned counts include pending votes.
+        """
         key = item_id_to_str(item_id)
-        with self._lock:
+        # items are never removed, so a lock-free lookup is safe
+        it = self.items_by_key.get(key)
+        if not it:
+            raise ValueError("item not found")
+
+        def base() -> Tuple[int, int]:
+            # under the aggregator lock, like the flush that clears these counts
+            self._category_votes[it.category] = self._category_votes.get(it.category, 0) + 1
+            return it.feedback.thumbs_up, it.feedback.thumbs_down
+
+        up, down = self._votes.add(key, vote, base=base)
+        if self.feedback_flush_interval_s <= 0:
+            self.flush_feedback()
+        return up, down, it.seller_id
+
+    def _apply_feedback(self, batch: Dict[str, Tuple[int, int]]) -> None:
+        for key, (up, down) in batch.items():
             it = self.items_by_key.get(key)
-            if not it:
-                raise ValueError("item not found")
-            if vote == "up":
-                it.feedback.thumbs_up += 1
-            else:
-                it.feedback.thumbs_down += 1
-            self._save()
-            return it.feedback.thumbs_up, it.feedback.thumbs_down, it.seller_id
+            if it is None:
+                continue
+            it.feedback.thumbs_up += up
+            it.feedback.thumbs_down += down
+            it.version += 1
+            self._record_change(FEEDBACK, it)
+        # the whole pending batch is applied at once
+        self._category_votes.clear()
+
+    def flush_feedback(self) -> int:
+        """Applies pending item votes and persists once. Returns the number of items touched."""
+        with self._lock:
+            n = self._votes.flush(self._apply_feedback)
+            if n:
+                self._save()
+            return n
+
+    def start_feedback_flusher(self) -> Optional[threading.Thread]:
+        if self.feedback_flush_interval_s <= 0:
+            return None
+        return self._votes.start_flusher(self.flush_feedback, self.feedback_flush_interval_s)
+
+    def _get_cart(self, buyer_id: int) -> Optional[Cart]:
+        return self.carts.get(buyer_id)
 
     def _get_or_create_cart(self, buyer_id: int) -> Cart:
+        # only called when a line is about to be added
         c = self.carts.get(buyer_id)
         if not c:
             c = Cart(buyer_id=buyer_id, items={}, saved=False)
             self.carts[buyer_id] = c
         return c
 
-    def add_to_cart(self, buyer_id: int, item_id: Dict[str, int], qty: int) -> int:
+    def _drop_cart_if_empty(self, cart: Cart) -> None:
+        if not cart.items:
+            self.carts.pop(cart.buyer_id, None)
+            self._carts_dropped += 1
+
+    def add_to_cart(self, buyer_id: int, item_id: Dict[str, int], qty: int, item_verified: bool = False) -> int:
+        """
+        item_verified: with ProductDB sharding the item may live on another shard; the frontend
+        has already checked it there, so a missing local item is not an error.
+        """
         if qty <= 0:
             raise ValueError("quantity must be > 0")
         key = item_id_to_str(item_id)
         with self._lock:
             it = self.items_by_key.get(key)
-            if not it:
+            if not it and not item_verified:
                 raise ValueError("item not found")
-            if it.quantity <= 0:
+            if it and it.quantity <= 0:
                 raise ValueError("item unavailable")
+            cart = self._get_cart(buyer_id)
+            is_new_line = cart is None or key not in cart.items
+            if is_new_line:
+                n_lines = len(cart.items) if cart else 0
+                if n_lines >= self.max_cart_lines:
+                    self._cart_rejects += 1
+                    raise ValueError(f"cart limit reached ({self.max_cart_lines} distinct items)")
+                if self._total_cart_lines >= self.max_total_cart_lines:
+                    self._cart_rejects += 1
+                    raise ValueError("cart capacity exhausted, try again later")
+                self._total_cart_lines += 1
             cart = self._get_or_create_cart(buyer_id)
             cart.saved = False  # modifying cart makes it unsaved until SaveCart
             cart.items[key] = cart.items.get(key, 0) + int(qty)
+            self._touch_cart(cart)
             self._save()
             return len(cart.items)
 
@@ -250,40 +449,63 @@ class ProductStore:
             raise ValueError("quantity must be > 0")
         key = item_id_to_str(item_id)
         with self._lock:
-            cart = self._get_or_create_cart(buyer_id)
-            if key not in cart.items:
+            cart = self._get_cart(buyer_id)
+            if cart is None or key not in cart.items:
                 raise ValueError("item not in cart")
             if qty > cart.items[key]:
                 raise ValueError("cannot remove more than in cart")
             cart.saved = False
             cart.items[key] -= int(qty)
+            self._touch_cart(cart)
             if cart.items[key] == 0:
                 del cart.items[key]
+                self._total_cart_lines -= 1
+                self._drop_cart_if_empty(cart)
             self._save()
             return len(cart.items)
 
     def save_cart(self, buyer_id: int) -> None:
         with self._lock:
-            cart = self._get_or_create_cart(buyer_id)
+            cart = self._get_cart(buyer_id)
+            if cart is None or cart.saved:
+                # nothing to keep, or already kept
+                return
             cart.saved = True
             self._save()
 
     def clear_cart(self, buyer_id: int) -> None:
         with self._lock:
-            cart = self._get_or_create_cart(buyer_id)
-            cart.items = {}
-            cart.saved = False
+            cart = self.carts.pop(buyer_id, None)
+            if cart is None:
+                return
+            self._total_cart_lines -= len(cart.items)
+            self._carts_dropped += 1
             self._save()
 
-    def display_cart(self, buyer_id: int) -> List[Dict[str, Any]]:
+    def display_cart(self, buyer_id: int) -> Tuple[List[Dict[str, Any]], str]:
+        """Returns (lines, etag)."""
         with self._lock:
-            cart = self._get_or_create_cart(buyer_id)
-            out = []
+            cart = self._get_cart(buyer_id)
+            out: List[Dict[str, Any]] = []
+            if cart is None:
+                return out, self._cart_etag(None)
             for key, qty in cart.items.items():
                 cat, iid = key.split(":")
                 out.append({"item_id": {"category": int(cat), "id": int(iid)}, "quantity": int(qty)})
             out.sort(key=lambda x: (x["item_id"]["category"], x["item_id"]["id"]))
-            return out
+            return out, self._cart_etag(cart)
+
+    def cart_metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "carts": len(self.carts),
+                "saved_carts": sum(1 for c in self.carts.values() if c.saved),
+                "total_lines": self._total_cart_lines,
+                "max_cart_lines": self.max_cart_lines,
+                "max_total_cart_lines": self.max_total_cart_lines,
+                "rejected_adds": self._cart_rejects,
+                "carts_dropped": self._carts_dropped,
+            }
 
     def logout_cleanup(self, buyer_id: int) -> None:
         """
@@ -291,8 +513,6 @@ class ProductStore:
         Called by Buyer Frontend on Logout.
         """
         with self._lock:
-            cart = self._get_or_create_cart(buyer_id)
-            if not cart.saved:
-                cart.items = {}
-                cart.saved = False
-                self._save()
+            cart = self._get_cart(buyer_id)
+            if cart is not None and not cart.saved:
+                self.clear_cart(buyer_id)